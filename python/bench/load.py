@@ -0,0 +1,474 @@
+"""
+Load test for the web endpoints: simulated users upload an image, process it a few times with different settings
+and download the bead template, over persistent HTTP/1.1 connections.
+
+By default a local server is launched with a private SQLite database and TMP_DIR; --url targets a running server
+instead (e.g. the production WSGI setup under test).
+
+    python -m bench.load --users 8 --duration 60 --output load.json
+    python -m bench.load --url http://127.0.0.1:8000 --users 32 --compare load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from http.cookies import SimpleCookie
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+
+from bench.pipeline import synthetic_image
+
+ENDPOINTS = ('index', 'upload', 'process', 'download')
+# (width, height, format) of uploaded images, with relative weights
+IMAGE_MIX = (((320, 240, 'png'), 3), ((800, 600, 'jpeg'), 4), ((1600, 1200, 'jpeg'), 2), ((3000, 2000, 'jpeg'), 1))
+# Longest side of the bead grid, with relative weights
+GRID_MIX = ((32, 3), (64, 4), (128, 2), (256, 1))
+# Palette selections: every bead, or a random subset of this many beads, with relative weights
+PALETTE_MIX = ((None, 5), (10, 2), (30, 2), (60, 1))
+METRIC_MIX = (('weighted_euclidian', 6), ('cie76', 3), ('ciede2000', 1))
+DITHER_MIX = (('none', 7), ('floyd_steinberg', 2), ('bayer', 1))
+PERCENTILES = (50, 90, 95, 99)
+SEED = 1234
+
+
+class HTTPConnection:
+    """
+    Minimal keep-alive HTTP/1.1 client connection on asyncio streams. Reconnects when the server closes the
+    connection.
+    """
+
+    def __init__(self, host: str, port: int, timeout: float):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.cookies = {}
+        self.connects = 0
+        self._reader = None
+        self._writer = None
+
+    async def request(self, method: str, path: str, body: bytes = b'',
+                      headers: Dict[str, str] = None) -> Tuple[int, Dict[str, str], bytes]:
+        """
+        Send a request and read the whole response
+        :return: (status, headers with lower-cased names, body)
+        """
+        headers = dict(headers or {})
+        headers.setdefault('Host', '{}:{}'.format(self.host, self.port))
+        headers['Content-Length'] = str(len(body))
+        if len(self.cookies) > 0:
+            headers['Cookie'] = '; '.join('{}={}'.format(name, value) for (name, value) in self.cookies.items())
+            if 'csrftoken' in self.cookies:
+                headers['X-CSRFToken'] = self.cookies['csrftoken']
+        head = '{} {} HTTP/1.1\r\n{}\r\n'.format(method, path, ''.join(
+            '{}: {}\r\n'.format(name, value) for (name, value) in headers.items()))
+
+        # A kept-alive connection may have been closed by the server in the meantime; retry once on a new one
+        for attempt in range(2):
+            reused = self._writer is not None
+            if not reused:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.timeout)
+                self.connects += 1
+            try:
+                self._writer.write(head.encode('latin-1') + body)
+                await self._writer.drain()
+                return await asyncio.wait_for(self._read_response(), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if not reused or attempt > 0:
+                    raise
+
+    async def _read_response(self) -> Tuple[int, Dict[str, str], bytes]:
+        status_line = await self._reader.readuntil(b'\r\n')
+        version, status = status_line.decode('latin-1').split(' ', 2)[:2]
+        headers = {}
+        while True:
+            line = (await self._reader.readuntil(b'\r\n')).decode('latin-1')
+            if line == '\r\n':
+                break
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            if name == 'set-cookie':
+                cookie = SimpleCookie(value.strip())
+                self.cookies.update({key: morsel.value for (key, morsel) in cookie.items()})
+            headers[name] = value.strip()
+
+        if 'content-length' in headers:
+            body = await self._reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self._reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                chunks.append(await self._reader.readexactly(size + 2))
+                if size == 0:
+                    break
+            body = b''.join(chunk[:-2] for chunk in chunks)
+        else:
+            body = await self._reader.read()
+
+        if version != 'HTTP/1.1' or headers.get('connection', '').lower() == 'close' or \
+                ('content-length' not in headers and 'transfer-encoding' not in headers):
+            self.close()
+        return int(status), headers, body
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+def _choose(rng: random.Random, mix):
+    """
+    Weighted choice from a tuple of (value, weight)
+    """
+    values, weights = zip(*mix)
+    return rng.choices(values, weights=weights)[0]
+
+
+def _multipart(field: str, file_name: str, content_type: str, data: bytes) -> (bytes, str):
+    """
+    Encode a single file upload
+    :return: (body, content type header)
+    """
+    boundary = uuid.uuid4().hex
+    body = '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\nContent-Type: {}\r\n\r\n'.format(
+        boundary, field, file_name, content_type).encode('utf-8') + data + '\r\n--{}--\r\n'.format(
+        boundary).encode('utf-8')
+    return body, 'multipart/form-data; boundary={}'.format(boundary)
+
+
+def make_images() -> Dict[tuple, bytes]:
+    """
+    Encode one synthetic image per entry of IMAGE_MIX
+    """
+    images = {}
+    for (width, height, fmt), _ in IMAGE_MIX:
+        image = synthetic_image(max(width, height)).resize((width, height))
+        with BytesIO() as buffer:
+            image.save(buffer, fmt, quality=90)
+            images[(width, height, fmt)] = buffer.getvalue()
+    return images
+
+
+class Stats:
+    """
+    Latencies, statuses and errors per endpoint
+    """
+
+    def __init__(self):
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.statuses = {endpoint: {} for endpoint in ENDPOINTS}
+        self.bytes = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.error_samples = []
+
+    def record(self, endpoint: str, seconds: float, status: Optional[int], size: int, error: str = None) -> None:
+        self.latencies[endpoint].append(seconds)
+        self.bytes[endpoint] += size
+        key = str(status) if status is not None else 'exception'
+        self.statuses[endpoint][key] = self.statuses[endpoint].get(key, 0) + 1
+        if error is not None:
+            self.errors[endpoint] += 1
+            if len(self.error_samples) < 20:
+                self.error_samples.append('{}: {}'.format(endpoint, error))
+
+    def summary(self, elapsed: float) -> List[dict]:
+        results = []
+        for endpoint in ENDPOINTS:
+            latencies = self.latencies[endpoint]
+            if len(latencies) == 0:
+                continue
+            result = {
+                'endpoint': endpoint,
+                'requests': len(latencies),
+                'errors': self.errors[endpoint],
+                'error_rate': self.errors[endpoint] / len(latencies),
+                'throughput': len(latencies) / elapsed,
+                'mean_seconds': statistics.mean(latencies),
+                'max_seconds': max(latencies),
+                'bytes': self.bytes[endpoint],
+                'statuses': self.statuses[endpoint],
+            }
+            for percentile, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+                result['p{}_seconds'.format(percentile)] = float(value)
+            results.append(result)
+        return results
+
+
+async def _timed(stats: Stats, endpoint: str, conn: HTTPConnection, method: str, path: str, body: bytes = b'',
+                 headers: Dict[str, str] = None) -> Optional[Tuple[int, Dict[str, str], bytes]]:
+    """
+    Send a request, recording its latency and outcome
+    :return: the response, or None if the request failed
+    """
+    start = time.perf_counter()
+    try:
+        status, response_headers, response_body = await conn.request(method, path, body, headers)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+        stats.record(endpoint, time.perf_counter() - start, None, 0, '{}: {}'.format(type(e).__name__, e))
+        return None
+    error = None
+    if status >= 400:
+        error = 'HTTP {}'.format(status)
+    elif endpoint == 'upload' and json.loads(response_body or b'{}').get('error') is not None:
+        error = json.loads(response_body)['error']
+    stats.record(endpoint, time.perf_counter() - start, status, len(response_body), error)
+    return (status, response_headers, response_body) if error is None else None
+
+
+async def user(user_id: int, args, images: Dict[tuple, bytes], stats: Stats, deadline: float) -> int:
+    """
+    One simulated user: sessions of upload -> process (one or more times) -> optional download, until the
+    deadline or the session limit
+    :return: number of TCP connections opened
+    """
+    rng = random.Random(SEED + user_id)
+    conn = HTTPConnection(args.host, args.port, args.timeout)
+    bead_ids = None
+    sessions = 0
+    try:
+        # The home page sets the CSRF cookie where CSRF protection is enabled
+        await _timed(stats, 'index', conn, 'GET', '/')
+        while time.monotonic() < deadline and (args.sessions is None or sessions < args.sessions):
+            sessions += 1
+            (width, height, fmt) = _choose(rng, IMAGE_MIX)
+            body, content_type = _multipart('file', 'image.{}'.format(fmt), 'image/{}'.format(fmt),
+                                            images[(width, height, fmt)])
+            response = await _timed(stats, 'upload', conn, 'POST', '/upload/', body, {'Content-Type': content_type})
+            if response is None:
+                continue
+            key = json.loads(response[2])['key']
+
+            for _ in range(rng.randint(1, args.max_tweaks)):
+                if time.monotonic() >= deadline:
+                    break
+                grid = _choose(rng, GRID_MIX)
+                params = [('width', grid), ('height', grid), ('metric', _choose(rng, METRIC_MIX)),
+                          ('dither', _choose(rng, DITHER_MIX))]
+                palette_size = _choose(rng, PALETTE_MIX)
+                if palette_size is not None and bead_ids:
+                    params += [('colors', bead_id) for bead_id in rng.sample(bead_ids, min(palette_size,
+                                                                                          len(bead_ids)))]
+                if rng.random() < 0.5:
+                    params.append(('blur', 1))
+                if rng.random() < args.reduce_rate:
+                    params.append(('num_colors', rng.choice((8, 16, 24))))
+                response = await _timed(stats, 'process', conn, 'POST', '/process/?' + urlencode({'key': key}),
+                                        urlencode(params).encode('ascii'),
+                                        {'Content-Type': 'application/x-www-form-urlencoded'})
+                if response is not None and bead_ids is None:
+                    # Learn the palette from the color picker of the process page
+                    picker = re.search(r'id="colors".*?</select>', response[2].decode(), re.DOTALL)
+                    bead_ids = [int(value) for value in re.findall(r'<option value="(\d+)"', picker.group(0))] \
+                        if picker is not None else []
+
+            if rng.random() < args.download_rate and time.monotonic() < deadline:
+                await _timed(stats, 'download', conn, 'GET', '/download/?' + urlencode({'key': key}))
+    finally:
+        conn.close()
+    return conn.connects
+
+
+async def run_load(args) -> (Stats, float, int):
+    """
+    Run every user concurrently
+    :return: (stats, elapsed seconds, TCP connections opened)
+    """
+    images = make_images()
+    stats = Stats()
+    start = time.monotonic()
+    deadline = start + args.duration
+    connects = await asyncio.gather(*(user(i, args, images, stats, deadline) for i in range(args.users)))
+    return stats, time.monotonic() - start, sum(connects)
+
+
+def serve(port: int, tmp_dir: str) -> None:
+    """
+    Run the development server on a private SQLite database and TMP_DIR (runs in the server subprocess)
+    """
+    import django
+    from django.conf import settings
+    import pixel.settings
+    overrides = {name: getattr(pixel.settings, name) for name in dir(pixel.settings) if name.isupper()}
+    overrides.update(DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                                            'NAME': os.path.join(tmp_dir, 'db.sqlite3')}},
+                     TMP_DIR=tmp_dir, DEBUG=False, ALLOWED_HOSTS=['*'],
+                     # Migrations are not part of the repository; create the tables directly
+                     MIGRATION_MODULES={'core': None})
+    # The development server keeps connections alive only for responses with a Content-Length
+    common = 'django.middleware.common.CommonMiddleware'
+    if common not in overrides.get('MIDDLEWARE', []):
+        overrides['MIDDLEWARE'] = [common] + list(overrides.get('MIDDLEWARE', []))
+    settings.configure(**overrides)
+    pixel.settings.TMP_DIR = tmp_dir
+    django.setup()
+
+    from django.core.management import call_command
+    from django.core.servers.basehttp import run
+    from django.core.wsgi import get_wsgi_application
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    call_command('loaddata', 'colors', verbosity=0)
+    run('127.0.0.1', port, get_wsgi_application(), threading=True)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def launch_server(tmp_dir: str, timeout: float = 60) -> (subprocess.Popen, int, str):
+    """
+    Start a local server subprocess and wait until it accepts connections
+    :return: (process, port, path of the server log)
+    """
+    port = _free_port()
+    log_file = os.path.join(tmp_dir, 'server.log')
+    with open(log_file, 'wb') as log:
+        process = subprocess.Popen([sys.executable, '-m', 'bench.load', '--serve', str(port), '--tmp-dir', tmp_dir],
+                                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                   stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Server exited; see {}'.format(log_file))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port, log_file
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('Server did not start within {} seconds; see {}'.format(timeout, log_file))
+
+
+def compare(results: List[dict], baseline: List[dict], threshold: float) -> List[str]:
+    """
+    Find endpoints whose p95 latency, throughput or error rate got worse than the baseline
+    :param results: current summary
+    :param baseline: baseline summary
+    :param threshold: allowed relative change (0.2 = 20%)
+    :return: descriptions of the regressions
+    """
+    previous = {result['endpoint']: result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(result['endpoint'])
+        if old is None:
+            continue
+        if result['p95_seconds'] > old['p95_seconds'] * (1 + threshold):
+            regressions.append('{} p95 {:.3f}s -> {:.3f}s'.format(result['endpoint'], old['p95_seconds'],
+                                                                 result['p95_seconds']))
+        if result['throughput'] < old['throughput'] * (1 - threshold):
+            regressions.append('{} throughput {:.2f}/s -> {:.2f}/s'.format(result['endpoint'], old['throughput'],
+                                                                          result['throughput']))
+        if result['error_rate'] > old['error_rate'] + 0.01:
+            regressions.append('{} error rate {:.1%} -> {:.1%}'.format(result['endpoint'], old['error_rate'],
+                                                                       result['error_rate']))
+    return regressions
+
+
+def print_summary(results: List[dict], elapsed: float, connects: int) -> None:
+    total = sum(result['requests'] for result in results)
+    print('{} requests in {:.1f}s ({:.2f}/s) over {} connections'.format(total, elapsed, total / elapsed, connects))
+    print('{:>9} {:>7} {:>8} {:>7} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'endpoint', 'count', 'req/s', 'errors', 'p50', 'p90', 'p95', 'p99', 'max'))
+    for result in results:
+        print('{endpoint:>9} {requests:>7} {throughput:>8.2f} {error_rate:>7.1%} {p50_seconds:>7.3f}s '
+              '{p90_seconds:>7.3f}s {p95_seconds:>7.3f}s {p99_seconds:>7.3f}s {max_seconds:>7.3f}s'.format(**result))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='server to test (a local server is launched if omitted)')
+    parser.add_argument('--users', type=int, default=8, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run for')
+    parser.add_argument('--sessions', type=int, help='stop each user after this many upload sessions')
+    parser.add_argument('--max-tweaks', type=int, default=3, help='most process requests per upload')
+    parser.add_argument('--reduce-rate', type=float, default=0.2,
+                        help='fraction of process requests that reduce the palette')
+    parser.add_argument('--download-rate', type=float, default=0.5, help='fraction of sessions that download')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds before a request fails')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative change when comparing')
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    parser.add_argument('--tmp-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve is not None:
+        serve(args.serve, args.tmp_dir)
+        return 0
+
+    server = None
+    if args.url:
+        url = urlsplit(args.url)
+        args.host, args.port = url.hostname, url.port or 80
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix='pixel-load-')
+        server, args.port, log_file = launch_server(tmp_dir)
+        args.host = '127.0.0.1'
+        print('Server on port {} (log: {})'.format(args.port, log_file), file=sys.stderr)
+
+    try:
+        stats, elapsed, connects = asyncio.run(run_load(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if server is not None:
+        # Kept, with the server log, if the run failed
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    results = stats.summary(elapsed)
+    print_summary(results, elapsed, connects)
+    for sample in stats.error_samples:
+        print('  error: ' + sample)
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'url': args.url or 'local',
+        },
+        'config': {'users': args.users, 'duration': args.duration, 'sessions': args.sessions,
+                   'max_tweaks': args.max_tweaks, 'reduce_rate': args.reduce_rate,
+                   'download_rate': args.download_rate},
+        'elapsed_seconds': elapsed,
+        'connections': connects,
+        'results': results,
+        'errors': stats.error_samples,
+    }
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fin:
+            baseline = json.load(fin)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if len(regressions) > 0:
+            return 1
+        print('No regressions against {}'.format(args.compare))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
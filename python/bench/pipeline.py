@@ -0,0 +1,256 @@
+"""
+Benchmarks for the image -> bead pipeline and PDF generation.
+
+Runs from the python/ directory without a database server: Django is configured from pixel.settings with an
+in-memory SQLite database, and palettes are unsaved BeadColor objects.
+
+    python -m bench.pipeline --output baseline.json
+    python -m bench.pipeline --compare baseline.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from base64 import b64encode
+from io import BytesIO
+
+import django
+import numpy as np
+from django.conf import settings
+
+GRID_SIZES = (32, 64, 128, 256, 512)
+PALETTE_SIZES = (10, 30, 100, 300)
+# Number of colors palettes are reduced to in the reduction stage
+REDUCED_COLORS = 12
+SEED = 1234
+
+
+def _configure() -> None:
+    """
+    Configure Django from the project settings, swapping in an in-memory database and a private TMP_DIR
+    """
+    if settings.configured:
+        return
+    import pixel.settings
+    tmp_dir = tempfile.mkdtemp(prefix='pixel-bench-')
+    overrides = {name: getattr(pixel.settings, name) for name in dir(pixel.settings) if name.isupper()}
+    overrides.update(DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+                     TMP_DIR=tmp_dir)
+    settings.configure(**overrides)
+    pixel.settings.TMP_DIR = tmp_dir
+    django.setup()
+
+
+def synthetic_image(size: int, seed: int = SEED):
+    """
+    Deterministic test image: smooth gradients with noise and a few flat shapes, like typical sprite sources
+    :param size: width and height
+    :param seed: random seed
+    :return: RGB image
+    """
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / max(1, size - 1)
+    data = np.stack([x * 255, y * 255, (1 - x) * (1 - y) * 255], axis=-1)
+    data += rng.normal(0, 12, data.shape)
+    for _ in range(6):
+        x0, y0 = rng.integers(0, size, 2)
+        w, h = rng.integers(size // 8 + 1, size // 3 + 2, 2)
+        data[y0:y0 + h, x0:x0 + w] = rng.integers(0, 256, 3)
+    return Image.fromarray(np.clip(data, 0, 255).astype(np.uint8), 'RGB')
+
+
+def synthetic_palette(size: int, seed: int = SEED):
+    """
+    Deterministic palette of unsaved bead colors
+    :param size: number of colors
+    :param seed: random seed
+    :return: list of BeadColor
+    """
+    from core.models import BeadColor
+    rng = np.random.default_rng(seed)
+    colors = rng.integers(0, 256, (size, 3))
+    return [BeadColor(id=i + 1, brand_id=1, name='Bead {}'.format(i + 1), red=int(r), green=int(g), blue=int(b))
+            for i, (r, g, b) in enumerate(colors)]
+
+
+def measure(fn, repeat: int) -> dict:
+    """
+    Measure a stage: best and median wall time over several runs, then peak memory and net allocated blocks from
+    one separate traced run (tracing slows execution, so it is not timed)
+    :param fn: callable running the stage
+    :param repeat: number of timed runs
+    :return: dict of measurements
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+
+    return {'seconds': min(times), 'median_seconds': statistics.median(times), 'peak_bytes': peak,
+            'allocated_blocks': sys.getallocatedblocks() - blocks}
+
+
+def run(grid_sizes, palette_sizes, metrics, repeat: int, include_pdf: bool = True):
+    """
+    Run the benchmark sweep
+    :return: list of result dicts
+    """
+    from util.color_index import palette_index_cache
+    from util.image import downsample, remap, upsample
+    from util.pattern import VALID_COLOR_CODES
+    from util.pdf import PDFGenerator
+    from util.reduction import reduce_palette
+
+    results = []
+
+    def record(stage, grid, palette, metric, fn):
+        result = {'stage': stage, 'grid': grid, 'palette': palette, 'metric': metric}
+        result.update(measure(fn, repeat))
+        results.append(result)
+        print('{stage:>12} grid={grid:<4} palette={palette!s:<4} metric={metric!s:<18} {seconds:9.4f}s '
+              'peak={peak_bytes:>11,}B'.format(**result), file=sys.stderr)
+
+    source = synthetic_image(1024)
+    preview = downsample(source, 512, 512)
+
+    def encode_png(image):
+        with BytesIO() as buffer:
+            image.save(buffer, 'png')
+            return b64encode(buffer.getvalue())
+
+    record('downsample', 512, None, None, lambda: downsample(source, 512, 512))
+    record('encode_png', 512, None, None, lambda: encode_png(preview))
+
+    for grid in grid_sizes:
+        px_image = downsample(preview, grid, grid)
+        record('grid_resize', grid, None, None, lambda: downsample(preview, grid, grid))
+
+        for palette_size in palette_sizes:
+            palette = synthetic_palette(palette_size)
+            for metric in metrics:
+                def cold_remap():
+                    # Include building the palette index, as on the first request for a selection
+                    palette_index_cache.clear()
+                    return remap(px_image, palette, metric=metric)
+                record('remap', grid, palette_size, metric, cold_remap)
+                record('remap_warm', grid, palette_size, metric, lambda: remap(px_image, palette, metric=metric))
+                if palette_size > REDUCED_COLORS:
+                    record('reduce', grid, palette_size, metric,
+                           lambda: reduce_palette(px_image, palette, REDUCED_COLORS, metric))
+
+        remapped = remap(px_image, synthetic_palette(palette_sizes[-1]))
+        record('upsample', grid, None, None, lambda: upsample(remapped, 512, 512))
+        record('encode_sprite', grid, None, None, lambda: encode_png(upsample(remapped, 512, 512)))
+
+        if include_pdf:
+            # Charts label each color with one code, so the palette is capped at the number of codes
+            pdf_palette_size = min(palette_sizes[-1], len(VALID_COLOR_CODES))
+            if pdf_palette_size < palette_sizes[-1]:
+                remapped = remap(px_image, synthetic_palette(pdf_palette_size))
+            data = np.asarray(remapped.convert('RGB')).reshape(-1, 3)
+            _, codes = np.unique(data, axis=0, return_inverse=True)
+            color_map = {VALID_COLOR_CODES[i]: 'Bead {}'.format(i) for i in range(codes.max() + 1)}
+            code_data = [VALID_COLOR_CODES[i] for i in codes.reshape(-1)]
+            palette_size = len(color_map)
+
+            def table_pdf():
+                PDFGenerator(color_map, code_data, grid).generate_pdf()
+
+            def canvas_pdf():
+                with BytesIO() as buffer:
+                    PDFGenerator(color_map, code_data, grid).write_pdf(buffer)
+
+            record('pdf_table', grid, palette_size, None, table_pdf)
+            record('pdf_canvas', grid, palette_size, None, canvas_pdf)
+
+    return results
+
+
+def compare(results, baseline, threshold: float, min_seconds: float):
+    """
+    Find stages that got slower than the baseline
+    :param results: current results
+    :param baseline: baseline results
+    :param threshold: allowed relative slowdown (0.2 = 20%)
+    :param min_seconds: absolute slowdown below which differences are treated as noise
+    :return: list of (result, baseline seconds) for regressions
+    """
+    def key(result):
+        return result['stage'], result['grid'], result['palette'], result['metric']
+
+    previous = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        slowdown = result['seconds'] - old['seconds']
+        if slowdown > min_seconds and result['seconds'] > old['seconds'] * (1 + threshold):
+            regressions.append((result, old['seconds']))
+    return regressions
+
+
+def main(argv=None) -> int:
+    _configure()
+    from util.color import METRICS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--grid', type=int, nargs='+', default=GRID_SIZES, help='grid sizes (beads per side)')
+    parser.add_argument('--palette', type=int, nargs='+', default=PALETTE_SIZES, help='palette sizes')
+    parser.add_argument('--metric', nargs='+', default=METRICS, choices=METRICS, help='color metrics')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage')
+    parser.add_argument('--no-pdf', action='store_true', help='skip PDF generation')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative slowdown when comparing')
+    parser.add_argument('--min-seconds', type=float, default=0.002,
+                        help='ignore slowdowns smaller than this many seconds when comparing')
+    args = parser.parse_args(argv)
+
+    results = run(args.grid, args.palette, args.metric, args.repeat, include_pdf=not args.no_pdf)
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fin:
+            baseline = json.load(fin)['results']
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        for result, old_seconds in regressions:
+            print('REGRESSION {stage} grid={grid} palette={palette} metric={metric}: {old:.4f}s -> {seconds:.4f}s'
+                  .format(old=old_seconds, **result))
+        if len(regressions) > 0:
+            return 1
+        print('No regressions against {}'.format(args.compare))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+
+from util.batch import BATCH_WORKERS, BatchItem, DirectoryWriter, ZipWriter, item_names, run_batch, write_results
+from util.pipeline import parse_process_params
+
+_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.tif', '.tiff')
+
+
+class Command(BaseCommand):
+    help = 'Converts many images to bead template PDFs and bead counts, writing them to a directory or zip file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='+', help='Image files, or directories to convert every image of')
+        parser.add_argument('--output', required=True,
+                            help='Output directory, or a file name ending in .zip to write a zip archive')
+        parser.add_argument('--params', action='append', default=None,
+                            help='Processing parameters as a query string, e.g. "width=64&height=64&dither=bayer" '
+                                 '(repeatable; every image is converted with every parameter set)')
+        parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help='Number of worker processes')
+
+    def handle(self, *args, **options):
+        files = []
+        for path in options['images']:
+            if os.path.isdir(path):
+                files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if os.path.splitext(name)[1].lower() in _IMAGE_EXTENSIONS)
+            elif os.path.isfile(path):
+                files.append(path)
+            else:
+                raise CommandError('No such file or directory: {}'.format(path))
+        if len(files) == 0:
+            raise CommandError('No images to convert')
+
+        param_sets = [parse_process_params(QueryDict(query)) for query in options['params'] or ['']]
+        names = iter(item_names(files, len(param_sets)))
+        items = [BatchItem(next(names), src_file, params) for src_file in files for params in param_sets]
+
+        output = options['output']
+        if output.lower().endswith('.zip'):
+            zip_file = open(output, 'wb')
+            writer = ZipWriter(zip_file)
+        else:
+            zip_file = None
+            writer = DirectoryWriter(output)
+
+        failed = 0
+        try:
+            for completed, total, result in write_results(run_batch(items, options['workers']), writer, len(items)):
+                if result.error is None:
+                    self.stdout.write('[{}/{}] {}'.format(completed, total, result.item.name))
+                else:
+                    failed += 1
+                    self.stderr.write('[{}/{}] {} failed: {}'.format(completed, total, result.item.name, result.error))
+        finally:
+            if zip_file is not None:
+                zip_file.close()
+
+        self.stdout.write('Converted {} of {} images into {}'.format(len(items) - failed, len(items), output))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import BeadBrand
+from util.lookup import ALL_BRANDS, DEFAULT_BITS, ColorLookupTable, palette_beads, table_lock
+
+
+class Command(BaseCommand):
+    help = 'Builds the memory-mapped RGB -> nearest bead lookup tables used by remap'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bits', type=int, default=DEFAULT_BITS,
+                            help='Bits per channel of the RGB cube (8 for an exact table, 5 or 6 for a compact one)')
+        parser.add_argument('--brand', action='append', dest='brands', default=None,
+                            help='Brand id to build a table for (repeatable). Defaults to every brand plus all beads.')
+
+    def handle(self, *args, **options):
+        bits = options['bits']
+        if not 1 <= bits <= 8:
+            raise CommandError('--bits must be between 1 and 8')
+
+        names = options['brands']
+        if names is None:
+            names = [ALL_BRANDS] + [str(brand_id) for brand_id in BeadBrand.objects.values_list('id', flat=True)]
+
+        for name in names:
+            beads = list(palette_beads(name))
+            if len(beads) == 0:
+                self.stderr.write('Skipping palette {}: no beads'.format(name))
+                continue
+            table = ColorLookupTable.build(name, beads, bits)
+            with table_lock():
+                table.save()
+            self.stdout.write('Built {}-bit table for palette {} ({} beads)'.format(bits, name, len(beads)))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from util.reaper import ORPHAN_GRACE, SESSION_MAX_BYTES, SESSION_TTL, TMP_MAX_BYTES, Reaper
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired image sessions and orphaned temporary files, and enforces the storage quotas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=float, default=SESSION_TTL,
+                            help='Seconds after which an unused session expires')
+        parser.add_argument('--session-max-bytes', type=int, default=SESSION_MAX_BYTES,
+                            help='Maximum bytes of files per session')
+        parser.add_argument('--max-bytes', type=int, default=TMP_MAX_BYTES,
+                            help='Maximum bytes of all session files')
+        parser.add_argument('--orphan-grace', type=float, default=ORPHAN_GRACE,
+                            help='Minimum age in seconds of an unreferenced file before it is removed')
+
+    def handle(self, *args, **options):
+        reaper = Reaper(ttl=options['ttl'], session_max_bytes=options['session_max_bytes'],
+                        max_bytes=options['max_bytes'], orphan_grace=options['orphan_grace'])
+        stats = reaper.run()
+        self.stdout.write('Expired {sessions_expired} and evicted {sessions_evicted} sessions, removed '
+                          '{job_results_removed} job results and {orphans_removed} orphaned files; reclaimed '
+                          '{bytes_reclaimed} bytes in {files_removed} files'.format(**stats))
@@ -0,0 +1,19 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from util.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = 'Runs the web worker warm-up in this process and reports the time spent in each step'
+    # The system checks would import the URLconf before the warm-up times it
+    requires_system_checks = []
+
+    def handle(self, *args, **options):
+        report = warm_up(freeze=False)
+        width = max(len(name) for name in report)
+        for name, seconds in report.items():
+            self.stdout.write('{:<{}} {:8.3f}s'.format(name, width, seconds))
+        heavy = [name for name in ('reportlab', 'util.pdf') if name in sys.modules]
+        self.stdout.write('Lazily imported modules already loaded: {}'.format(', '.join(heavy) or 'none'))
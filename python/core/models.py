@@ -1,6 +1,8 @@
+import json
 import os
 
 from django.db import models
+from django.utils import timezone
 
 
 class Color(models.Model):
@@ -61,10 +63,94 @@ class BeadDistance(models.Model):
 class ImageSession(models.Model):
     session_key = models.TextField(primary_key=True)
     src_file = models.TextField()
-    processed_file = models.TextField(blank=True, null=True)
+    src_hash = models.TextField(blank=True, null=True)
+    working_file = models.TextField(blank=True, null=True)
+    pattern_file = models.TextField(blank=True, null=True)
+    # JSON list of [bead id, count] pairs of the pattern, most used first
+    pattern_counts = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(default=timezone.now)
+    # Last time the session was used; sessions idle for longer than SESSION_TTL are reaped
+    accessed = models.DateTimeField(default=timezone.now, db_index=True)
+
+    @property
+    def image_file(self):
+        """
+        Image to process: the normalized working copy, or the original for sessions created without one
+        """
+        return self.working_file or self.src_file
+
+    @property
+    def files(self):
+        """
+        Files owned by the session itself (job results are owned by the jobs)
+        """
+        return [fp for fp in (self.src_file, self.working_file, self.pattern_file) if fp]
+
+    def touch(self):
+        """
+        Record that the session was used
+        """
+        self.accessed = timezone.now()
+        ImageSession.objects.filter(pk=self.pk).update(accessed=self.accessed)
+
+    @property
+    def bead_counts(self):
+        """
+        Bead counts of the pattern as [bead id, count] pairs, None if they have not been computed
+        """
+        return json.loads(self.pattern_counts) if self.pattern_counts else None
+
+    def set_pattern_file(self, pattern_file, counts=None):
+        """
+        Replace the session's pattern, removing the previous pattern file
+        :param pattern_file: path of the new pattern
+        :param counts: bead counts of the new pattern, if known
+        """
+        previous = self.pattern_file
+        self.pattern_file = pattern_file
+        self.pattern_counts = json.dumps(counts) if counts is not None else None
+        self.accessed = timezone.now()
+        self.save()
+        if previous and previous != pattern_file and os.path.isfile(previous):
+            os.remove(previous)
 
     def delete(self, *args, **kwargs):
-        for fp in (self.src_file, self.processed_file):
-            if fp is not None and os.path.isfile(fp):
+        for fp in self.files:
+            if os.path.isfile(fp):
                 os.remove(fp)
+        for job in self.processingjob_set.all():
+            job.delete_files()
+        super().delete(*args, **kwargs)
+
+
+class ProcessingJob(models.Model):
+    """
+    Model that tracks a background job (processing or PDF generation) for an image session
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+    PROCESS = 'process'
+    DOWNLOAD = 'download'
+
+    job_id = models.TextField(primary_key=True)
+    session = models.ForeignKey(ImageSession, on_delete=models.CASCADE)
+    kind = models.TextField()
+    status = models.TextField(default=QUEUED)
+    params = models.TextField(default='{}')
+    result_file = models.TextField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def delete_files(self):
+        if self.result_file is not None and os.path.isfile(self.result_file):
+            os.remove(self.result_file)
+
+    def delete(self, *args, **kwargs):
+        self.delete_files()
         super().delete(*args, **kwargs)
@@ -0,0 +1,39 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from core.models import BeadBrand, BeadColor
+from util.cache import result_cache
+from util.lookup import schedule_refresh
+from util.palette import palette_registry
+
+
+@receiver(post_save, sender=BeadColor)
+@receiver(post_delete, sender=BeadColor)
+def update_lookup_tables(sender, **kwargs) -> None:
+    """
+    Update the built lookup tables once the change is committed, in the background: a rolled back change never
+    reaches the tables, and the request does not wait for the cube to be rematched
+    """
+    transaction.on_commit(schedule_refresh)
+
+
+@receiver(post_save, sender=BeadColor)
+@receiver(post_delete, sender=BeadColor)
+def invalidate_result_cache(sender, **kwargs) -> None:
+    """
+    Drop cached results once the palette change is committed, so that a request racing the transaction cannot cache a
+    result of the old palette after the invalidation
+    """
+    transaction.on_commit(result_cache.invalidate)
+
+
+@receiver(post_save, sender=BeadColor)
+@receiver(post_delete, sender=BeadColor)
+@receiver(post_save, sender=BeadBrand)
+@receiver(post_delete, sender=BeadBrand)
+def invalidate_palette(sender, **kwargs) -> None:
+    """
+    Reload the palette snapshot once the change is committed, so that other processes never reload stale rows
+    """
+    transaction.on_commit(palette_registry.invalidate)
@@ -0,0 +1,1006 @@
+import csv
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from xml.etree import ElementTree
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest import mock, skipIf
+
+import numpy as np
+from PIL import Image
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError, transaction
+from django.http import HttpResponse, QueryDict
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+from bench import load as bench_load, pipeline as bench_pipeline
+from core.models import BeadBrand, BeadColor, ImageSession, ProcessingJob
+from util.color import CIEDE2000, METRICS, colors_to_array, nearest_color_indices
+from util.color_index import PaletteIndex, PaletteIndexCache, palette_index_cache
+from util import jobs, pdf
+from util.dither import ATKINSON, BAYER, DITHER_MODES, FLOYD_STEINBERG, NONE, dither
+from util.batch import BatchItem, BatchResult, ChunkBuffer, ZipWriter, convert, item_names, run_shared_batch, \
+    write_results
+from util.cache import ResultCache
+from util.export import CSV, EXPORT_FORMATS, JSON, SVG, export_pattern
+from util.general import UploadTooLarge, create_tmp_file
+from util.image import ImageTooLarge, alpha_mask, create_working_copy, remap_pattern
+from util.instrument import count, instrumented, registry, stage
+from util.lookup import ALL_BRANDS, ColorLookupTable, find_table, palette_beads, refresh_tables, tables_version
+from util.mural import remap_mural
+from util.palette import PaletteRegistry, PaletteSnapshot, palette_registry
+from util.pipeline import count_summary, create_pattern, parse_process_params, pattern_counts, write_pattern_pdf
+from util.pattern import BLANK_CODE, VALID_COLOR_CODES, BeadPattern
+from util.pdf import PDFGenerator
+from util.preview import PNG, create_preview_response, parse_preview_params, preview_etag
+from util.reaper import Reaper
+from util.reduction import reduce_palette
+from util.stage_cache import StageCache
+
+
+def make_palette(size: int, seed: int = 0):
+    """
+    Unsaved bead colors with random RGB values
+    :param size: number of beads
+    :param seed: random seed
+    :return: list of BeadColor
+    """
+    rng = np.random.default_rng(seed)
+    return [BeadColor(id=i + 1, brand_id=1, name='Bead {}'.format(i + 1), red=int(r), green=int(g), blue=int(b))
+            for i, (r, g, b) in enumerate(rng.integers(0, 256, (size, 3)))]
+
+
+def make_image(width: int, height: int, seed: int = 0, mode: str = 'RGB') -> Image.Image:
+    """
+    Random noise image
+    :param width: image width
+    :param height: image height
+    :param seed: random seed
+    :param mode: 'RGB' or 'RGBA'
+    :return: the image
+    """
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (height, width, len(mode)), dtype=np.uint8), mode)
+
+
+def png_bytes(image: Image.Image) -> bytes:
+    """
+    Encode an image as PNG
+    :param image: the image
+    :return: PNG file contents
+    """
+    with BytesIO() as buffer:
+        image.save(buffer, 'png')
+        return buffer.getvalue()
+
+
+class UploadTests(TestCase):
+    def test_oversized_upload_is_removed(self):
+        with mock.patch('util.general.TMP_DIR', tempfile.mkdtemp()) as tmp_dir:
+            self.addCleanup(os.rmdir, tmp_dir)
+            with self.assertRaises(UploadTooLarge):
+                create_tmp_file(BytesIO(b'x' * 1000), max_bytes=999)
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+    def test_working_copy(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for mode in ('RGB', 'RGBA'):
+            with self.subTest(mode=mode):
+                path = os.path.join(directory.name, mode)
+                make_image(1000, 300, mode=mode).save(path, 'png')
+                working_copy = create_working_copy(path)
+                self.assertEqual((working_copy.size, working_copy.mode), ((512, 154), mode))
+                with self.assertRaises(ImageTooLarge):
+                    create_working_copy(path, max_pixels=1000 * 300 - 1)
+
+    def test_upload_view(self):
+        upload = SimpleUploadedFile('image.png', png_bytes(make_image(64, 48)))
+        data = self.client.post(reverse('core:upload'), {'file': upload}).json()
+        self.assertIsNone(data['error'])
+        session = ImageSession.objects.get(pk=data['key'])
+        self.addCleanup(session.delete)
+        self.assertEqual(Image.open(session.working_file).size, (512, 384))
+
+        with mock.patch('core.views.MAX_UPLOAD_BYTES', 100):
+            upload = SimpleUploadedFile('image.png', png_bytes(make_image(64, 48)))
+            data = self.client.post(reverse('core:upload'), {'file': upload}).json()
+        self.assertIsNone(data['key'])
+        self.assertIn('limit', data['error'])
+        self.assertEqual(ImageSession.objects.count(), 1)
+
+
+class RemapTests(SimpleTestCase):
+    def test_per_pixel_matches_vectorized(self):
+        image = make_image(12, 10, mode='RGBA')
+        palette = make_palette(20)
+        for metric in METRICS:
+            with self.subTest(metric=metric):
+                exact = remap_pattern(image, palette, method='per_pixel', metric=metric, alpha_threshold=128)
+                fast = remap_pattern(image, palette, method='vectorized', metric=metric, alpha_threshold=128)
+                np.testing.assert_array_equal(exact.mask, fast.mask)
+                np.testing.assert_array_equal(exact.codes([str(i) for i in exact.bead_ids]),
+                                              fast.codes([str(i) for i in fast.bead_ids]))
+
+
+class AlphaTests(SimpleTestCase):
+    def setUp(self):
+        data = np.asarray(make_image(16, 12, mode='RGBA')).copy()
+        data[..., 3] = np.where(np.arange(16) < 6, 40, 255)
+        self.image = Image.fromarray(data, 'RGBA')
+        self.kept = np.broadcast_to(np.arange(16) >= 6, (12, 16))
+
+    def test_mask(self):
+        self.assertIsNone(alpha_mask(self.image, 0))
+        self.assertIsNone(alpha_mask(self.image, 30))
+        self.assertIsNone(alpha_mask(self.image.convert('RGB'), 128))
+        np.testing.assert_array_equal(alpha_mask(self.image, 128), self.kept)
+
+    def test_empty_cells(self):
+        palette = make_palette(6)
+        for dither_mode in DITHER_MODES:
+            with self.subTest(dither=dither_mode):
+                pattern = remap_pattern(self.image, palette, dither=dither_mode, alpha_threshold=128)
+                np.testing.assert_array_equal(pattern.mask, self.kept)
+                self.assertEqual(pattern.counts().sum(), self.kept.sum())
+                codes = pattern.codes([str(i) for i in range(len(pattern.bead_ids))])
+                self.assertTrue((codes[~self.kept] == BLANK_CODE).all())
+                self.assertTrue((codes[self.kept] != BLANK_CODE).all())
+                np.testing.assert_array_equal(np.asarray(pattern.to_image().getchannel('A')), self.kept * 255)
+
+        # Nothing left to bead
+        pattern = remap_pattern(self.image, palette, alpha_threshold=256)
+        self.assertEqual((len(pattern.bead_ids), pattern.counts().sum()), (0, 0))
+        self.assertEqual(pattern.to_image().size, (16, 12))
+
+
+class DitherTests(SimpleTestCase):
+    def test_mixes_approximate_flat_colors(self):
+        index = PaletteIndex(np.array([[0, 0, 0], [255, 255, 255]]), METRICS[0])
+        data = np.full((32, 32, 3), 64, dtype=np.uint8)
+        self.assertEqual(dither(data, index, NONE).sum(), 0)
+        # Floyd-Steinberg keeps the whole error, so a quarter of the beads are white
+        self.assertAlmostEqual(dither(data, index, FLOYD_STEINBERG).mean(), 0.25, delta=0.02)
+        for mode in (ATKINSON, BAYER):
+            with self.subTest(mode=mode):
+                self.assertTrue(0.1 < dither(data, index, mode).mean() < 0.25)
+        with self.assertRaises(ValueError):
+            dither(data, index, 'unknown')
+
+    def test_masked_pixels_are_skipped(self):
+        index = PaletteIndex(colors_to_array(make_palette(8)), METRICS[0])
+        data = np.asarray(make_image(20, 16))
+        mask = np.random.default_rng(1).random((16, 20)) < 0.7
+        changed = data.copy()
+        changed[~mask] = 255 - changed[~mask]
+        for mode in DITHER_MODES:
+            with self.subTest(mode=mode):
+                result = dither(data, index, mode, mask)
+                self.assertTrue((result[~mask] == 0).all())
+                np.testing.assert_array_equal(dither(changed, index, mode, mask), result)
+
+
+class ReductionTests(SimpleTestCase):
+    def test_keeps_colors_of_image(self):
+        palette = make_palette(300)
+        chosen = [palette[i] for i in (4, 90, 250)]
+        rng = np.random.default_rng(0)
+        data = np.array([[bead.red, bead.green, bead.blue] for bead in chosen])[rng.integers(0, 3, (128, 128))]
+        data = np.clip(data + rng.integers(-6, 7, data.shape), 0, 255).astype(np.uint8)
+        image = Image.fromarray(data, 'RGB')
+        for metric in METRICS:
+            # The noise spreads over more histogram colors than the cap, so the histogram is coarsened
+            for max_colors in (4096, 16):
+                with self.subTest(metric=metric, max_colors=max_colors), \
+                        mock.patch('util.reduction.MAX_HISTOGRAM_COLORS', max_colors):
+                    self.assertEqual(reduce_palette(image, palette, 3, metric), chosen)
+
+
+class MuralTests(SimpleTestCase):
+    def test_matches_single_pass(self):
+        for size, mode, threshold in ((12, 'RGB', 0), (300, 'RGBA', 128)):
+            with self.subTest(size=size, mode=mode):
+                image = make_image(45, 31, seed=size, mode=mode)
+                palette = make_palette(size)
+                mural = remap_mural(image, palette, board_size=8, workers=2, alpha_threshold=threshold)
+                single = remap_pattern(image, palette, alpha_threshold=threshold)
+                self.assertEqual(mural.board_size, 8)
+                self.assertEqual(mural.indices.dtype, single.indices.dtype)
+                np.testing.assert_array_equal(mural.bead_ids, single.bead_ids)
+                np.testing.assert_array_equal(mural.colors, single.colors)
+                if single.mask is None:
+                    self.assertIsNone(mural.mask)
+                    np.testing.assert_array_equal(mural.indices, single.indices)
+                else:
+                    np.testing.assert_array_equal(mural.mask, single.mask)
+                    np.testing.assert_array_equal(mural.indices[mural.mask], single.indices[single.mask])
+
+    def test_dithered_boards_match_single_pass(self):
+        image = make_image(45, 31, mode='RGBA')
+        palette = make_palette(12)
+        for dither_mode in (FLOYD_STEINBERG, ATKINSON, BAYER):
+            with self.subTest(dither=dither_mode):
+                # Board rows of 6 are not a multiple of the Bayer matrix size
+                mural = remap_mural(image, palette, board_size=6, dither=dither_mode, alpha_threshold=128)
+                single = remap_pattern(image, palette, dither=dither_mode, alpha_threshold=128)
+                self.assertEqual(mural.board_size, 6)
+                np.testing.assert_array_equal(mural.mask, single.mask)
+                np.testing.assert_array_equal(mural.bead_ids, single.bead_ids)
+                np.testing.assert_array_equal(mural.indices[mural.mask], single.indices[single.mask])
+
+
+class BeadPatternTests(SimpleTestCase):
+    def assert_same_pattern(self, loaded, pattern):
+        np.testing.assert_array_equal(loaded.indices, pattern.indices)
+        self.assertEqual(loaded.indices.dtype, pattern.indices.dtype)
+        np.testing.assert_array_equal(loaded.bead_ids, pattern.bead_ids)
+        np.testing.assert_array_equal(loaded.colors, pattern.colors)
+        self.assertEqual(loaded.board_size, pattern.board_size)
+        if pattern.mask is None:
+            self.assertIsNone(loaded.mask)
+        else:
+            np.testing.assert_array_equal(loaded.mask, pattern.mask)
+
+    def test_save_load_round_trip(self):
+        rng = np.random.default_rng(0)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for size, board_size, masked in ((5, 0, False), (300, 29, True)):
+            with self.subTest(size=size, board_size=board_size, masked=masked):
+                indices = rng.integers(0, size, (40, 70))
+                mask = rng.random(indices.shape) < 0.8 if masked else None
+                pattern = BeadPattern.from_indices(indices, np.arange(size) + 10, rng.integers(0, 256, (size, 3)),
+                                                   board_size, mask)
+                # Paths are used as given, without an added .npz extension
+                path = os.path.join(directory.name, 'pattern-{}'.format(size))
+                pattern.save(path)
+                self.assert_same_pattern(BeadPattern.load(path), pattern)
+
+                buffer = BytesIO()
+                pattern.save(buffer)
+                buffer.seek(0)
+                self.assert_same_pattern(BeadPattern.load(buffer), pattern)
+
+    def test_unsupported_file_is_rejected(self):
+        buffer = BytesIO()
+        np.savez(buffer, indices=np.zeros((2, 2)))
+        buffer.seek(0)
+        with self.assertRaises(ValueError):
+            BeadPattern.load(buffer)
+
+
+class ResultCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.cache = ResultCache(os.path.join(self.directory, 'cache'), max_bytes=150)
+
+    def write_file(self, name, size):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as fout:
+            fout.write(b'x' * size)
+        return path
+
+    def test_key_covers_colors_and_matching(self):
+        beads = make_palette(5)
+        key = ResultCache.make_key('hash', {'width': 32}, beads, 'exact')
+        self.assertEqual(ResultCache.make_key('hash', {'width': 32}, reversed(beads), 'exact'), key)
+        self.assertNotEqual(ResultCache.make_key('hash', {'width': 32}, beads, 'lookup-6'), key)
+        self.assertNotEqual(ResultCache.make_key('hash', {'width': 16}, beads, 'exact'), key)
+        beads[0].red = (beads[0].red + 1) % 256
+        self.assertNotEqual(ResultCache.make_key('hash', {'width': 32}, beads, 'exact'), key)
+
+    def test_put_get_and_evict(self):
+        destination = os.path.join(self.directory, 'copy')
+        self.assertIsNone(self.cache.get('first', destination))
+        self.cache.put('first', self.write_file('first', 100), {'width': 1})
+        self.assertEqual(self.cache.get('first', destination), {'width': 1})
+        with open(destination, 'rb') as fin:
+            self.assertEqual(len(fin.read()), 100)
+
+        # The least recently used entry is evicted once the cache outgrows max_bytes
+        os.utime(os.path.join(self.cache.directory, 'first.json'), (0, 0))
+        self.cache.put('second', self.write_file('second', 100), {'width': 2})
+        self.assertIsNone(self.cache.get('first', destination))
+        self.assertEqual(self.cache.get('second', destination), {'width': 2})
+
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.get('second', destination))
+
+
+class StageCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.src_file = os.path.join(directory.name, 'image.png')
+        make_image(64, 48).save(self.src_file)
+        self.beads = make_palette(4)
+        self.cache = StageCache()
+        patcher = mock.patch('util.pipeline.stage_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_pipeline(self, query):
+        before = self.cache.stats()
+        pattern, _ = create_pattern(self.src_file, parse_process_params(QueryDict(query)), self.beads)
+        after = self.cache.stats()
+        return pattern, (after['hits'] - before['hits'], after['misses'] - before['misses'])
+
+    def test_stages_rerun_from_first_change(self):
+        # decode, preview, resize and remap
+        pattern, counts = self.run_pipeline('width=16&height=12')
+        self.assertEqual(counts, (0, 4))
+        repeat, counts = self.run_pipeline('width=16&height=12')
+        self.assertIs(repeat, pattern)
+        self.assertEqual(counts, (4, 0))
+        self.assertEqual(self.run_pipeline('width=16&height=12&metric=cie76')[1], (3, 1))
+        self.assertEqual(self.run_pipeline('width=8&height=6')[1], (2, 2))
+        self.assertEqual(self.run_pipeline('width=8&height=6&blur=1')[1], (2, 3))
+
+    def test_decoded_images_are_not_cached(self):
+        create_pattern(make_image(64, 48), parse_process_params(QueryDict('width=16&height=12')), self.beads)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_mural_sized_stages_are_not_cached(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        source_file = os.path.join(directory.name, 'original.png')
+        make_image(600, 450).save(source_file)
+        params = parse_process_params(QueryDict('mural=1&width=600&height=450'))
+        pattern, _ = create_pattern(self.src_file, params, self.beads, source_file)
+        self.assertEqual(pattern.width, 600)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_eviction(self):
+        cache = StageCache(max_bytes=2000)
+        for key in ('a', 'b', 'c'):
+            cache.get_or_compute(key, 'test', lambda: Image.new('L', (40, 20)))
+        # Too large to cache at all
+        cache.get_or_compute('d', 'test', lambda: Image.new('L', (200, 20)))
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 4, 'evictions': 1, 'entries': 2, 'bytes': 1600})
+        compute = mock.Mock(return_value=Image.new('L', (40, 20)))
+        cache.get_or_compute('c', 'test', compute)
+        self.assertEqual(compute.call_count, 0)
+        cache.get_or_compute('a', 'test', compute)
+        self.assertEqual(compute.call_count, 1)
+
+
+class PaletteIndexTests(SimpleTestCase):
+    def test_matches_brute_force(self):
+        pixels = np.asarray(make_image(64, 64, seed=1)).reshape(-1, 3)
+        # Grays and blues, where the CIEDE2000 hue and rotation terms change fastest
+        ramp = np.arange(256)[:, np.newaxis]
+        pixels = np.vstack([pixels, np.repeat(ramp, 3, axis=1), np.hstack([ramp * 0, ramp * 0, ramp]),
+                            np.hstack([ramp // 2, ramp * 0, ramp])])
+        for size in (1, 7, 60, 300):
+            palette = colors_to_array(make_palette(size, seed=size))
+            # Duplicate colors must resolve to the earliest entry
+            palette = np.vstack([palette, palette[:3]])
+            for metric in METRICS:
+                with self.subTest(size=size, metric=metric):
+                    np.testing.assert_array_equal(PaletteIndex(palette, metric).nearest(pixels),
+                                                  nearest_color_indices(pixels, palette, metric))
+
+    def test_quantized_table_matches_brute_force(self):
+        palette = colors_to_array(make_palette(40, seed=2))
+        levels = (np.arange(16) << 4) + 8
+        centers = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+        for metric in METRICS:
+            with self.subTest(metric=metric):
+                np.testing.assert_array_equal(PaletteIndex(palette, metric).quantized_table(4),
+                                              nearest_color_indices(centers, palette, metric))
+
+    def test_cache_rebuilds_edited_beads(self):
+        palette_index_cache.clear()
+        beads = make_palette(5)
+        _, first = palette_index_cache.get(beads)
+        self.assertIs(palette_index_cache.get(reversed(beads))[1], first)
+        beads[0].red = (beads[0].red + 1) % 256
+        self.assertIsNot(palette_index_cache.get(beads)[1], first)
+
+    def test_cache_charges_quantized_tables(self):
+        cache = PaletteIndexCache(max_entries=1)
+        _, first = cache.get(make_palette(5))
+        table = cache.quantized_table(first, 4)
+        self.assertIs(cache.quantized_table(first, 4), table)
+        self.assertEqual(cache.stats()['bytes'], first.nbytes + table.nbytes)
+        # Evicting the index releases its table too
+        _, second = cache.get(make_palette(6))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['bytes'], second.nbytes)
+        self.assertIsNot(cache.quantized_table(first, 4), table)
+        self.assertEqual(cache.stats()['bytes'], second.nbytes)
+
+    def test_cache_builds_each_table_once(self):
+        cache = PaletteIndexCache()
+        _, index = cache.get(make_palette(20), CIEDE2000)
+        with mock.patch.object(index, 'quantized_table', wraps=index.quantized_table) as build, \
+                ThreadPoolExecutor(4) as pool:
+            tables = list(pool.map(lambda _: cache.quantized_table(index, 5), range(8)))
+        self.assertEqual(build.call_count, 1)
+        self.assertTrue(all(table is tables[0] for table in tables))
+
+
+class LookupTableTests(TestCase):
+    bits = 4
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch('util.lookup.LOOKUP_DIR', directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        brand = BeadBrand.objects.create(name='Brand')
+        for bead in make_palette(12):
+            BeadColor.objects.create(brand=brand, name=bead.name, red=bead.red, green=bead.green, blue=bead.blue)
+        ColorLookupTable.build(ALL_BRANDS, palette_beads(ALL_BRANDS), self.bits).save()
+
+    def assert_up_to_date(self):
+        beads = list(palette_beads(ALL_BRANDS))
+        table = find_table(beads, self.bits)
+        self.assertIsNotNone(table)
+        expected = ColorLookupTable.build(ALL_BRANDS, beads, self.bits)
+        np.testing.assert_array_equal(np.array(table.bead_ids)[table.table],
+                                      np.array(expected.bead_ids)[expected.table])
+
+    def test_rolled_back_edit_is_not_applied(self):
+        bead = BeadColor.objects.first()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                bead.red, bead.green, bead.blue = 10, 200, 30
+                bead.save()
+                raise RuntimeError()
+        self.assertEqual(callbacks, [])
+        self.assert_up_to_date()
+
+    def test_edit_add_and_delete_are_applied(self):
+        version = tables_version(self.bits)
+        bead = BeadColor.objects.first()
+        bead.red, bead.green, bead.blue = 10, 200, 30
+        bead.save()
+        # A table that has not caught up is never used
+        self.assertIsNone(find_table(palette_beads(ALL_BRANDS), self.bits))
+
+        BeadColor.objects.create(brand=bead.brand, name='New', red=250, green=250, blue=5)
+        BeadColor.objects.last().delete()
+        BeadColor.objects.order_by('id')[3].delete()
+        refresh_tables()
+        self.assert_up_to_date()
+        # Results cached with the previous tables are not reused
+        self.assertNotEqual(tables_version(self.bits), version)
+
+
+class PaletteRegistryTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.version_file = os.path.join(directory.name, 'palette.version')
+        patcher = mock.patch.object(palette_registry, 'version_file', self.version_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        palette_registry._snapshot = None
+        self.addCleanup(setattr, palette_registry, '_snapshot', None)
+
+        self.brand = BeadBrand.objects.create(name='Brand')
+        self.bead = BeadColor.objects.create(brand=self.brand, name='Red', red=200, green=10, blue=10)
+
+    def test_snapshot_is_reused_until_invalidated(self):
+        snapshot = palette_registry.snapshot()
+        with self.assertNumQueries(0):
+            self.assertIs(palette_registry.snapshot(), snapshot)
+        palette_registry.invalidate()
+        self.assertIsNot(palette_registry.snapshot(), snapshot)
+
+    def test_committed_edit_reloads_every_process(self):
+        # A second registry on the same version file stands in for another process
+        other = PaletteRegistry(self.version_file)
+        self.assertEqual(other.snapshot().get(self.bead.id).red, 200)
+        palette_registry.snapshot()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bead.red = 100
+            self.bead.save()
+            BeadColor.objects.create(brand=self.brand, name='Blue', red=10, green=10, blue=200)
+        for registry in (palette_registry, other):
+            snapshot = registry.snapshot()
+            self.assertEqual(snapshot.get(self.bead.id).red, 100)
+            self.assertEqual([bead.name for bead in snapshot.color_groups['Brand']], ['Red', 'Blue'])
+
+    def test_rolled_back_edit_keeps_snapshot(self):
+        snapshot = palette_registry.snapshot()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.bead.delete()
+                raise RuntimeError()
+        self.assertEqual(callbacks, [])
+        self.assertIs(palette_registry.snapshot(), snapshot)
+
+    def test_cached_results_are_dropped_on_commit(self):
+        with mock.patch('core.signals.result_cache') as cache:
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(RuntimeError), transaction.atomic():
+                    self.bead.delete()
+                    raise RuntimeError()
+                self.bead.red = 100
+                self.bead.save()
+                cache.invalidate.assert_not_called()
+        cache.invalidate.assert_called_once_with()
+
+
+class InstrumentationTests(SimpleTestCase):
+    def setUp(self):
+        registry.clear()
+        self.addCleanup(registry.clear)
+
+        @instrumented('test')
+        def view(request):
+            with stage('work'):
+                count('cells', 3)
+            return HttpResponse()
+        self.view = view
+
+    def test_records_stages_and_counters(self):
+        with mock.patch('util.instrument.INSTRUMENTATION', True):
+            response = self.view(RequestFactory().get('/'))
+        self.assertRegex(response['Server-Timing'], r'^work;dur=[0-9.]+, total;dur=[0-9.]+$')
+        metrics = registry.render()
+        self.assertIn('pixel_request_seconds_count{view="test"} 1', metrics)
+        self.assertIn('pixel_stage_seconds_count{stage="work"} 1', metrics)
+        self.assertIn('pixel_cells_total 3', metrics)
+
+    def test_disabled(self):
+        with mock.patch('util.instrument.INSTRUMENTATION', False):
+            response = self.view(RequestFactory().get('/'))
+        self.assertNotIn('Server-Timing', response)
+        self.assertNotIn('view="test"', registry.render())
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        brand = BeadBrand(id=1, name='Brand')
+        beads = [BeadColor(id=10, brand=brand, name='Red', red=200, green=0, blue=0),
+                 BeadColor(id=20, brand=brand, name='Green', red=0, green=200, blue=0)]
+        self.palette = PaletteSnapshot(1, (0, 0), [brand], beads)
+        # Bead 30 is not in the palette, so it is named by its color
+        self.pattern = BeadPattern(np.array([[0, 0, 1, 2], [1, 1, 1, 0], [2, 2, 1, 1]], dtype=np.uint8),
+                                   [10, 20, 30], [(200, 0, 0), (0, 200, 0), (0, 0, 200)], board_size=2,
+                                   mask=np.array([[True, False, True, True], [True] * 4, [True] * 4]))
+        # Codes in order of use, None for the empty cell
+        self.grid = [['2', None, '0', '1'], ['0', '0', '0', '2'], ['1', '1', '0', '0']]
+
+    def export(self, fmt, pattern=None):
+        return b''.join(export_pattern(pattern or self.pattern, fmt, self.palette)).decode('utf-8')
+
+    def test_json(self):
+        data = json.loads(self.export(JSON))
+        self.assertEqual((data['width'], data['height'], data['board_size']), (4, 3, 2))
+        self.assertEqual(data['beads'], [
+            {'code': '0', 'id': 20, 'name': 'Green (Brand)', 'color': '#00c800', 'count': 6},
+            {'code': '1', 'id': 30, 'name': '(0, 0, 200)', 'color': '#0000c8', 'count': 3},
+            {'code': '2', 'id': 10, 'name': 'Red (Brand)', 'color': '#c80000', 'count': 2}])
+        self.assertEqual([[code for (code, length) in row for _ in range(length)] for row in data['rows']], self.grid)
+
+    def test_csv(self):
+        rows = list(csv.reader(StringIO(self.export(CSV))))
+        self.assertEqual(rows[0], ['row', 'column', 'length', 'code', 'bead_id', 'bead_name'])
+        grid = [[None] * 4 for _ in range(3)]
+        for row, column, length, code, bead_id, _ in rows[1:]:
+            for x in range(int(column) - 1, int(column) - 1 + int(length)):
+                grid[int(row) - 1][x] = code
+        self.assertEqual(grid, self.grid)
+        self.assertIn(['1', '3', '1', '0', '20', 'Green (Brand)'], rows)
+
+    def test_svg(self):
+        root = ElementTree.fromstring(self.export(SVG))
+        namespace = '{http://www.w3.org/2000/svg}'
+        grid = [[None] * 4 for _ in range(3)]
+        for rect in root.iter(namespace + 'rect'):
+            x, y, width = (int(rect.get(name)) for name in ('x', 'y', 'width'))
+            for column in range(x, x + width):
+                grid[y][column] = rect.get('class')[1:]
+        self.assertEqual(grid, self.grid)
+        self.assertEqual(len(list(root.iter(namespace + 'path'))), 1)
+
+    def test_too_many_beads_is_rejected_before_streaming(self):
+        size = len(VALID_COLOR_CODES) + 1
+        pattern = BeadPattern(np.arange(size, dtype=np.uint8).reshape(1, -1), np.arange(size) + 1,
+                              np.zeros((size, 3)))
+        for fmt in EXPORT_FORMATS:
+            with self.subTest(fmt=fmt), self.assertRaises(ValueError):
+                export_pattern(pattern, fmt, self.palette)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        pattern_file = os.path.join(directory.name, 'pattern.npz')
+        pattern.save(pattern_file)
+        ImageSession.objects.create(session_key='session', src_file='source.png', pattern_file=pattern_file)
+        for name, params in (('core:export', {'format': CSV}), ('core:download', {})):
+            with self.subTest(view=name):
+                response = self.client.get(reverse(name), dict(params, key='session'))
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('at most', response.json()['error'])
+
+    def test_pdf_color_codes(self):
+        size = len(VALID_COLOR_CODES) + 3
+        # Beads of the pattern palette that no cell uses take no code
+        used = BeadPattern(np.arange(size - 3, dtype=np.uint8).reshape(1, -1), np.arange(size) + 1, np.zeros((size, 3)))
+        buffer = BytesIO()
+        write_pattern_pdf(used, buffer, self.palette, workers=1)
+        self.assertTrue(buffer.getvalue().startswith(b'%PDF'))
+
+        # One bead too many fails before anything is drawn
+        pattern = BeadPattern(np.arange(size - 2, dtype=np.uint8).reshape(1, -1), np.arange(size) + 1,
+                              np.zeros((size, 3)))
+        buffer = BytesIO()
+        with self.assertRaisesRegex(ValueError, 'at most'):
+            write_pattern_pdf(pattern, buffer, self.palette, workers=1)
+        self.assertEqual(buffer.getvalue(), b'')
+
+
+class CountTests(TestCase):
+    def setUp(self):
+        brand = BeadBrand.objects.create(id=1, name='Brand')
+        BeadColor.objects.create(id=10, brand=brand, name='Red', red=200, green=0, blue=0)
+        BeadColor.objects.create(id=20, brand=brand, name='Green', red=0, green=200, blue=0)
+        # Bead 30 is not in the palette; the empty cell is not counted
+        self.pattern = BeadPattern(np.array([[0, 0, 1, 2], [1, 1, 1, 0], [2, 2, 1, 1]], dtype=np.uint8),
+                                   [10, 20, 30], [(200, 0, 0), (0, 200, 0), (0, 0, 200)],
+                                   mask=np.array([[True, False, True, True], [True] * 4, [True] * 4]))
+        self.counts = [[20, 6], [30, 3], [10, 2]]
+
+    def test_summary(self):
+        self.assertEqual(pattern_counts(self.pattern), self.counts)
+        with mock.patch('util.pipeline.BEAD_PRICES', {'Brand': 0.5}):
+            summary = count_summary(self.counts, palette_registry.snapshot())
+        self.assertEqual(summary['total'], 11)
+        self.assertEqual([(bead['name'], bead['brand'], bead['count']) for bead in summary['beads']],
+                         [('Green', 'Brand', 6), (None, None, 3), ('Red', 'Brand', 2)])
+        self.assertEqual(summary['brands'], [{'brand': 'Brand', 'colors': 2, 'count': 8, 'cost': 4.0},
+                                             {'brand': None, 'colors': 1, 'count': 3}])
+        self.assertEqual(summary['cost'], 4.0)
+
+    def test_view(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        pattern_file = os.path.join(directory.name, 'pattern.npz')
+        self.pattern.save(pattern_file)
+        ImageSession.objects.create(session_key='session', src_file='source.png', pattern_file=pattern_file)
+
+        # Counts missing from the session are computed once and kept
+        response = self.client.get(reverse('core:counts'), {'key': 'session'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total'], 11)
+        self.assertEqual(ImageSession.objects.get(pk='session').bead_counts, self.counts)
+
+        response = self.client.get(reverse('core:counts'), {'key': 'session'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get(reverse('core:counts'), {'key': 'missing'}).status_code, 404)
+
+
+class PDFTests(SimpleTestCase):
+    def render(self, workers):
+        codes = ['0', '1', '2', BLANK_CODE]
+        data = [codes[(x // 7 + y) % 4] for y in range(50) for x in range(70)]
+        buffer = BytesIO()
+        PDFGenerator({'0': 'Red', '1': 'Green', '2': 'Blue'}, data, 70).write_pdf(buffer, workers=workers)
+        return PdfReader(BytesIO(buffer.getvalue()))
+
+    @skipIf(PdfReader is None, 'pypdf is not installed')
+    def test_parallel_matches_serial(self):
+        serial = self.render(1)
+        # The cover page, then 3 x 2 grid pages of 30 x 45 beads
+        self.assertEqual(len(serial.pages), 7)
+        with mock.patch('util.pdf.PAGES_PER_WORKER', 1):
+            parallel = self.render(2)
+        self.assertEqual([page.extract_text() for page in parallel.pages],
+                         [page.extract_text() for page in serial.pages])
+
+    @skipIf(PdfReader is None, 'pypdf is not installed')
+    def test_serial_without_pypdf(self):
+        pdf._warn_serial.cache_clear()
+        self.addCleanup(pdf._warn_serial.cache_clear)
+        with mock.patch('util.pdf.PAGES_PER_WORKER', 1), mock.patch('util.pdf.PdfWriter', None), \
+                mock.patch('util.pdf.ProcessPoolExecutor') as pool, self.assertLogs('util.pdf', 'WARNING'):
+            self.assertEqual(len(self.render(2).pages), 7)
+        pool.assert_not_called()
+
+
+class BatchTests(TestCase):
+    def test_item_names(self):
+        self.assertEqual(item_names(['a b.png', 'dir/a b.jpg', '../x?.png'], 1), ['a_b', 'a_b-2', 'x_'])
+        self.assertEqual(item_names(['cat.png', 'cat.png'], 2), ['cat-p1', 'cat-p2', 'cat-p1-2', 'cat-p2-2'])
+
+    def test_convert_and_write_results(self):
+        palette = PaletteSnapshot(1, (0, 0), [BeadBrand.objects.create(id=1, name='Brand')], make_palette(3))
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        src_file = os.path.join(directory.name, 'image.png')
+        make_image(24, 16).save(src_file)
+        params = parse_process_params(QueryDict('width=12&height=8'))
+
+        results = [convert(BatchItem('image', src_file, params), palette),
+                   convert(BatchItem('missing', os.path.join(directory.name, 'missing.png'), params), palette)]
+        self.assertIsNone(results[0].error)
+        self.assertTrue(results[0].pdf.startswith(b'%PDF'))
+        self.assertIsNotNone(results[1].error)
+
+        buffer = ChunkBuffer()
+        progress = [(completed, total) for (completed, total, _) in write_results(iter(results), ZipWriter(buffer), 2)]
+        self.assertEqual(progress, [(1, 2), (2, 2)])
+        with zipfile.ZipFile(BytesIO(buffer.drain())) as archive:
+            self.assertEqual(sorted(archive.namelist()), ['image.json', 'image.pdf', 'manifest.json'])
+            manifest = json.loads(archive.read('manifest.json'))
+        self.assertEqual([(entry['name'], entry['error'] is None) for entry in manifest],
+                         [('image', True), ('missing', False)])
+        self.assertEqual(manifest[0]['beads'], 12 * 8)
+
+    def test_shared_batch_is_bounded_and_cancellable(self):
+        executor = FakeExecutor()
+        slots = threading.BoundedSemaphore(2)
+        items = [BatchItem(str(i), 'image.png', {}) for i in range(3)]
+        with mock.patch('util.jobs._get_executor', return_value=executor), \
+                mock.patch('util.batch._batch_slots', slots), ThreadPoolExecutor(1) as thread:
+            results = run_shared_batch(items)
+            first = thread.submit(next, results)
+            deadline = time.monotonic() + 5
+            while len(executor.futures) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            # The third conversion waits for a slot
+            self.assertEqual(len(executor.futures), 2)
+            executor.futures[0].set_result(BatchResult(items[0], None, None, 'error'))
+            self.assertEqual(first.result(timeout=5).item, items[0])
+
+            # A client disconnect cancels what has not started and frees its slots
+            results.close()
+        self.assertTrue(executor.futures[1].cancelled())
+        self.assertEqual(len(executor.futures), 2)
+        self.assertTrue(slots.acquire(blocking=False) and slots.acquire(blocking=False))
+
+    def test_limits(self):
+        self.assertEqual(self.client.post(reverse('core:batch')).status_code, 400)
+        upload = SimpleUploadedFile('image.png', png_bytes(make_image(8, 8)), content_type='image/png')
+        with mock.patch('core.views.MAX_BATCH_ITEMS', 1):
+            response = self.client.post(reverse('core:batch'), {'files': [upload], 'params': ['width=8', 'width=16']})
+        self.assertEqual(response.status_code, 400)
+
+
+class BenchmarkTests(SimpleTestCase):
+    def test_run_and_compare(self):
+        with mock.patch('sys.stderr', StringIO()):
+            results = bench_pipeline.run([32], [300], ['weighted_euclidian'], repeat=1)
+        stages = {result['stage']: result for result in results}
+        self.assertIn('reduce', stages)
+        # More colors than there are codes: the PDF stages run with a capped palette
+        self.assertLessEqual(stages['pdf_canvas']['palette'], len(VALID_COLOR_CODES))
+
+        slower = dict(stages['remap'], seconds=stages['remap']['seconds'] + 1)
+        self.assertEqual(bench_pipeline.compare([slower], results, 0.2, 0.01), [(slower, stages['remap']['seconds'])])
+        self.assertEqual(bench_pipeline.compare(results, results, 0.2, 0.01), [])
+
+
+class LoadTestTests(TestCase):
+    def test_upload_body(self):
+        body, content_type = bench_load._multipart('file', 'image.png', 'image/png', png_bytes(make_image(64, 48)))
+        data = self.client.post(reverse('core:upload'), body, content_type=content_type).json()
+        self.assertIsNone(data['error'])
+        self.addCleanup(ImageSession.objects.get(pk=data['key']).delete)
+
+    def test_summary_and_compare(self):
+        stats = bench_load.Stats()
+        for seconds in (0.1, 0.2, 0.3, 0.4):
+            stats.record('process', seconds, 200, 10)
+        stats.record('process', 0.5, 500, 0, 'HTTP 500')
+        stats.record('upload', 1.0, None, 0, 'OSError: refused')
+        upload, process = stats.summary(elapsed=5.0)
+        self.assertEqual((process['endpoint'], process['requests'], process['errors']), ('process', 5, 1))
+        self.assertEqual((process['throughput'], process['bytes']), (1.0, 40))
+        self.assertEqual(process['statuses'], {'200': 4, '500': 1})
+        self.assertAlmostEqual(process['p50_seconds'], 0.3)
+        self.assertEqual(upload['statuses'], {'exception': 1})
+
+        self.assertEqual(bench_load.compare([process], [process], 0.2), [])
+        slower = dict(process, p95_seconds=process['p95_seconds'] * 2, throughput=0.5, error_rate=0.5)
+        self.assertEqual([regression.split()[1] for regression in bench_load.compare([slower], [process], 0.2)],
+                         ['p95', 'throughput', 'error'])
+
+
+class FakeExecutor:
+    """
+    Executor that never runs its jobs, so that tests complete the futures themselves
+    """
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, *args):
+        future = Future()
+        self.futures.append(future)
+        return future
+
+
+class JobTests(TestCase):
+    def setUp(self):
+        self.executor = FakeExecutor()
+        for patcher in (mock.patch('util.jobs._get_executor', return_value=self.executor),
+                        # The test case's transaction must survive the connection cleanup of finished jobs
+                        mock.patch('util.jobs.close_old_connections')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.session = ImageSession.objects.create(session_key='session', src_file='source.png')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.pattern_file = os.path.join(directory.name, 'pattern.npz')
+        open(self.pattern_file, 'wb').close()
+
+    def test_new_job_supersedes_earlier_one(self):
+        download = jobs.submit_job(self.session, ProcessingJob.DOWNLOAD, {}, ())
+        first = jobs.submit_job(self.session, ProcessingJob.PROCESS, {}, ())
+        second = jobs.submit_job(self.session, ProcessingJob.PROCESS, {}, ())
+
+        statuses = dict(ProcessingJob.objects.values_list('job_id', 'status'))
+        self.assertEqual(statuses, {download.job_id: ProcessingJob.QUEUED, first.job_id: ProcessingJob.CANCELLED,
+                                    second.job_id: ProcessingJob.QUEUED})
+        self.assertTrue(self.executor.futures[1].cancelled())
+        self.assertNotIn(first.job_id, jobs._futures)
+
+    def test_queue_depth_is_enforced(self):
+        other = ImageSession.objects.create(session_key='other', src_file='other.png')
+        with mock.patch('util.jobs.JOB_QUEUE_DEPTH', 1):
+            jobs.submit_job(self.session, ProcessingJob.PROCESS, {}, ())
+            with self.assertRaises(jobs.JobQueueFull):
+                jobs.submit_job(other, ProcessingJob.PROCESS, {}, ())
+            # Resubmitting for the same session replaces the queued job instead
+            jobs.submit_job(self.session, ProcessingJob.PROCESS, {}, ())
+
+    def test_finished_job_is_recorded(self):
+        job = jobs.submit_job(self.session, ProcessingJob.PROCESS, {}, ())
+        result = {'pattern_file': self.pattern_file, 'counts': [[1, 4]]}
+        self.executor.futures[0].set_result(result)
+
+        job.refresh_from_db()
+        self.addCleanup(os.remove, job.result_file)
+        self.assertEqual(job.status, ProcessingJob.DONE)
+        self.assertEqual(jobs.load_result(job), result)
+        self.session.refresh_from_db()
+        self.assertEqual((self.session.pattern_file, self.session.bead_counts), (self.pattern_file, [[1, 4]]))
+        self.assertNotIn(job.job_id, jobs._futures)
+
+    def test_result_of_cancelled_running_job_is_discarded(self):
+        job = jobs.submit_job(self.session, ProcessingJob.PROCESS, {}, ())
+        future = self.executor.futures[0]
+        future.set_running_or_notify_cancel()
+        jobs.cancel_jobs([job.job_id])
+        future.set_result({'pattern_file': self.pattern_file})
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ProcessingJob.CANCELLED)
+        self.assertFalse(os.path.exists(self.pattern_file))
+        self.session.refresh_from_db()
+        self.assertIsNone(self.session.pattern_file)
+
+    def test_result_of_job_cancelled_while_recording_is_discarded(self):
+        job = jobs.submit_job(self.session, ProcessingJob.DOWNLOAD, {}, ())
+        # Cancelled by another web worker, which has no future to cancel
+        ProcessingJob.objects.filter(pk=job.job_id).update(status=ProcessingJob.CANCELLED)
+        self.executor.futures[0].set_result(self.pattern_file)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result_file), (ProcessingJob.CANCELLED, None))
+        self.assertFalse(os.path.exists(self.pattern_file))
+
+    def test_removed_result_is_gone(self):
+        for kind in (ProcessingJob.PROCESS, ProcessingJob.DOWNLOAD):
+            with self.subTest(kind=kind):
+                job = ProcessingJob.objects.create(job_id=kind, session=self.session, kind=kind,
+                                                   status=ProcessingJob.DONE, result_file=self.pattern_file + '.gone')
+                response = self.client.get(reverse('core:job_result'), {'id': job.job_id})
+                self.assertEqual(response.status_code, 410)
+                with self.assertRaises(FileNotFoundError):
+                    jobs.load_result(job)
+
+    def test_failed_job_is_recorded(self):
+        job = jobs.submit_job(self.session, ProcessingJob.PROCESS, {}, ())
+        self.executor.futures[0].set_exception(ValueError('Broken image'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (ProcessingJob.FAILED, 'Broken image'))
+
+
+class PreviewTests(SimpleTestCase):
+    def test_params(self):
+        factory = RequestFactory()
+        self.assertEqual(parse_preview_params(factory.get('/', {'format': 'webp', 'level': '12'}).GET), ('webp', 9))
+        fmt, level = parse_preview_params(factory.get('/', {'format': 'gif', 'level': 'x'}).GET)
+        self.assertEqual(fmt, PNG)
+        self.assertEqual(parse_preview_params(factory.get('/').GET), (fmt, level))
+
+    def test_conditional_response(self):
+        etag = preview_etag('session', 3, 'hash')
+        self.assertEqual(etag, preview_etag('session', 3, 'hash'))
+        self.assertNotEqual(etag, preview_etag('session', 4, 'hash'))
+
+        render = mock.Mock(return_value=make_image(8, 6))
+        factory = RequestFactory()
+        response = create_preview_response(factory.get('/'), etag, render, PNG, 1, immutable=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(Image.open(BytesIO(response.content)).size, (8, 6))
+
+        # The client already has it: nothing is rendered
+        response = create_preview_response(factory.get('/', HTTP_IF_NONE_MATCH=response['ETag']), etag, render, PNG,
+                                           1, immutable=False)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertEqual(render.call_count, 1)
+
+
+class ReaperTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.tmp_dir = directory.name
+
+    def make_file(self, size, age=0):
+        # Named like the files of create_tmp_file
+        path = os.path.join(self.tmp_dir, str(uuid.uuid4()))
+        with open(path, 'wb') as fout:
+            fout.write(b'x' * size)
+        if age > 0:
+            os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def test_expired_sessions_and_orphans_are_removed(self):
+        expired = ImageSession.objects.create(session_key='expired', src_file=self.make_file(10),
+                                              accessed=timezone.now() - timedelta(hours=2))
+        active = ImageSession.objects.create(session_key='active', src_file=self.make_file(10))
+        old_orphan, new_orphan = self.make_file(10, age=7200), self.make_file(10)
+
+        stats = Reaper(self.tmp_dir, ttl=3600, orphan_grace=3600).run()
+        self.assertEqual((stats['sessions_expired'], stats['orphans_removed'], stats['files_removed']), (1, 1, 2))
+        self.assertEqual(list(ImageSession.objects.values_list('session_key', flat=True)), ['active'])
+        self.assertEqual([os.path.exists(fp) for fp in (expired.src_file, active.src_file, old_orphan, new_orphan)],
+                         [False, True, False, True])
+
+    def test_quotas(self):
+        now = timezone.now()
+        ImageSession.objects.create(session_key='older', src_file=self.make_file(100),
+                                    accessed=now - timedelta(minutes=1))
+        newer = ImageSession.objects.create(session_key='newer', src_file=self.make_file(100), accessed=now)
+        job = ProcessingJob.objects.create(job_id='job', session=newer, kind=ProcessingJob.DOWNLOAD,
+                                           status=ProcessingJob.DONE, result_file=self.make_file(50))
+
+        # The job result is dropped to fit the session quota, then the older session to fit the total
+        stats = Reaper(self.tmp_dir, session_max_bytes=120, max_bytes=150).run()
+        self.assertEqual((stats['job_results_removed'], stats['sessions_evicted']), (1, 1))
+        self.assertEqual(list(ImageSession.objects.values_list('session_key', flat=True)), ['newer'])
+        self.assertFalse(os.path.exists(job.result_file))
+        self.assertIsNone(ProcessingJob.objects.get(pk='job').result_file)
+
+
+class WsgiTests(SimpleTestCase):
+    def test_failed_warm_up_starts_cold(self):
+        self.addCleanup(sys.modules.pop, 'pixel.wsgi', None)
+        sys.modules.pop('pixel.wsgi', None)
+        with mock.patch('util.warmup.WARMUP', True), \
+                mock.patch('util.warmup.warm_up', side_effect=OperationalError('no such table')) as warm_up, \
+                mock.patch('util.reaper.start_reaper'), self.assertLogs('pixel.wsgi', 'ERROR'):
+            wsgi = importlib.import_module('pixel.wsgi')
+        warm_up.assert_called_once_with()
+        self.assertIsNotNone(wsgi.application)
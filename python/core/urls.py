@@ -8,5 +8,15 @@ urlpatterns = [
     url(r'^$', views.index, name='index'),
     url(r'^upload/$', views.upload, name='upload'),
     url(r'^process/$', views.process, name='process'),
-    url(r'^download/$', views.download, name='download')
+    url(r'^download/$', views.download, name='download'),
+    url(r'^export/$', views.export, name='export'),
+    url(r'^counts/$', views.counts, name='counts'),
+    url(r'^batch/$', views.batch, name='batch'),
+    url(r'^preview/source/$', views.preview_source, name='preview_source'),
+    url(r'^preview/pattern/$', views.preview_pattern, name='preview_pattern'),
+    url(r'^jobs/process/$', views.submit_process, name='submit_process'),
+    url(r'^jobs/download/$', views.submit_download, name='submit_download'),
+    url(r'^jobs/status/$', views.job_status, name='job_status'),
+    url(r'^jobs/result/$', views.job_result, name='job_result'),
+    url(r'^metrics/$', views.metrics, name='metrics')
 ]
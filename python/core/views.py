@@ -1,17 +1,37 @@
+import json
 import os
-from base64 import b64encode
-from io import BytesIO
+import tempfile
 
-from PIL import Image, ImageFilter
-from django.http import HttpResponse, HttpRequest, JsonResponse, Http404
+from django.conf import settings
+from django.http import HttpResponse, HttpRequest, JsonResponse, Http404, QueryDict, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import urlencode
+from django.views.decorators.http import require_POST
 
-from core.models import BeadColor, ImageSession, BeadBrand
-from pixel.settings import PDF_TEXT
+from core.models import ImageSession, ProcessingJob
+from util.batch import BatchItem, ChunkBuffer, ZipWriter, item_names, run_shared_batch, write_results
+from util.color import METRIC_LABELS
+from util.dither import DITHER_LABELS
+from util.export import EXPORT_CONTENT_TYPES, EXPORT_FORMATS, JSON, export_pattern
 from util.general import generate_session_key, create_tmp_file
-from util.http import create_file_response
-from util.image import downsample, remap, upsample, preserve_aspect_ratio
-from util.pdf import VALID_COLOR_CODES, PDFGenerator
+from util.image import create_working_copy, pattern_to_image, preserve_aspect_ratio
+from util.http import create_stream_response
+from util.instrument import INSTRUMENTATION, instrumented, registry, stage
+from util.jobs import JOB_RETRY_AFTER, JobQueueFull, load_result, open_result, submit_job, wait_for_job
+from util.mural import MAX_MURAL_SIZE, MURAL_BOARD_SIZE
+from util.palette import palette_registry
+from util.pattern import BeadPattern
+from util.pipeline import count_summary, generate_pattern_pdf, parse_process_params, pattern_counts, prepare_source, \
+    process_image
+from util.preview import create_preview_response, parse_preview_params, preview_etag
+
+# Longest time a status request may wait for a job to finish
+MAX_JOB_WAIT = 30
+MAX_UPLOAD_BYTES = getattr(settings, 'MAX_UPLOAD_BYTES', 20 * 1024 * 1024)
+# Most conversions (images x parameter sets) in one batch request
+MAX_BATCH_ITEMS = getattr(settings, 'MAX_BATCH_ITEMS', 100)
 
 
 def index(request: HttpRequest) -> HttpResponse:
@@ -21,22 +41,39 @@ def index(request: HttpRequest) -> HttpResponse:
     return render(request, 'core/index.html')
 
 
+@instrumented('upload')
 def upload(request: HttpRequest) -> JsonResponse:
     """
     Handles file upload and returns a unique session key
     """
     error = None
+    tmp_files = []
     try:
         file = request.FILES.get('file')
         key = generate_session_key()
-        tmp_file = create_tmp_file(file)
-        ImageSession.objects.create(session_key=key, src_file=tmp_file)
+        with stage('store_upload'):
+            tmp_file, src_hash = create_tmp_file(file, return_digest=True, max_bytes=MAX_UPLOAD_BYTES)
+        tmp_files.append(tmp_file)
+
+        # Decode the upload once, into the working copy used by every later request
+        with stage('decode'):
+            working_copy = create_working_copy(tmp_file)
+        working_file = create_tmp_file()
+        tmp_files.append(working_file)
+        with stage('save'):
+            working_copy.save(working_file, 'png')
+
+        ImageSession.objects.create(session_key=key, src_file=tmp_file, src_hash=src_hash, working_file=working_file)
     except Exception as e:
+        for fp in tmp_files:
+            if os.path.isfile(fp):
+                os.remove(fp)
         error = str(e)
         key = None
     return JsonResponse({'error': error, 'key': key})
 
 
+@instrumented('process')
 def process(request: HttpRequest) -> HttpResponse:
     """
     Processes the image with the given parameters
@@ -46,95 +83,305 @@ def process(request: HttpRequest) -> HttpResponse:
     key = request.GET.get('key', None)
     image_session = get_object_or_404(ImageSession, pk=key)
 
-    # Load the image from disk
-    image = Image.open(image_session.src_file)
-
-    # Downsample the image to a reasonable size for previews
-    src_image = downsample(image, 512, 512)
-
-    # Extract processing parameters from POST data
-    dest_width = int(request.POST.get('width', 64))
-    dest_height = int(request.POST.get('height', 64))
-    dest_width, dest_height = preserve_aspect_ratio(image.width, image.height, dest_width, dest_height)
-    blur = request.POST.get('blur', '0') == '1'
-    sharpen = request.POST.get('sharpen', '0') == '1'
-    selected_colors = list(
-        map(int, request.POST.getlist('colors', BeadColor.objects.all().values_list('id', flat=True))))
-    if len(selected_colors) > 0:
-        available_colors = BeadColor.objects.filter(id__in=selected_colors)
-    else:
-        available_colors = BeadColor.objects.all()
-
-    # Apply filters if applicable
-    if blur:
-        src_image = src_image.filter(ImageFilter.BLUR)
-    elif sharpen:
-        src_image = src_image.filter(ImageFilter.SHARPEN)
-
-    # Convert src image to base64
-    with BytesIO() as buffer:
-        src_image.save(buffer, 'png')
-        src_data = b64encode(buffer.getvalue())
-
-    # Perform the image -> sprite process:
-    # 1) Downsample to the desired size (1 px per bead)
-    # 2) Remap the colors to the available bead colors
-    # 3) Upsample to a reasonable viewing size
-    px_image = downsample(src_image, dest_width, dest_height)
-    remapped_image = remap(px_image, available_colors)
-    px_image = upsample(remapped_image, 512, 512)
-
-    # Convert image data to base64 for page display
-    with BytesIO() as buffer:
-        px_image.save(buffer, 'png')
-        px_data = b64encode(buffer.getvalue())
-
-    # Save remapped image for possible download
-    processed_file = create_tmp_file()
-    remapped_image.save(processed_file, 'png')
-    image_session.processed_file = processed_file
-    image_session.save()
-
-    color_groups = {brand.name: list(BeadColor.objects.filter(brand=brand)) for brand in BeadBrand.objects.all()}
-
-    return render(request, 'core/process.html', {
-        'src': src_data,
-        'px': px_data,
-        'width': dest_width,
-        'height': dest_height,
-        'blur': 1 if blur else 0,
-        'sharpen': 1 if sharpen else 0,
-        'color_groups': color_groups,
-        'selected_colors': selected_colors,
-        'aspect_ratio': image.width / image.height
-    })
+    # Extract processing parameters from POST data and run the pipeline
+    params = parse_process_params(request.POST)
+    result = process_image(image_session.image_file, params, image_session.src_hash, image_session.src_file)
+
+    # Save the pattern for possible download
+    image_session.set_pattern_file(result['pattern_file'], result.get('counts'))
+
+    return _render_process(request, image_session, params, result)
+
+
+def _render_process(request: HttpRequest, image_session: ImageSession, params: dict, result: dict) -> HttpResponse:
+    """
+    Render the process page for a processing result
+    :param request: current request
+    :param image_session: session the result belongs to
+    :param params: parameters from parse_process_params
+    :param result: result of process_image
+    """
+    # Previews are fetched separately so that the browser can cache them; the sprite is one pixel per bead and
+    # scaled up client-side
+    src_url = '{}?{}'.format(reverse('core:preview_source'), urlencode({
+        'key': image_session.session_key, 'blur': int(params['blur']), 'sharpen': int(params['sharpen'])}))
+    px_url = '{}?{}'.format(reverse('core:preview_pattern'), urlencode({
+        'key': image_session.session_key, 'v': _pattern_version(result['pattern_file'])}))
+    display_width, display_height = preserve_aspect_ratio(result['width'], result['height'], 512, 512)
+
+    with stage('color_groups'):
+        palette = palette_registry.snapshot()
+        color_groups = palette.color_groups
+        selected_colors = params['colors'] or list(palette.ids)
+
+    with stage('render'):
+        return render(request, 'core/process.html', {
+            'src_url': src_url,
+            'px_url': px_url,
+            'display_width': display_width,
+            'display_height': display_height,
+            'width': result['width'],
+            'height': result['height'],
+            'blur': 1 if params['blur'] else 0,
+            'sharpen': 1 if params['sharpen'] else 0,
+            'metric': params['metric'],
+            'metrics': METRIC_LABELS,
+            'dither': params['dither'],
+            'dither_modes': DITHER_LABELS,
+            'mural': 1 if params['mural'] else 0,
+            'board_size': MURAL_BOARD_SIZE,
+            'max_mural_size': MAX_MURAL_SIZE,
+            'color_groups': color_groups,
+            'selected_colors': selected_colors,
+            'num_colors': params['num_colors'],
+            'alpha_threshold': params['alpha_threshold'],
+            'aspect_ratio': result['aspect_ratio']
+        })
+
+
+def _pattern_version(pattern_file: str) -> str:
+    """
+    Version of a pattern for preview URLs. Pattern files are never rewritten, so their path identifies the content.
+    """
+    return preview_etag(pattern_file)[:16]
+
+
+def preview_source(request: HttpRequest) -> HttpResponse:
+    """
+    Returns the (filtered) source image preview as PNG or WebP
+    """
+    image_session = get_object_or_404(ImageSession, pk=request.GET.get('key', None))
+    blur = request.GET.get('blur', '0') == '1'
+    sharpen = request.GET.get('sharpen', '0') == '1'
+    fmt, level = parse_preview_params(request.GET)
+
+    # The source of a session never changes, so the URL always identifies the content
+    etag = preview_etag(image_session.src_hash or image_session.session_key, blur, sharpen, fmt, level)
+    return create_preview_response(request, etag, lambda: prepare_source(image_session.image_file, blur, sharpen)[1],
+                                   fmt, level, immutable=True)
+
+
+def preview_pattern(request: HttpRequest) -> HttpResponse:
+    """
+    Returns the session's current pattern as a PNG or WebP image with one pixel per bead
+    """
+    image_session = get_object_or_404(ImageSession, pk=request.GET.get('key', None))
+    fp = image_session.pattern_file
+    if fp is None or not os.path.isfile(fp):
+        raise Http404
+    fmt, level = parse_preview_params(request.GET)
+
+    version = _pattern_version(fp)
+    etag = preview_etag(version, fmt, level)
+    return create_preview_response(request, etag, lambda: pattern_to_image(BeadPattern.load(fp)), fmt, level,
+                                   immutable=request.GET.get('v') == version, lossless=True)
+
+
+@require_POST
+@instrumented('batch')
+def batch(request: HttpRequest) -> HttpResponse:
+    """
+    Converts every uploaded image ('files') with every parameter set ('params', as query strings; the regular
+    processing fields otherwise) and streams back a zip of bead template PDFs and bead counts, in the order the
+    conversions finish. The archive ends with a manifest listing each conversion and any error.
+    """
+    uploads = request.FILES.getlist('files')
+    queries = request.POST.getlist('params')
+    param_sets = [parse_process_params(QueryDict(query)) for query in queries] or [parse_process_params(request.POST)]
+    if len(uploads) == 0:
+        return JsonResponse({'error': 'No images uploaded'}, status=400)
+    if len(uploads) * len(param_sets) > MAX_BATCH_ITEMS:
+        return JsonResponse({'error': 'At most {} conversions per batch'.format(MAX_BATCH_ITEMS)}, status=400)
+
+    tmp_files = []
+    try:
+        for file in uploads:
+            tmp_files.append(create_tmp_file(file, max_bytes=MAX_UPLOAD_BYTES))
+    except Exception as e:
+        for fp in tmp_files:
+            os.remove(fp)
+        return JsonResponse({'error': str(e)}, status=400)
+
+    names = iter(item_names([file.name for file in uploads], len(param_sets)))
+    items = [BatchItem(next(names), src_file, params) for src_file in tmp_files for params in param_sets]
+
+    def stream():
+        buffer = ChunkBuffer()
+        results = run_shared_batch(items)
+        try:
+            for _ in write_results(results, ZipWriter(buffer), len(items)):
+                yield buffer.drain()
+            yield buffer.drain()
+        finally:
+            # Cancel the conversions that have not started if the client went away
+            results.close()
+            for fp in tmp_files:
+                if os.path.isfile(fp):
+                    os.remove(fp)
+
+    response = StreamingHttpResponse(stream(), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=bead_templates.zip'
+    response['X-Batch-Items'] = len(items)
+    return response
+
+
+@instrumented('counts')
+def counts(request: HttpRequest) -> HttpResponse:
+    """
+    Returns the bead counts of the session's current pattern, with per-brand totals and cost estimates, as JSON.
+    Counts are computed once per pattern and kept with the session.
+    """
+    image_session = get_object_or_404(ImageSession, pk=request.GET.get('key', None))
+    fp = image_session.pattern_file
+    if fp is None or not os.path.isfile(fp):
+        raise Http404
+
+    # Names and prices come from the palette, so the response changes with the palette as well as the pattern
+    palette = palette_registry.snapshot()
+    etag = quote_etag(preview_etag(_pattern_version(fp), palette.stamp))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        bead_counts = image_session.bead_counts
+        if bead_counts is None:
+            # Patterns from before counts were kept with the session
+            with stage('count'):
+                bead_counts = pattern_counts(BeadPattern.load(fp))
+            ImageSession.objects.filter(pk=image_session.pk, pattern_file=fp).update(
+                pattern_counts=json.dumps(bead_counts))
+        response = JsonResponse(count_summary(bead_counts, palette))
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 
+@instrumented('download')
 def download(request: HttpRequest) -> HttpResponse:
     # Extract the session key from the GET params
     session_key = request.GET.get('key', None)
     image_session = get_object_or_404(ImageSession, pk=session_key)
+    image_session.touch()
 
     # Make sure file exists
-    fp = image_session.processed_file
+    fp = image_session.pattern_file
     if fp is None or not os.path.isfile(fp):
         raise Http404
 
-    # Extract the pixel data in row-major order
-    image = Image.open(fp)
-    px_data = [image.getpixel((x, y)) for y in range(image.height) for x in range(image.width)]
+    # Generate the PDF into an anonymous temporary file, which is removed once the response has been sent
+    pdf_file = tempfile.TemporaryFile()
+    try:
+        generate_pattern_pdf(fp, pdf_file, image_session.bead_counts)
+    except ValueError as e:
+        pdf_file.close()
+        return JsonResponse({'error': str(e)}, status=400)
+    pdf_file.seek(0)
 
-    # Create the color code -> color name mapping
-    color_map = {VALID_COLOR_CODES[i]: str(bead_color) for (i, bead_color) in enumerate(BeadColor.objects.all())}
-    inverse_color_map = {v: k for (k, v) in color_map.items()}
+    # Return the file for download
+    return create_stream_response(pdf_file, 'bead_template.pdf', 'application/pdf')
 
-    # Map the pixel data to the bead colors
-    bead_map = {(bead.red, bead.green, bead.blue): inverse_color_map[str(bead)] for bead in BeadColor.objects.all()}
-    px_data = [bead_map[tuple(rgba[:3])] for rgba in px_data]
 
-    # Generate the PDF
-    pdf_gen = PDFGenerator(color_map, px_data, image.width, text=[PDF_TEXT['THANK_YOU'], PDF_TEXT['INSTRUCTIONS']])
-    pdf_bytes = pdf_gen.generate_pdf()
+@instrumented('export')
+def export(request: HttpRequest) -> HttpResponse:
+    """
+    Streams the session's current pattern as run-length encoded JSON or CSV, or as SVG, without building a PDF
+    """
+    image_session = get_object_or_404(ImageSession, pk=request.GET.get('key', None))
+    image_session.touch()
 
-    # Return the file for download
-    return create_file_response(pdf_bytes, 'bead_template.pdf', 'application/pdf')
+    fp = image_session.pattern_file
+    if fp is None or not os.path.isfile(fp):
+        raise Http404
+    fmt = request.GET.get('format', JSON)
+    if fmt not in EXPORT_FORMATS:
+        return JsonResponse({'error': 'Unknown export format: {}'.format(fmt)}, status=400)
+
+    with stage('load'):
+        pattern = BeadPattern.load(fp)
+    try:
+        chunks = export_pattern(pattern, fmt)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    response = StreamingHttpResponse(chunks, content_type=EXPORT_CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = 'attachment; filename=bead_pattern.{}'.format(fmt)
+    return response
+
+
+def _submit(image_session: ImageSession, kind: str, params: dict, args: tuple) -> JsonResponse:
+    """
+    Submit a background job and describe it, or ask the client to back off if the queue is saturated
+    """
+    image_session.touch()
+    try:
+        job = submit_job(image_session, kind, params, args)
+    except JobQueueFull:
+        response = JsonResponse({'error': 'Server is busy, please retry', 'job': None}, status=503)
+        response['Retry-After'] = JOB_RETRY_AFTER
+        return response
+    return JsonResponse({'error': None, 'job': job.job_id}, status=202)
+
+
+@require_POST
+def submit_process(request: HttpRequest) -> JsonResponse:
+    """
+    Queues processing of the image with the given parameters and returns a job id
+    """
+    image_session = get_object_or_404(ImageSession, pk=request.GET.get('key', None))
+    params = parse_process_params(request.POST)
+    return _submit(image_session, ProcessingJob.PROCESS, params,
+                   (image_session.image_file, params, image_session.src_hash, image_session.src_file))
+
+
+@require_POST
+def submit_download(request: HttpRequest) -> JsonResponse:
+    """
+    Queues generation of the bead template PDF and returns a job id
+    """
+    image_session = get_object_or_404(ImageSession, pk=request.GET.get('key', None))
+    fp = image_session.pattern_file
+    if fp is None or not os.path.isfile(fp):
+        raise Http404
+    return _submit(image_session, ProcessingJob.DOWNLOAD, {}, (fp, image_session.bead_counts))
+
+
+def job_status(request: HttpRequest) -> JsonResponse:
+    """
+    Returns the status of a job. If 'wait' is given, waits up to that many seconds for the job to finish.
+    """
+    try:
+        wait = min(float(request.GET.get('wait', 0)), MAX_JOB_WAIT)
+        job = wait_for_job(request.GET.get('id', None), wait)
+    except (ValueError, ProcessingJob.DoesNotExist):
+        raise Http404
+    return JsonResponse({'job': job.job_id, 'kind': job.kind, 'status': job.status, 'error': job.error})
+
+
+@instrumented('job_result')
+def job_result(request: HttpRequest) -> HttpResponse:
+    """
+    Returns the result of a finished job: the process page or the PDF download
+    """
+    job = get_object_or_404(ProcessingJob, pk=request.GET.get('id', None))
+    if job.status != ProcessingJob.DONE:
+        return JsonResponse({'job': job.job_id, 'status': job.status, 'error': job.error}, status=409)
+
+    try:
+        if job.kind == ProcessingJob.PROCESS:
+            result = load_result(job)
+        else:
+            fin = open_result(job)
+    except FileNotFoundError:
+        return JsonResponse({'job': job.job_id, 'status': job.status, 'error': 'The result of this job has expired'},
+                            status=410)
+
+    if job.kind == ProcessingJob.PROCESS:
+        return _render_process(request, job.session, json.loads(job.params), result)
+
+    return create_stream_response(fin, 'bead_template.pdf', 'application/pdf')
+
+
+def metrics(request: HttpRequest) -> HttpResponse:
+    """
+    Timers and counters of this worker process in the Prometheus text format
+    """
+    if not INSTRUMENTATION:
+        raise Http404
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,13 @@
+"""
+Settings for the test suite:
+
+    python manage.py test --settings=pixel.test_settings
+"""
+import tempfile
+
+from pixel.settings import *  # noqa: F401,F403
+
+# The core app has no migrations, so its tables are created directly in the test database
+MIGRATION_MODULES = {'core': None}
+# Keep session files, caches and lookup tables out of the real TMP_DIR
+TMP_DIR = tempfile.mkdtemp(prefix='pixel-test-')
@@ -1,7 +1,24 @@
+import logging
 import os
 
 from django.core.wsgi import get_wsgi_application
+from django.db import connections
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pixel.settings")
 
 application = get_wsgi_application()
+
+# Preload the views, palette and color matching tables before the server forks its workers (unless WARMUP is off)
+from util.warmup import WARMUP, warm_up  # noqa: E402
+if WARMUP:
+    try:
+        warm_up()
+    except Exception:
+        # E.g. the database is not reachable yet: serve anyway, the workers then warm up on their first requests
+        logging.getLogger(__name__).exception('Warm-up failed, starting cold')
+        # Workers must not inherit a connection opened before the failure
+        connections.close_all()
+
+# Periodically clean up expired sessions and temporary files (only if REAPER_INTERVAL is set)
+from util.reaper import start_reaper  # noqa: E402
+start_reaper()
@@ -0,0 +1,232 @@
+import json
+import multiprocessing
+import os
+import re
+import threading
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import BytesIO
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+
+from core.models import BeadBrand, BeadColor
+from util import jobs
+from util.image import create_working_copy
+from util.palette import PaletteSnapshot, palette_registry
+from util.pipeline import count_summary, create_pattern, pattern_counts, write_pattern_pdf
+from util.worker import init_worker
+
+BATCH_WORKERS = getattr(settings, 'BATCH_WORKERS', os.cpu_count() or 1)
+# Conversions of web batches that may be in the shared job pool at once, across all requests of this web worker; the
+# rest of the pool is left to interactive jobs
+BATCH_CONCURRENCY = getattr(settings, 'BATCH_CONCURRENCY', max(1, jobs.JOB_WORKERS // 2))
+
+_batch_slots = threading.BoundedSemaphore(BATCH_CONCURRENCY)
+
+# Palette shared by every conversion in a worker process, sent once when the worker starts
+_palette = None
+
+
+class BatchItem(NamedTuple):
+    """
+    One conversion of a batch: an image with one set of processing parameters
+    """
+    name: str
+    src_file: str
+    params: dict
+
+
+class BatchResult(NamedTuple):
+    """
+    Outcome of a conversion
+    """
+    item: BatchItem
+    pdf: Optional[bytes]
+    counts: Optional[dict]
+    error: Optional[str]
+
+
+def _palette_rows(palette: PaletteSnapshot) -> (list, list):
+    """
+    Plain representation of a palette that can be sent to worker processes
+    """
+    brands = [(brand.id, brand.name) for brand in palette.brands]
+    beads = [(bead.id, bead.brand_id, bead.name, bead.red, bead.green, bead.blue) for bead in palette.beads]
+    return brands, beads
+
+
+def _load_palette(brand_rows: list, bead_rows: list) -> None:
+    """
+    Rebuild the palette in a worker process without touching the database
+    """
+    global _palette
+    brands = {brand_id: BeadBrand(id=brand_id, name=name) for (brand_id, name) in brand_rows}
+    beads = [BeadColor(id=bead_id, brand=brands[brand_id], name=name, red=red, green=green, blue=blue)
+             for (bead_id, brand_id, name, red, green, blue) in bead_rows]
+    _palette = PaletteSnapshot(0, None, brands.values(), beads)
+
+
+def convert(item: BatchItem, palette: PaletteSnapshot = None) -> BatchResult:
+    """
+    Convert one image to a bead template PDF and bead counts
+    :param item: image and parameters
+    :param palette: palette to use (defaults to the worker's palette, or the current palette in job workers)
+    :return: the result; errors are reported rather than raised
+    """
+    palette = palette or _palette or palette_registry.snapshot()
+    try:
+        working_copy = create_working_copy(item.src_file)
+        pattern, _ = create_pattern(working_copy, item.params, palette.select(item.params['colors']), item.src_file)
+        counts = pattern_counts(pattern)
+
+        with BytesIO() as buffer:
+            write_pattern_pdf(pattern, buffer, palette, workers=1, counts=counts)
+            pdf = buffer.getvalue()
+    except Exception as e:
+        return BatchResult(item, None, None, str(e))
+    return BatchResult(item, pdf, count_summary(counts, palette), None)
+
+
+def run_batch(items: List[BatchItem], workers: int = BATCH_WORKERS) -> Iterator[BatchResult]:
+    """
+    Convert images in a pool of worker processes, yielding results as they finish (not in input order). The
+    palette is read once here and shared read-only with the workers.
+    :param items: conversions to run
+    :param workers: number of worker processes
+    :return: iterator of results
+    """
+    if len(items) == 0:
+        return
+    brand_rows, bead_rows = _palette_rows(palette_registry.snapshot())
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(items))),
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=('util.batch._load_palette', brand_rows, bead_rows)) as pool:
+        pending = {pool.submit(convert, item) for item in items}
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def run_shared_batch(items: List[BatchItem]) -> Iterator[BatchResult]:
+    """
+    Convert images for a web request in the shared job worker pool, yielding results as they finish (not in input
+    order). At most BATCH_CONCURRENCY conversions of all requests are submitted at a time, and closing the iterator
+    (e.g. when the client disconnects) cancels the conversions that have not started.
+    :param items: conversions to run
+    :return: iterator of results
+    """
+    executor = jobs._get_executor()
+    queued = list(reversed(items))
+    pending = set()
+    try:
+        while len(queued) > 0 or len(pending) > 0:
+            # Wait for a slot only when none of this batch's conversions are running; otherwise wait for them
+            while len(queued) > 0 and _batch_slots.acquire(blocking=len(pending) == 0):
+                future = executor.submit(convert, queued.pop())
+                future.add_done_callback(lambda _: _batch_slots.release())
+                pending.add(future)
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class ChunkBuffer:
+    """
+    Write-only buffer used to stream a zip archive: whatever has been written is taken out with drain()
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipWriter:
+    """
+    Writes batch results into a zip archive as they arrive. The archive may be an unseekable stream.
+    """
+
+    def __init__(self, output: BinaryIO):
+        self._zip = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+
+    def write(self, name: str, data: bytes) -> None:
+        self._zip.writestr(name, data)
+
+    def close(self) -> None:
+        self._zip.close()
+
+
+class DirectoryWriter:
+    """
+    Writes batch results into a directory as they arrive
+    """
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, name: str, data: bytes) -> None:
+        with open(os.path.join(self._directory, name), 'wb') as fout:
+            fout.write(data)
+
+    def close(self) -> None:
+        pass
+
+
+def write_results(results: Iterator[BatchResult], writer, total: int) -> Iterator[Tuple[int, int, BatchResult]]:
+    """
+    Store each result's PDF and bead counts as it finishes, then a manifest of the whole batch, and close the writer
+    :param results: results from run_batch
+    :param writer: ZipWriter or DirectoryWriter
+    :param total: number of conversions in the batch
+    :return: iterator of (completed, total, result), produced after each result has been written
+    """
+    manifest = []
+    for completed, result in enumerate(results, 1):
+        entry = {'name': result.item.name, 'params': result.item.params, 'error': result.error}
+        if result.error is None:
+            writer.write(result.item.name + '.pdf', result.pdf)
+            writer.write(result.item.name + '.json', json.dumps(result.counts, indent=2).encode('utf-8'))
+            entry['beads'] = result.counts['total']
+        manifest.append(entry)
+        yield completed, total, result
+    writer.write('manifest.json', json.dumps(sorted(manifest, key=lambda e: e['name']), indent=2).encode('utf-8'))
+    writer.close()
+
+
+def item_names(file_names: List[str], num_param_sets: int) -> List[str]:
+    """
+    Unique, filesystem-safe output names for each (image, parameter set) pair, in image-major order
+    :param file_names: source file names
+    :param num_param_sets: number of parameter sets
+    :return: output names without extension
+    """
+    names = []
+    used = set()
+    for file_name in file_names:
+        stem = re.sub(r'[^A-Za-z0-9._-]+', '_', os.path.splitext(os.path.basename(file_name))[0]) or 'image'
+        for i in range(num_param_sets):
+            name = stem if num_param_sets == 1 else '{}-p{}'.format(stem, i + 1)
+            candidate, n = name, 1
+            while candidate in used:
+                n += 1
+                candidate = '{}-{}'.format(name, n)
+            used.add(candidate)
+            names.append(candidate)
+    return names
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from typing import Iterable, Optional
+
+from django.conf import settings
+
+from core.models import BeadColor
+
+RESULT_CACHE_DIR = getattr(settings, 'RESULT_CACHE_DIR', os.path.join(settings.TMP_DIR, 'cache'))
+RESULT_CACHE_MAX_BYTES = getattr(settings, 'RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+
+_PATTERN_SUFFIX = '.npz'
+_META_SUFFIX = '.json'
+
+
+class ResultCache:
+    """
+    Disk-backed, size-bounded LRU cache of processed sprites. Entries are keyed by the hash of the source image,
+    the normalized processing parameters, the colors of the selected beads and the color matching used, so
+    identical requests from any session are served from the cache. Each entry is a bead pattern plus a JSON file
+    of preview data.
+    """
+
+    def __init__(self, directory: str = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        """
+        Constructor
+        :param directory: directory holding the cache entries
+        :param max_bytes: maximum total size of the cache entries
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(src_hash: str, params: dict, beads: Iterable[BeadColor], remap: str = '') -> str:
+        """
+        Build the cache key for a processing request
+        :param src_hash: hex digest of the source image
+        :param params: normalized processing parameters
+        :param beads: bead colors available to the remap
+        :param remap: identity of the color matching used (see util.image.remap_version)
+        :return: hex digest identifying the result
+        """
+        palette = sorted((bead.id, bead.red, bead.green, bead.blue) for bead in beads)
+        payload = json.dumps([src_hash, params, palette, remap], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _paths(self, key: str) -> (str, str):
+        """
+        File paths of an entry
+        :param key: cache key
+        :return: (pattern path, metadata path)
+        """
+        base = os.path.join(self.directory, key)
+        return base + _PATTERN_SUFFIX, base + _META_SUFFIX
+
+    def get(self, key: str, dest_file: str) -> Optional[dict]:
+        """
+        Look up an entry, copying its bead pattern to dest_file
+        :param key: cache key
+        :param dest_file: where to copy the bead pattern
+        :return: the cached metadata, or None on a miss
+        """
+        pattern_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as fin:
+                meta = json.load(fin)
+            shutil.copyfile(pattern_path, dest_file)
+            # Refresh the access time used for LRU eviction
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def put(self, key: str, pattern_file: str, meta: dict) -> None:
+        """
+        Add an entry, evicting the least recently used entries if the cache grows too large
+        :param key: cache key
+        :param pattern_file: bead pattern to copy into the cache
+        :param meta: JSON-serializable metadata
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        pattern_path, meta_path = self._paths(key)
+        # Write to temporary names first so readers never see a partial entry; the metadata is written last
+        suffix = '.{}.tmp'.format(uuid.uuid4())
+        shutil.copyfile(pattern_file, pattern_path + suffix)
+        os.replace(pattern_path + suffix, pattern_path)
+        with open(meta_path + suffix, 'w') as fout:
+            json.dump(meta, fout)
+        os.replace(meta_path + suffix, meta_path)
+        self._evict()
+
+    def _evict(self) -> None:
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        """
+        with self._lock:
+            entries = {}
+            total = 0
+            for entry in os.scandir(self.directory):
+                key, suffix = os.path.splitext(entry.name)
+                if suffix not in (_PATTERN_SUFFIX, _META_SUFFIX):
+                    continue
+                stat = entry.stat()
+                size, last_used = entries.get(key, (0, 0))
+                if suffix == _META_SUFFIX:
+                    last_used = stat.st_mtime
+                entries[key] = (size + stat.st_size, last_used)
+                total += stat.st_size
+
+            for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+                if total <= self.max_bytes:
+                    break
+                self._remove(key)
+                total -= size
+
+    def _remove(self, key: str) -> None:
+        """
+        Remove an entry
+        :param key: cache key
+        """
+        # Metadata first, so that a concurrent reader misses instead of finding a missing pattern
+        for path in reversed(self._paths(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def invalidate(self) -> None:
+        """
+        Remove every entry, e.g. after the bead palette changed
+        """
+        if not os.path.isdir(self.directory):
+            return
+        with self._lock:
+            keys = {os.path.splitext(file_name)[0] for file_name in os.listdir(self.directory)
+                    if os.path.splitext(file_name)[1] in (_PATTERN_SUFFIX, _META_SUFFIX)}
+            for key in keys:
+                self._remove(key)
+
+
+result_cache = ResultCache()
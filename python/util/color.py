@@ -1,5 +1,26 @@
+from functools import lru_cache
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
 from core.models import Color
 
+WEIGHTED_EUCLIDIAN = 'weighted_euclidian'
+CIE76 = 'cie76'
+CIEDE2000 = 'ciede2000'
+METRICS = (WEIGHTED_EUCLIDIAN, CIE76, CIEDE2000)
+METRIC_LABELS = {WEIGHTED_EUCLIDIAN: 'Weighted RGB', CIE76: 'Perceptual (CIE76)', CIEDE2000: 'Perceptual (CIEDE2000)'}
+
+# Number of (pixel, palette color) distances evaluated per batch when matching arrays of colors
+_BATCH_SIZE = 1 << 20
+
+# sRGB -> linear light (scaled to 0-100) for every 8-bit channel value
+_SRGB_LINEAR = np.array([((v / 255 + 0.055) / 1.055) ** 2.4 * 100 if v / 255 > 0.04045 else v / 255 / 12.92 * 100
+                         for v in range(256)])
+_RGB_TO_XYZ = np.array([[0.4124, 0.3576, 0.1805], [0.2126, 0.7152, 0.0722], [0.0193, 0.1192, 0.9505]])
+# Illuminant D65
+_XYZ_WHITE = np.array([95.047, 100, 108.883])
+
 
 def _weighted_euclidian(c1: Color, c2: Color) -> float:
     """
@@ -15,14 +36,139 @@ def _weighted_euclidian(c1: Color, c2: Color) -> float:
     return (2 + r_bar / 256) * dr * dr + 4 * dg * dg + (2 + (255 - r_bar) / 256) * db * db
 
 
-def color_distance(c1: Color, c2: Color) -> float:
+def color_distance(c1: Color, c2: Color, metric: str = WEIGHTED_EUCLIDIAN) -> float:
     """
     Calculate the distance between two colors
     :param c1: color 1
     :param c2: color 2
+    :param metric: one of METRICS
     :return: The distance between the two colors
     """
-    return _weighted_euclidian(c1, c2)
+    if metric == WEIGHTED_EUCLIDIAN:
+        return _weighted_euclidian(c1, c2)
+    elif metric == CIE76:
+        return _cie_delta_e_sq(c1, c2)
+    elif metric == CIEDE2000:
+        return _ciede2000(c1, c2)
+    raise ValueError('Unknown color metric: {}'.format(metric))
+
+
+def _weighted_euclidian_array(pixels: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    """
+    Vectorized form of _weighted_euclidian, evaluated for every (pixel, palette color) pair
+    :param pixels: (N, 3) float array of RGB values
+    :param palette: (M, 3) float array of RGB values
+    :return: (N, M) array of distances
+    """
+    # Mirrors the operation order of _weighted_euclidian so that results are bit-for-bit identical
+    p = pixels[:, np.newaxis, :]
+    c = palette[np.newaxis, :, :]
+    r_bar = (p[..., 0] + c[..., 0]) / 2
+    dr = p[..., 0] - c[..., 0]
+    dg = p[..., 1] - c[..., 1]
+    db = p[..., 2] - c[..., 2]
+    return (2 + r_bar / 256) * dr * dr + 4 * dg * dg + (2 + (255 - r_bar) / 256) * db * db
+
+
+def colors_to_array(colors: Iterable[Color]) -> np.ndarray:
+    """
+    Convert an iterable of colors to an array
+    :param colors: Iterable of Color objects
+    :return: (M, 3) float array of RGB values
+    """
+    return np.array([(color.red, color.green, color.blue) for color in colors], dtype=np.float64).reshape(-1, 3)
+
+
+def unique_colors(pixels: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Find the distinct colors of an array of 8-bit pixels. Images rarely use more than a fraction of the RGB cube,
+    so matching only the distinct colors saves most of the work.
+    :param pixels: (N, 3) array of RGB values
+    :return: ((U, 3) float array of distinct colors, (N,) array of indices into the distinct colors)
+    """
+    packed = np.asarray(pixels).reshape(-1, 3).astype(np.int64) @ np.array([1 << 16, 1 << 8, 1], dtype=np.int64)
+    unique_packed, inverse = np.unique(packed, return_inverse=True)
+    unique_pixels = np.stack([unique_packed >> 16, (unique_packed >> 8) & 0xFF, unique_packed & 0xFF],
+                             axis=1).astype(np.float64)
+    return unique_pixels, inverse.reshape(-1)
+
+
+def nearest_color_indices(pixels: np.ndarray, palette: np.ndarray, metric: str = WEIGHTED_EUCLIDIAN) -> np.ndarray:
+    """
+    Find the nearest palette color for each pixel
+    :param pixels: (N, 3) array of RGB values
+    :param palette: (M, 3) array of RGB values
+    :param metric: one of METRICS
+    :return: (N,) array of indices into the palette; ties resolve to the earliest palette entry
+    """
+    unique_pixels, inverse = unique_colors(pixels)
+    # Convert to the metric's space once rather than per comparison
+    points = to_metric_space(unique_pixels, metric)
+    return nearest_points(points, to_metric_space(palette, metric), metric)[inverse]
+
+
+def match_pixels(nearest: Callable[[np.ndarray], np.ndarray], data: np.ndarray,
+                 mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Match the kept pixels of an image; pixels outside the mask are never looked at
+    :param nearest: function mapping an (N, 3) array of RGB values to palette indices
+    :param data: (H, W, 3) array of 8-bit RGB values
+    :param mask: (H, W) boolean array of the pixels to match, None to match every pixel
+    :return: (H, W) array of palette indices, 0 for pixels outside the mask
+    """
+    if mask is None:
+        return nearest(data.reshape(-1, 3)).reshape(data.shape[:2])
+    indices = np.zeros(data.shape[:2], dtype=np.intp)
+    if mask.any():
+        indices[mask] = nearest(data[mask])
+    return indices
+
+
+def to_metric_space(rgb: np.ndarray, metric: str) -> np.ndarray:
+    """
+    Convert RGB colors to the space a metric's vectorized distance function operates in
+    :param rgb: (N, 3) array of RGB values
+    :param metric: one of METRICS
+    :return: (N, 3) float array of RGB values for the weighted Euclidian metric, CIEL*ab otherwise
+    """
+    rgb = np.asarray(rgb).reshape(-1, 3)
+    if metric == WEIGHTED_EUCLIDIAN:
+        return rgb.astype(np.float64)
+    return rgb_to_lab_array(rgb)
+
+
+def nearest_points(points: np.ndarray, palette: np.ndarray, metric: str) -> np.ndarray:
+    """
+    Brute-force nearest palette entry for points that are already in the metric's space
+    :param points: (N, 3) array of colors (see to_metric_space)
+    :param palette: (M, 3) array of colors (see to_metric_space)
+    :param metric: one of METRICS
+    :return: (N,) array of indices into the palette; ties resolve to the earliest palette entry
+    """
+    if len(palette) == 0:
+        raise ValueError('At least one palette color is required')
+    distance_fn = array_distance_functions(metric)
+    indices = np.empty(len(points), dtype=np.intp)
+    step = max(1, _BATCH_SIZE // len(palette))
+    for start in range(0, len(points), step):
+        distances = distance_fn(points[start:start + step], palette)
+        indices[start:start + step] = np.argmin(distances, axis=1)
+    return indices
+
+
+def array_distance_functions(metric: str):
+    """
+    Get the vectorized distance function for a metric
+    :param metric: one of METRICS
+    :return: function of ((N, 3) array, (M, 3) array) -> (N, M) distances. CIE metrics expect CIEL*ab input.
+    """
+    if metric == WEIGHTED_EUCLIDIAN:
+        return _weighted_euclidian_array
+    elif metric == CIE76:
+        return _cie_delta_e_sq_array
+    elif metric == CIEDE2000:
+        return lambda lab1, lab2: _ciede2000_array(lab1[:, np.newaxis, :], lab2[np.newaxis, :, :])
+    raise ValueError('Unknown color metric: {}'.format(metric))
 
 
 # Recipe borrowed from easyrgb.com
@@ -32,24 +178,7 @@ def _rgb_to_xyz(color: Color) -> (float, float, float):
     :param color: RGB color
     :return: 3-tuple containing XYZ values
     """
-    var_r = color.red / 255
-    var_g = color.green / 255
-    var_b = color.blue / 255
-
-    values = (var_r, var_g, var_b)
-    new_values = []
-
-    for value in values:
-        if value > 0.04045:
-            new_values.append(((value + 0.055) / 1.055) ** 2.4)
-        else:
-            new_values.append(value / 12.92)
-
-    new_values = [val * 100 for val in new_values]
-    coeffs = [[0.4124, 0.3576, 0.1805], [0.2126, 0.7152, 0.0722], [0.0193, 0.1192, 0.9505]]
-    xyz = [sum([val * coeff for val, coeff in zip(new_values, coeffs[i])]) for i in range(3)]
-
-    return tuple(xyz)
+    return tuple(_linearize(np.array([color.red, color.green, color.blue])) @ _RGB_TO_XYZ.T)
 
 
 # Recipe borrowed from easyrgb.com
@@ -59,28 +188,61 @@ def _xyz_to_cielab(xyz: (float, float, float)) -> (float, float, float):
     :param xyz: 3-tuple containing XYZ color
     :return: 3-tuple containing CIEL*ab color
     """
-    # Using Illuminant D65
-    x_norm = 95.047
-    y_norm = 100
-    z_norm = 108.883
+    return tuple(_xyz_to_cielab_array(np.array(xyz)))
+
+
+@lru_cache(maxsize=4096)
+def _cached_lab(red: int, green: int, blue: int) -> (float, float, float):
+    """
+    CIEL*ab value of an RGB color. Palettes are small and reused constantly, so conversions are memoized.
+    :return: 3-tuple containing CIEL*ab color
+    """
+    return tuple(rgb_to_lab_array(np.array([[red, green, blue]]))[0])
+
+
+def color_to_lab(color: Color) -> (float, float, float):
+    """
+    Converts an RGB color to CIEL*ab
+    :param color: RGB color
+    :return: 3-tuple containing CIEL*ab color
+    """
+    return _cached_lab(color.red, color.green, color.blue)
 
-    x, y, z = xyz
-    x /= x_norm
-    y /= y_norm
-    z /= z_norm
 
-    values = (x, y, z)
-    new_values = []
+def _linearize(rgb: np.ndarray) -> np.ndarray:
+    """
+    Convert sRGB channel values to linear light scaled to 0-100
+    :param rgb: array of channel values (0-255)
+    :return: array of linear values
+    """
+    if np.issubdtype(rgb.dtype, np.integer) and rgb.min(initial=0) >= 0 and rgb.max(initial=0) <= 255:
+        return _SRGB_LINEAR[rgb]
+    values = rgb / 255
+    return np.where(values > 0.04045, ((values + 0.055) / 1.055) ** 2.4, values / 12.92) * 100
+
 
-    for value in values:
-        if value > 0.008856:
-            new_values.append(value ** (1 / 3))
-        else:
-            new_values.append(value * 7.787 + 16 / 116)
+def _xyz_to_cielab_array(xyz: np.ndarray) -> np.ndarray:
+    """
+    Converts an array of XYZ colors to CIEL*ab
+    :param xyz: (..., 3) array of XYZ colors
+    :return: (..., 3) array of CIEL*ab colors
+    """
+    values = xyz / _XYZ_WHITE
+    values = np.where(values > 0.008856, np.cbrt(values), values * 7.787 + 16 / 116)
+    x, y, z = values[..., 0], values[..., 1], values[..., 2]
+    return np.stack([116 * y - 16, 500 * (x - y), 200 * (y - z)], axis=-1)
 
-    x, y, z = new_values
 
-    return 116 * y - 16, 500 * (x - y), 200 * (y - z)
+def rgb_to_lab_array(rgb: np.ndarray) -> np.ndarray:
+    """
+    Converts an array of RGB colors to CIEL*ab. 8-bit integer input uses a precomputed linearization table.
+    :param rgb: (..., 3) array of RGB colors
+    :return: (..., 3) float array of CIEL*ab colors
+    """
+    rgb = np.asarray(rgb)
+    if np.issubdtype(rgb.dtype, np.floating) and np.array_equal(rgb, np.round(rgb)):
+        rgb = rgb.astype(np.int64)
+    return _xyz_to_cielab_array(_linearize(rgb) @ _RGB_TO_XYZ.T)
 
 
 # Recipe borrowed from easyrgb.com
@@ -91,7 +253,77 @@ def _cie_delta_e_sq(c1: Color, c2: Color) -> float:
     :param c2: color 2
     :return: The distance between the two colors
     """
-    lab1 = _xyz_to_cielab(_rgb_to_xyz(c1))
-    lab2 = _xyz_to_cielab(_rgb_to_xyz(c2))
+    lab1 = color_to_lab(c1)
+    lab2 = color_to_lab(c2)
 
     return sum((elem1 - elem2) ** 2 for elem1, elem2 in zip(lab1, lab2))
+
+
+def _cie_delta_e_sq_array(lab1: np.ndarray, lab2: np.ndarray) -> np.ndarray:
+    """
+    Vectorized form of _cie_delta_e_sq
+    :param lab1: (N, 3) array of CIEL*ab colors
+    :param lab2: (M, 3) array of CIEL*ab colors
+    :return: (N, M) array of squared distances
+    """
+    diff = lab1[:, np.newaxis, :] - lab2[np.newaxis, :, :]
+    return diff[..., 0] * diff[..., 0] + diff[..., 1] * diff[..., 1] + diff[..., 2] * diff[..., 2]
+
+
+def _ciede2000(c1: Color, c2: Color) -> float:
+    """
+    Calculate the distance between two colors using the CIEDE2000 metric
+    :param c1: color 1
+    :param c2: color 2
+    :return: The distance between the two colors
+    """
+    return float(_ciede2000_array(np.array(color_to_lab(c1)), np.array(color_to_lab(c2))))
+
+
+# Formulas from Sharma, Wu and Dalal, "The CIEDE2000 Color-Difference Formula"
+def _ciede2000_array(lab1: np.ndarray, lab2: np.ndarray) -> np.ndarray:
+    """
+    Vectorized CIEDE2000 color difference
+    :param lab1: (..., 3) array of CIEL*ab colors
+    :param lab2: (..., 3) array of CIEL*ab colors, broadcastable against lab1
+    :return: array of distances with the broadcast shape
+    """
+    l1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    l2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    c_bar = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+    c_bar7 = c_bar ** 7
+    g = 0.5 * (1 - np.sqrt(c_bar7 / (c_bar7 + 25 ** 7)))
+    a1p = (1 + g) * a1
+    a2p = (1 + g) * a2
+    c1p = np.hypot(a1p, b1)
+    c2p = np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+
+    dl = l2 - l1
+    dc = c2p - c1p
+    chroma_zero = c1p * c2p == 0
+    dh = h2p - h1p
+    dh = np.where(dh > 180, dh - 360, np.where(dh < -180, dh + 360, dh))
+    dh = np.where(chroma_zero, 0, dh)
+    dh_big = 2 * np.sqrt(c1p * c2p) * np.sin(np.radians(dh / 2))
+
+    l_bar = (l1 + l2) / 2
+    cp_bar = (c1p + c2p) / 2
+    h_sum = h1p + h2p
+    h_bar = np.where(np.abs(h1p - h2p) > 180, np.where(h_sum < 360, h_sum + 360, h_sum - 360), h_sum) / 2
+    h_bar = np.where(chroma_zero, h_sum, h_bar)
+
+    t = 1 - 0.17 * np.cos(np.radians(h_bar - 30)) + 0.24 * np.cos(np.radians(2 * h_bar)) + \
+        0.32 * np.cos(np.radians(3 * h_bar + 6)) - 0.20 * np.cos(np.radians(4 * h_bar - 63))
+    d_theta = 30 * np.exp(-((h_bar - 275) / 25) ** 2)
+    cp_bar7 = cp_bar ** 7
+    r_c = 2 * np.sqrt(cp_bar7 / (cp_bar7 + 25 ** 7))
+    l_bar_sq = (l_bar - 50) ** 2
+    s_l = 1 + 0.015 * l_bar_sq / np.sqrt(20 + l_bar_sq)
+    s_c = 1 + 0.045 * cp_bar
+    s_h = 1 + 0.015 * cp_bar * t
+    r_t = -np.sin(np.radians(2 * d_theta)) * r_c
+
+    return np.sqrt((dl / s_l) ** 2 + (dc / s_c) ** 2 + (dh_big / s_h) ** 2 + r_t * (dc / s_c) * (dh_big / s_h))
@@ -0,0 +1,541 @@
+import threading
+from collections import OrderedDict
+from typing import Iterable, FrozenSet, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from core.models import BeadColor
+from util.color import CIE76, CIEDE2000, WEIGHTED_EUCLIDIAN, _ciede2000_array, colors_to_array, nearest_points, \
+    to_metric_space, unique_colors
+
+# Cells per axis in the candidate grid
+GRID_SIZE = 16
+CACHE_MAX_BYTES = getattr(settings, 'PALETTE_INDEX_CACHE_BYTES', 32 * 1024 * 1024)
+CACHE_MAX_ENTRIES = getattr(settings, 'PALETTE_INDEX_CACHE_ENTRIES', 256)
+
+# Number of (pixel, candidate) distances evaluated per batch
+_BATCH_SIZE = 1 << 20
+
+# Extent of the CIEL*ab grid, which covers every sRGB color
+_LAB_LO = np.array([-1, -128, -128], dtype=np.float64)
+_LAB_HI = np.array([101, 128, 128], dtype=np.float64)
+
+# Cells per axis of the CIEL*ab grid used to prune CIEDE2000 queries
+_CIEDE2000_GRID_SIZE = 32
+# Colors of lowest bound in a cell that each point is compared with first, to limit the search
+_CIEDE2000_REFERENCES = 4
+
+
+class PaletteIndex:
+    """
+    Nearest-neighbour index over a palette. The metric's color space is divided into a grid, and each grid cell
+    stores the palette colors that could be nearest to some point inside it. Queries only measure distances to the
+    candidates of their cell, and give exactly the same results as a brute-force scan. CIEDE2000 is not a distance
+    over a fixed space, so its candidates are pruned at query time with lower bounds per cell of a CIEL*ab grid.
+    """
+
+    def __init__(self, palette: np.ndarray, metric: str = WEIGHTED_EUCLIDIAN, grid_size: int = GRID_SIZE):
+        """
+        Constructor
+        :param palette: (M, 3) array of RGB values
+        :param metric: one of METRICS
+        :param grid_size: number of cells per axis (must divide 256)
+        """
+        if len(palette) == 0:
+            raise ValueError('At least one palette color is required')
+        self.palette = np.asarray(palette, dtype=np.float64).reshape(-1, 3)
+        self.metric = metric
+        self.grid_size = grid_size
+        # Palette in the metric's space, e.g. CIEL*ab values for the CIE metrics
+        self.points = to_metric_space(self.palette, metric)
+
+        if metric == WEIGHTED_EUCLIDIAN:
+            self._grid_lo = np.zeros(3)
+            self._cell_width = np.full(3, 256 // grid_size, dtype=np.float64)
+            self.candidates = self._build_candidates(self._weighted_euclidian_bounds)
+        elif metric == CIE76:
+            self._grid_lo = _LAB_LO
+            self._cell_width = (_LAB_HI - _LAB_LO) / grid_size
+            self.candidates = self._build_candidates(self._euclidian_bounds)
+        else:
+            self.candidates = None
+            # The hue of a color after CIEDE2000 scales a* by 1 + G, with G in [0, 0.5]
+            a, b = self.points[:, 1], self.points[:, 2]
+            self._hue_arcs = _hue_arcs(np.minimum(a, 1.5 * a), np.maximum(a, 1.5 * a), b, b)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Approximate memory used by the index
+        """
+        return self.palette.nbytes + self.points.nbytes + (0 if self.candidates is None else self.candidates.nbytes)
+
+    def _cell_intervals(self, axis: int) -> (np.ndarray, np.ndarray):
+        """
+        Bounds of the grid cells along one axis
+        :param axis: axis of the metric's space
+        :return: (lower bounds, upper bounds), each of length grid_size
+        """
+        lo = self._grid_lo[axis] + np.arange(self.grid_size) * self._cell_width[axis]
+        if self.metric == WEIGHTED_EUCLIDIAN:
+            # Integer channel values, so the last value in the cell is the upper bound
+            return lo, lo + self._cell_width[axis] - 1
+        return lo, lo + self._cell_width[axis]
+
+    def _axis_bounds(self, axis: int) -> (np.ndarray, np.ndarray):
+        """
+        Squared per-axis distance bounds between each cell interval and each palette point
+        :param axis: axis of the metric's space
+        :return: (minimum, maximum) arrays of shape (grid_size, M)
+        """
+        lo, hi = self._cell_intervals(axis)
+        values = self.points[:, axis][np.newaxis, :]
+        below = lo[:, np.newaxis] - values
+        above = values - hi[:, np.newaxis]
+        nearest = np.maximum(np.maximum(below, above), 0)
+        farthest = np.maximum(np.abs(below), np.abs(above))
+        return nearest * nearest, farthest * farthest
+
+    def _weighted_euclidian_bounds(self) -> (np.ndarray, np.ndarray):
+        """
+        Lower and upper weighted Euclidian distance bounds between every cell and palette color
+        :return: (lower, upper) arrays of shape (r, g, b, M)
+        """
+        (min_r, max_r), (min_g, max_g), (min_b, max_b) = (self._axis_bounds(axis) for axis in range(3))
+
+        # The red and blue weights depend on the mean red value, which is bounded by the cell's red interval
+        lo, hi = self._cell_intervals(0)
+        r_bar_lo = (lo[:, np.newaxis] + self.palette[:, 0]) / 2
+        r_bar_hi = (hi[:, np.newaxis] + self.palette[:, 0]) / 2
+        w_r_lo, w_r_hi = 2 + r_bar_lo / 256, 2 + r_bar_hi / 256
+        w_b_lo, w_b_hi = 2 + (255 - r_bar_hi) / 256, 2 + (255 - r_bar_lo) / 256
+
+        lower = (w_r_lo * min_r)[:, None, None, :] + 4 * min_g[None, :, None, :] + \
+            (w_b_lo[:, None, None, :] * min_b[None, None, :, :])
+        upper = (w_r_hi * max_r)[:, None, None, :] + 4 * max_g[None, :, None, :] + \
+            (w_b_hi[:, None, None, :] * max_b[None, None, :, :])
+        return lower, upper
+
+    def _euclidian_bounds(self) -> (np.ndarray, np.ndarray):
+        """
+        Lower and upper squared Euclidian distance bounds between every cell and palette point
+        :return: (lower, upper) arrays of shape (x, y, z, M)
+        """
+        (min_x, max_x), (min_y, max_y), (min_z, max_z) = (self._axis_bounds(axis) for axis in range(3))
+        lower = min_x[:, None, None, :] + min_y[None, :, None, :] + min_z[None, None, :, :]
+        upper = max_x[:, None, None, :] + max_y[None, :, None, :] + max_z[None, None, :, :]
+        return lower, upper
+
+    def _build_candidates(self, bounds_fn) -> np.ndarray:
+        """
+        Compute the candidate list of every grid cell
+        :param bounds_fn: function returning (lower, upper) distance bounds per cell and palette entry
+        :return: (cells, K) array of palette indices in ascending order, padded with -1
+        """
+        lower, upper = bounds_fn()
+        lower = lower.reshape(self.grid_size ** 3, -1)
+        upper = upper.reshape(self.grid_size ** 3, -1)
+
+        # A color can only be nearest if its lower bound does not exceed the best upper bound in the cell.
+        # The slack guards against rounding so that exact ties are never dropped.
+        best_upper = upper.min(axis=1, keepdims=True)
+        is_candidate = lower <= best_upper * (1 + 1e-9) + 1e-9
+
+        width = int(is_candidate.sum(axis=1).max())
+        candidates = np.full((len(lower), width), -1, dtype=np.int16 if len(self.palette) < 1 << 15 else np.int32)
+        rows, cols = np.nonzero(is_candidate)
+        slots = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        candidates[rows, slots] = cols
+        return candidates
+
+    def nearest(self, pixels: np.ndarray) -> np.ndarray:
+        """
+        Find the nearest palette color for each pixel
+        :param pixels: (N, 3) array of 8-bit RGB values
+        :return: (N,) array of indices into the palette; ties resolve to the earliest palette entry
+        """
+        unique_pixels, inverse = unique_colors(pixels)
+        points = to_metric_space(unique_pixels, self.metric)
+
+        if self.metric == CIEDE2000 and len(self.palette) > _CIEDE2000_REFERENCES:
+            return self._nearest_ciede2000(points)[inverse]
+        if self.candidates is None or self.candidates.shape[1] >= len(self.palette):
+            # The grid cannot prune anything for this metric or palette
+            return nearest_points(points, self.points, self.metric)[inverse]
+
+        cells = np.clip(((points - self._grid_lo) // self._cell_width).astype(np.intp), 0, self.grid_size - 1)
+        cells = (cells[:, 0] * self.grid_size + cells[:, 1]) * self.grid_size + cells[:, 2]
+        distance_fn = _paired_weighted_euclidian if self.metric == WEIGHTED_EUCLIDIAN else _paired_euclidian_sq
+
+        indices = np.empty(len(points), dtype=np.intp)
+        step = max(1, _BATCH_SIZE // self.candidates.shape[1])
+        for start in range(0, len(points), step):
+            batch = points[start:start + step]
+            candidates = self.candidates[cells[start:start + step]]
+            distances = distance_fn(batch, self.points[candidates])
+            distances[candidates < 0] = np.inf
+            # Candidates are stored in palette order, so the first minimum is the earliest palette entry
+            best = np.argmin(distances, axis=1)
+            indices[start:start + step] = candidates[np.arange(len(batch)), best]
+
+        return indices[inverse]
+
+    def _ciede2000_bounds(self, cells: np.ndarray) -> np.ndarray:
+        """
+        Lower bounds of the squared CIEDE2000 distance between the points of CIEL*ab grid cells and the palette.
+        With the weighted lightness, chroma and hue differences x, y and z, the distance is x^2 + y^2 + z^2 + RT*y*z
+        and |RT*y*z| <= |RT| * (y^2 + z^2) / 2. SH never exceeds SC, and the chroma and hue differences together
+        make up the distance in (a', b), which is at least the distance in (a, b). |RT| is bounded through the
+        largest mean chroma and the smallest distance between the mean hue and 275 degrees.
+        :param cells: flat indices of cells of a grid with _CIEDE2000_GRID_SIZE cells per axis
+        :return: (len(cells), M) array of bounds
+        """
+        size = _CIEDE2000_GRID_SIZE
+        lo = _LAB_LO + np.stack([cells // (size * size), cells // size % size, cells % size], axis=1) * \
+            ((_LAB_HI - _LAB_LO) / size)
+        hi = lo + (_LAB_HI - _LAB_LO) / size
+        l, a, b = self.points[:, 0], self.points[:, 1], self.points[:, 2]
+
+        def gap(axis, values):
+            return np.maximum(np.maximum(lo[:, axis, np.newaxis] - values, values - hi[:, axis, np.newaxis]), 0)
+
+        d_l, d_a, d_b = gap(0, l), gap(1, a), gap(2, b)
+        # SL grows with |L_bar - 50|, so it is largest at an end of the cell's interval of mean lightness
+        s_l = np.maximum(_ciede2000_s_l((lo[:, 0, np.newaxis] + l) / 2), _ciede2000_s_l((hi[:, 0, np.newaxis] + l) / 2))
+
+        # Chroma range of the cell
+        a_min = np.where((lo[:, 1] <= 0) & (hi[:, 1] >= 0), 0, np.minimum(np.abs(lo[:, 1]), np.abs(hi[:, 1])))
+        b_min = np.where((lo[:, 2] <= 0) & (hi[:, 2] >= 0), 0, np.minimum(np.abs(lo[:, 2]), np.abs(hi[:, 2])))
+        c_min = np.hypot(a_min, b_min)[:, np.newaxis]
+        c_max = np.hypot(np.maximum(np.abs(lo[:, 1]), np.abs(hi[:, 1])),
+                         np.maximum(np.abs(lo[:, 2]), np.abs(hi[:, 2])))[:, np.newaxis]
+        chroma = np.hypot(a, b)
+        # G decreases with the mean chroma, and C' is at most (1 + G) * C
+        g_max = 0.5 * (1 - _ciede2000_chroma_weight((c_min + chroma) / 2))
+        cp_bar_max = (1 + g_max) * (c_max + chroma) / 2
+
+        # The mean hue lies on the shorter arc between the two hues, within both colors' hue arcs
+        cell_center, cell_half = _hue_arcs(np.minimum(lo[:, 1], 1.5 * lo[:, 1]), np.maximum(hi[:, 1], 1.5 * hi[:, 1]),
+                                           lo[:, 2], hi[:, 2])
+        cell_center, cell_half = cell_center[:, np.newaxis], cell_half[:, np.newaxis]
+        palette_center, palette_half = self._hue_arcs
+        delta = _wrap_degrees(palette_center - cell_center)
+        hue_gap = np.maximum(np.abs(_wrap_degrees(275 - cell_center - delta / 2)) - (cell_half + palette_half) / 2, 0)
+        # Hues half a turn apart or more have no well-defined shorter arc to bound
+        hue_gap = np.where(np.abs(delta) + cell_half + palette_half < 180, hue_gap, 0)
+        d_theta = 30 * np.exp(-(hue_gap / 25) ** 2)
+        r_t = np.sin(np.radians(2 * d_theta)) * 2 * _ciede2000_chroma_weight(cp_bar_max)
+
+        return (d_l / s_l) ** 2 + (1 - r_t / 2) * (d_a * d_a + d_b * d_b) / (1 + 0.045 * cp_bar_max) ** 2
+
+    def _nearest_ciede2000(self, points: np.ndarray) -> np.ndarray:
+        """
+        Exact CIEDE2000 matching. Each point is first compared with the colors of lowest bound in its grid cell; the
+        smallest of those distances limits which colors can still be nearest, and only those are compared exactly.
+        :param points: (N, 3) array of CIEL*ab values
+        :return: (N,) array of indices into the palette; ties resolve to the earliest palette entry
+        """
+        size = _CIEDE2000_GRID_SIZE
+        cells = np.clip(((points - _LAB_LO) // ((_LAB_HI - _LAB_LO) / size)).astype(np.intp), 0, size - 1)
+        occupied, cell_of = np.unique((cells[:, 0] * size + cells[:, 1]) * size + cells[:, 2], return_inverse=True)
+        cell_of = cell_of.reshape(-1)
+        # Points ordered by cell, so that cells are processed in chunks with their points
+        by_cell = np.argsort(cell_of, kind='stable')
+        ends = np.cumsum(np.bincount(cell_of, minlength=len(occupied)))
+
+        indices = np.empty(len(points), dtype=np.intp)
+        step = max(1, _BATCH_SIZE // len(self.palette))
+        for start in range(0, len(occupied), step):
+            stop = min(start + step, len(occupied))
+            members = by_cell[(ends[start - 1] if start > 0 else 0):ends[stop - 1]]
+            bounds = self._ciede2000_bounds(occupied[start:stop])
+            indices[members] = self._nearest_within_bounds(points[members], cell_of[members] - start, bounds)
+        return indices
+
+    def _nearest_within_bounds(self, points: np.ndarray, cells: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+        """
+        Exact CIEDE2000 matching of points against the colors whose bound does not exceed the distance to a reference
+        :param points: (N, 3) array of CIEL*ab values
+        :param cells: (N,) row of each point in bounds
+        :param bounds: (cells, M) lower bounds of the squared distances
+        :return: (N,) array of indices into the palette; ties resolve to the earliest palette entry
+        """
+        references = np.argpartition(bounds, _CIEDE2000_REFERENCES - 1, axis=1)[:, :_CIEDE2000_REFERENCES]
+        limit = _ciede2000_array(points[:, np.newaxis, :], self.points[references[cells]]).min(axis=1)
+        # The slack guards against rounding so that exact ties are never dropped
+        limit = limit * limit * (1 + 1e-9) + 1e-9
+
+        cell_limit = np.zeros(len(bounds))
+        np.maximum.at(cell_limit, cells, limit)
+        bounds = np.where(bounds <= cell_limit[:, np.newaxis], bounds, np.inf)
+        width = int(np.isfinite(bounds).sum(axis=1).max())
+        ranked = np.argsort(bounds, axis=1, kind='stable')[:, :width]
+        ranked_bounds = np.take_along_axis(bounds, ranked, axis=1)
+
+        # Number of leading candidates in each point's cell that could be nearest to the point
+        counts = np.empty(len(points), dtype=np.intp)
+        step = max(1, _BATCH_SIZE // width)
+        for start in range(0, len(points), step):
+            counts[start:start + step] = (ranked_bounds[cells[start:start + step]] <=
+                                          limit[start:start + step, np.newaxis]).sum(axis=1)
+
+        indices = np.empty(len(points), dtype=np.intp)
+        for count in np.unique(counts):
+            group = np.flatnonzero(counts == count)
+            step = max(1, _BATCH_SIZE // count)
+            for start in range(0, len(group), step):
+                batch = group[start:start + step]
+                candidates = ranked[cells[batch], :count]
+                distances = _ciede2000_array(points[batch, np.newaxis, :], self.points[candidates])
+                # Candidates are in order of their bounds, so ties are resolved by palette index
+                best = distances.min(axis=1, keepdims=True)
+                indices[batch] = np.where(distances == best, candidates, len(self.palette)).min(axis=1)
+        return indices
+
+    def quantized_table(self, bits: int) -> np.ndarray:
+        """
+        Nearest palette index for the center of every cell of a quantized RGB cube, for callers that match one pixel
+        at a time. Built on every call: PaletteIndexCache.quantized_table keeps the tables of cached indices.
+        :param bits: bits per channel (1-8)
+        :return: flat array indexed by (r >> (8 - bits)) << 2 * bits | (g >> (8 - bits)) << bits | b >> (8 - bits)
+        """
+        levels = (np.arange(1 << bits) << (8 - bits)) + ((1 << (8 - bits)) >> 1)
+        cube = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+        return self.nearest(cube).astype(np.uint16)
+
+
+def _paired_weighted_euclidian(pixels: np.ndarray, colors: np.ndarray) -> np.ndarray:
+    """
+    Weighted Euclidian distance between each pixel and each of its own candidate colors
+    :param pixels: (N, 3) array of RGB values
+    :param colors: (N, K, 3) array of candidate RGB values
+    :return: (N, K) array of distances
+    """
+    p = pixels[:, np.newaxis, :]
+    r_bar = (p[..., 0] + colors[..., 0]) / 2
+    dr = p[..., 0] - colors[..., 0]
+    dg = p[..., 1] - colors[..., 1]
+    db = p[..., 2] - colors[..., 2]
+    return (2 + r_bar / 256) * dr * dr + 4 * dg * dg + (2 + (255 - r_bar) / 256) * db * db
+
+
+def _paired_euclidian_sq(points: np.ndarray, colors: np.ndarray) -> np.ndarray:
+    """
+    Squared Euclidian distance between each point and each of its own candidate points
+    :param points: (N, 3) array
+    :param colors: (N, K, 3) array of candidates
+    :return: (N, K) array of squared distances
+    """
+    diff = points[:, np.newaxis, :] - colors
+    return diff[..., 0] * diff[..., 0] + diff[..., 1] * diff[..., 1] + diff[..., 2] * diff[..., 2]
+
+
+def _wrap_degrees(angles: np.ndarray) -> np.ndarray:
+    """
+    Wrap angles to [-180, 180)
+    :param angles: array of angles in degrees
+    :return: wrapped angles
+    """
+    return (angles + 180) % 360 - 180
+
+
+def _hue_arcs(a_lo: np.ndarray, a_hi: np.ndarray, b_lo: np.ndarray, b_hi: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Arcs of hue angles covered by rectangles of the (a, b) plane
+    :param a_lo: lower a bounds
+    :param a_hi: upper a bounds
+    :param b_lo: lower b bounds
+    :param b_hi: upper b bounds
+    :return: (center, half width) of each arc in degrees; the half width is 180 if the rectangle contains the origin
+    """
+    center = np.degrees(np.arctan2((b_lo + b_hi) / 2, (a_lo + a_hi) / 2))
+    corners = np.degrees(np.arctan2(np.stack([b_lo, b_hi, b_lo, b_hi], axis=-1),
+                                    np.stack([a_lo, a_lo, a_hi, a_hi], axis=-1)))
+    offsets = _wrap_degrees(corners - center[..., np.newaxis])
+    lo, hi = offsets.min(axis=-1), offsets.max(axis=-1)
+    contains_origin = (a_lo <= 0) & (a_hi >= 0) & (b_lo <= 0) & (b_hi >= 0)
+    return center + (lo + hi) / 2, np.where(contains_origin, 180.0, (hi - lo) / 2)
+
+
+def _ciede2000_chroma_weight(chroma: np.ndarray) -> np.ndarray:
+    """
+    The term sqrt(C^7 / (C^7 + 25^7)) of CIEDE2000, which increases with the chroma
+    :param chroma: array of chroma values
+    :return: array of weights in [0, 1)
+    """
+    chroma7 = chroma ** 7
+    return np.sqrt(chroma7 / (chroma7 + 25 ** 7))
+
+
+def _ciede2000_s_l(l_bar: np.ndarray) -> np.ndarray:
+    """
+    The lightness weighting SL of CIEDE2000
+    :param l_bar: array of mean lightness values
+    :return: array of weights
+    """
+    l_bar_sq = (l_bar - 50) ** 2
+    return 1 + 0.015 * l_bar_sq / np.sqrt(20 + l_bar_sq)
+
+
+class _CacheEntry:
+    """
+    Cached palette index, with the quantized tables built for it and the memory charged for both
+    """
+
+    def __init__(self, key: Tuple[str, FrozenSet[int]], bead_ids: np.ndarray, index: PaletteIndex):
+        """
+        Constructor
+        :param key: cache key
+        :param bead_ids: bead ids in palette order
+        :param index: index over their colors
+        """
+        self.key = key
+        self.bead_ids = bead_ids
+        self.index = index
+        self.tables = {}
+        self.nbytes = index.nbytes
+
+
+class PaletteIndexCache:
+    """
+    Thread-safe LRU cache of palette indices keyed by metric and the selected bead ids, bounded by entry count and
+    memory. The quantized tables of cached indices are kept (and charged) with them.
+    """
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES, max_entries: int = CACHE_MAX_ENTRIES):
+        """
+        Constructor
+        :param max_bytes: maximum total size of the cached indices and their tables
+        :param max_entries: maximum number of cached indices
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # Cached entries by id of their index
+        self._indices = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Held while a table is built, so that threads matching with the same palette (e.g. mural boards) wait for
+        # one build instead of each building it
+        self._table_lock = threading.Lock()
+
+    def get(self, beads: Iterable[BeadColor], metric: str = WEIGHTED_EUCLIDIAN) -> (np.ndarray, PaletteIndex):
+        """
+        Get the index for a selection of beads, building it if it is not cached
+        :param beads: selected bead colors
+        :param metric: one of METRICS
+        :return: (bead ids in palette order, index over their colors)
+        """
+        beads = sorted(beads, key=lambda bead: bead.id)
+        key = (metric, frozenset(bead.id for bead in beads))
+        palette = colors_to_array(beads)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            # Edited beads keep their ids, so the cached colors are checked as well
+            if entry is not None and np.array_equal(entry.index.palette, palette):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.bead_ids, entry.index
+            self.misses += 1
+
+        entry = _CacheEntry(key, np.array([bead.id for bead in beads]), PaletteIndex(palette, metric))
+
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = entry
+            self._indices[id(entry.index)] = entry
+            self._bytes += entry.nbytes
+            self._evict()
+        return entry.bead_ids, entry.index
+
+    def quantized_table(self, index: PaletteIndex, bits: int) -> np.ndarray:
+        """
+        Get the quantized table of an index (see PaletteIndex.quantized_table), building it once per cached index.
+        Tables of indices that are not (or no longer) cached are built on every call.
+        :param index: index from get
+        :param bits: bits per channel
+        :return: the table
+        """
+        table = self._cached_table(index, bits)
+        if table is not None:
+            return table
+        with self._table_lock:
+            table = self._cached_table(index, bits)
+            if table is not None:
+                return table
+            table = index.quantized_table(bits)
+            with self._lock:
+                entry = self._entry(index)
+                if entry is not None:
+                    entry.tables[bits] = table
+                    entry.nbytes += table.nbytes
+                    self._bytes += table.nbytes
+                    self._entries.move_to_end(entry.key)
+                    self._evict()
+        return table
+
+    def clear(self) -> None:
+        """
+        Remove every cached index
+        """
+        with self._lock:
+            self._entries.clear()
+            self._indices.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """
+        Cache counters
+        :return: dict of hits, misses, evictions, entries and bytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self._bytes}
+
+    def _cached_table(self, index: PaletteIndex, bits: int) -> Optional[np.ndarray]:
+        """
+        Look up the table of a cached index
+        :param index: palette index
+        :param bits: bits per channel
+        :return: the table, None if the index is not cached or its table has not been built
+        """
+        with self._lock:
+            entry = self._entry(index)
+            return None if entry is None else entry.tables.get(bits)
+
+    def _entry(self, index: PaletteIndex) -> Optional[_CacheEntry]:
+        """
+        Entry of a cached index (caller must hold the lock)
+        :param index: palette index
+        :return: the entry, None if the index is not cached
+        """
+        entry = self._indices.get(id(index))
+        # Ids are reused once an index is freed
+        return entry if entry is not None and entry.index is index else None
+
+    def _evict(self) -> None:
+        """
+        Evict least recently used entries until the cache fits its bounds (caller must hold the lock)
+        """
+        while len(self._entries) > 1 and (self._bytes > self.max_bytes or len(self._entries) > self.max_entries):
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _discard(self, key: Tuple[str, FrozenSet[int]]) -> None:
+        """
+        Remove an entry (caller must hold the lock)
+        :param key: entry key
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            del self._indices[id(entry.index)]
+            # What was charged, whatever the index has allocated since
+            self._bytes -= entry.nbytes
+
+
+palette_index_cache = PaletteIndexCache()
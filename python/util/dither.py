@@ -0,0 +1,172 @@
+from typing import Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+
+from util.color import match_pixels
+from util.color_index import PaletteIndex, palette_index_cache
+
+NONE = 'none'
+FLOYD_STEINBERG = 'floyd_steinberg'
+ATKINSON = 'atkinson'
+BAYER = 'bayer'
+DITHER_MODES = (NONE, FLOYD_STEINBERG, ATKINSON, BAYER)
+DITHER_LABELS = {NONE: 'None', FLOYD_STEINBERG: 'Floyd-Steinberg', ATKINSON: 'Atkinson', BAYER: 'Ordered (Bayer)'}
+
+# Error diffusion kernels as (row offset, column offset, weight)
+_KERNELS = {
+    FLOYD_STEINBERG: [(0, 1, 7 / 16), (1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16)],
+    ATKINSON: [(0, 1, 1 / 8), (0, 2, 1 / 8), (1, -1, 1 / 8), (1, 0, 1 / 8), (1, 1, 1 / 8), (2, 0, 1 / 8)],
+}
+
+# Bits per channel of the table used to match diffused colors inside the serial loop
+DIFFUSION_TABLE_BITS = 6
+
+
+def dither(data: np.ndarray, index: PaletteIndex, mode: str, mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Match every pixel to the palette while dithering
+    :param data: (H, W, 3) array of 8-bit RGB values
+    :param index: index over the palette
+    :param mode: one of DITHER_MODES
+    :param mask: (H, W) boolean array of the pixels to match, None to match every pixel. Pixels outside the mask
+                 are skipped: they neither receive nor spread error.
+    :return: (H, W) array of indices into the palette, 0 for pixels outside the mask
+    """
+    if mode == NONE:
+        return match_pixels(index.nearest, data, mask)
+    elif mode == BAYER:
+        return _ordered(data, index, mask)
+    elif mode in _KERNELS:
+        return _error_diffusion(data, index, _KERNELS[mode], mask)
+    raise ValueError('Unknown dither mode: {}'.format(mode))
+
+
+def dither_bands(bands: Iterable[Tuple[np.ndarray, Optional[np.ndarray]]], index: PaletteIndex,
+                 mode: str) -> Iterator[np.ndarray]:
+    """
+    Match an image given as consecutive bands of rows while dithering. Error diffused past the bottom of a band is
+    carried into the next one, so the result is the same as dithering the whole image, while only one band of pixel
+    data needs to exist at a time.
+    :param bands: iterable of (data, mask) for each band, top to bottom, as taken by dither
+    :param index: index over the palette
+    :param mode: one of DITHER_MODES
+    :return: iterator of the (rows, W) array of indices into the palette of each band
+    """
+    if mode in _KERNELS:
+        yield from _diffuse_bands(bands, index, _KERNELS[mode])
+        return
+    top = 0
+    for data, mask in bands:
+        yield _ordered(data, index, mask, top=top) if mode == BAYER else dither(data, index, mode, mask)
+        top += len(data)
+
+
+def _bayer_matrix(size: int) -> np.ndarray:
+    """
+    Build a normalized Bayer threshold matrix
+    :param size: matrix size (power of 2)
+    :return: (size, size) array of thresholds in (-0.5, 0.5)
+    """
+    matrix = np.zeros((1, 1))
+    while len(matrix) < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return (matrix + 0.5) / matrix.size - 0.5
+
+
+def _ordered(data: np.ndarray, index: PaletteIndex, mask: Optional[np.ndarray] = None, size: int = 4,
+             top: int = 0) -> np.ndarray:
+    """
+    Ordered (Bayer) dithering, fully vectorized
+    :param data: (H, W, 3) array of 8-bit RGB values
+    :param index: index over the palette
+    :param mask: (H, W) boolean array of the pixels to match, None to match every pixel
+    :param size: Bayer matrix size
+    :param top: row of the image the data starts at, when dithering a band of it
+    :return: (H, W) array of indices into the palette
+    """
+    height, width = data.shape[:2]
+    # Offsets scale with the typical distance between palette colors
+    spread = 255 / max(1, len(index.palette)) ** (1 / 3)
+    offset = top % size
+    thresholds = np.tile(_bayer_matrix(size), (height // size + 2, width // size + 1))[offset:offset + height, :width]
+    shifted = np.clip(data + (thresholds * spread)[..., np.newaxis], 0, 255).round().astype(np.uint8)
+    return match_pixels(index.nearest, shifted, mask)
+
+
+def _error_diffusion(data: np.ndarray, index: PaletteIndex, kernel, mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Error diffusion dithering of a whole image, see _diffuse_bands
+    :param data: (H, W, 3) array of 8-bit RGB values
+    :param index: index over the palette
+    :param kernel: list of (row offset, column offset, weight)
+    :param mask: (H, W) boolean array of the pixels to match, None to match every pixel
+    :return: (H, W) array of indices into the palette
+    """
+    return next(_diffuse_bands([(data, mask)], index, kernel))
+
+
+def _diffuse_bands(bands: Iterable[Tuple[np.ndarray, Optional[np.ndarray]]], index: PaletteIndex,
+                   kernel) -> Iterator[np.ndarray]:
+    """
+    Error diffusion dithering. Rows are streamed one at a time: only the propagation along the current row is
+    serial, and error pushed to the following rows is applied with array operations once the row is finished.
+    :param bands: iterable of (data, mask) for each band of rows, top to bottom, see dither_bands
+    :param index: index over the palette
+    :param kernel: list of (row offset, column offset, weight)
+    :return: iterator of the (rows, W) array of indices into the palette of each band
+    """
+    # Shared with every thread dithering with the same index, and charged to the index cache
+    table = palette_index_cache.quantized_table(index, DIFFUSION_TABLE_BITS).tolist()
+    palette = index.palette.tolist()
+    shift = 8 - DIFFUSION_TABLE_BITS
+    bits = DIFFUSION_TABLE_BITS
+
+    same_row = [(dx, weight) for (dy, dx, weight) in kernel if dy == 0]
+    later_rows = [(dy, dx, weight) for (dy, dx, weight) in kernel if dy > 0]
+    depth = max(dy for (dy, _, _) in kernel) + 1
+    pad = max(abs(dx) for (_, dx, _) in kernel)
+    no_error = (0.0, 0.0, 0.0)
+    carried = None
+
+    for data, mask in bands:
+        height, width = data.shape[:2]
+        if carried is None:
+            # Rolling buffer of error carried into the next rows, across bands, padded so that kernel offsets never
+            # go out of bounds
+            carried = np.zeros((depth, width + 2 * pad, 3))
+        result = np.empty((height, width), dtype=np.intp)
+
+        for y in range(height):
+            row = data[y].astype(np.float64) + carried[0, pad:pad + width]
+            reds, greens, blues = row[:, 0].tolist(), row[:, 1].tolist(), row[:, 2].tolist()
+            indices = [0] * width
+            errors = [no_error] * width
+            kept = [True] * width if mask is None else mask[y].tolist()
+
+            for x in range(width):
+                if not kept[x]:
+                    continue
+                r = min(max(reds[x], 0.0), 255.0)
+                g = min(max(greens[x], 0.0), 255.0)
+                b = min(max(blues[x], 0.0), 255.0)
+                i = table[((int(r) >> shift) << (2 * bits)) | ((int(g) >> shift) << bits) | (int(b) >> shift)]
+                indices[x] = i
+                pr, pg, pb = palette[i]
+                er, eg, eb = r - pr, g - pg, b - pb
+                errors[x] = (er, eg, eb)
+                for dx, weight in same_row:
+                    if x + dx < width:
+                        reds[x + dx] += er * weight
+                        greens[x + dx] += eg * weight
+                        blues[x + dx] += eb * weight
+
+            result[y] = indices
+
+            # Push this row's error down, then advance the buffer
+            errors = np.array(errors)
+            for dy, dx, weight in later_rows:
+                carried[dy, pad + dx:pad + dx + width] += errors * weight
+            carried[:-1] = carried[1:]
+            carried[-1] = 0
+
+        yield result
@@ -0,0 +1,181 @@
+import csv
+import json
+from io import StringIO
+from itertools import repeat
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from util.palette import PaletteSnapshot, palette_registry
+from util.pattern import BeadPattern, assign_color_codes
+from util.pipeline import bead_names
+
+JSON = 'json'
+CSV = 'csv'
+SVG = 'svg'
+EXPORT_FORMATS = (JSON, CSV, SVG)
+EXPORT_CONTENT_TYPES = {JSON: 'application/json', CSV: 'text/csv; charset=utf-8', SVG: 'image/svg+xml'}
+
+# Approximate size of the chunks exports are streamed in
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 64 * 1024)
+# Size, in SVG user units (pixels), of one bead
+SVG_CELL_SIZE = 10
+
+
+def export_pattern(pattern: BeadPattern, fmt: str, palette: PaletteSnapshot = None) -> Iterator[bytes]:
+    """
+    Stream a pattern as run-length encoded JSON or CSV, or as an SVG drawing. Rows are encoded one at a time
+    straight from the bead grid, so memory does not grow with the pattern. Beads get the same color codes as on the
+    PDF template.
+    :param pattern: bead pattern
+    :param fmt: one of EXPORT_FORMATS
+    :param palette: palette to name the beads from (defaults to the current palette)
+    :return: iterator of UTF-8 encoded chunks
+    :raises ValueError: if the format is unknown or the pattern uses more beads than there are color codes; raised
+                        here rather than while streaming, so that the response is not cut short
+    """
+    writers = {JSON: _json_parts, CSV: _csv_parts, SVG: _svg_parts}
+    if fmt not in writers:
+        raise ValueError('Unknown export format: {}'.format(fmt))
+    code_table = _code_table(pattern)
+    # Resolved now rather than on the first chunk, while the request still owns its database connection
+    palette = palette or palette_registry.snapshot()
+    return _buffered(writers[fmt](pattern, palette, code_table))
+
+
+def row_runs(pattern: BeadPattern) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Run-length encode a pattern one row at a time
+    :param pattern: bead pattern
+    :return: iterator over the rows of (start column of each run, run lengths, palette index of each run); runs of
+             empty cells have the index len(pattern.bead_ids)
+    """
+    empty = len(pattern.bead_ids)
+    for y in range(pattern.height):
+        row = pattern.indices[y]
+        if pattern.mask is not None:
+            row = np.where(pattern.mask[y], row, empty)
+        starts = np.flatnonzero(np.concatenate(([True], row[1:] != row[:-1])))
+        yield starts, np.diff(np.append(starts, len(row))), row[starts]
+
+
+def _code_table(pattern: BeadPattern) -> (List[Optional[str]], List[int], np.ndarray):
+    """
+    Color codes of the beads of a pattern
+    :param pattern: bead pattern
+    :return: (code of each palette bead followed by None for empty cells, palette indices of the used beads in code
+             order, number of cells of each palette bead)
+    """
+    counts = pattern.counts()
+    codes = assign_color_codes(dict(enumerate(counts.tolist())))
+    return [codes.get(i) for i in range(len(pattern.bead_ids))] + [None], list(codes), counts
+
+
+def _filled(starts: np.ndarray, lengths: np.ndarray, beads: np.ndarray, empty: int) -> (list, list, list):
+    """
+    Drop the runs of empty cells from a row
+    :return: (start columns, lengths, palette indices) of the remaining runs, as lists
+    """
+    keep = beads != empty
+    return starts[keep].tolist(), lengths[keep].tolist(), beads[keep].tolist()
+
+
+def _json_parts(pattern: BeadPattern, palette: PaletteSnapshot, code_table: tuple) -> Iterator[str]:
+    """
+    JSON export: pattern size, a legend of the beads, then each row as a list of [code, length] runs, with a null
+    code for empty cells
+    """
+    table, order, counts = code_table
+    names = bead_names(pattern, palette)
+    header = {
+        'width': pattern.width,
+        'height': pattern.height,
+        'board_size': pattern.board_size,
+        'beads': [{'code': table[i], 'id': int(pattern.bead_ids[i]), 'name': names[i],
+                   'color': '#{:02x}{:02x}{:02x}'.format(*pattern.colors[i].tolist()), 'count': int(counts[i])}
+                  for i in order],
+    }
+    # Runs are formatted from pre-encoded codes, since a pattern can have as many runs as cells
+    tokens = [json.dumps(code) for code in table]
+    # The rows are streamed inside the header object
+    yield json.dumps(header, separators=(',', ':'))[:-1] + ',"rows":['
+    for y, (_, lengths, beads) in enumerate(row_runs(pattern)):
+        yield ('[' if y == 0 else ',[') + ','.join(map('[{},{}]'.format, map(tokens.__getitem__, beads.tolist()),
+                                                         lengths.tolist())) + ']'
+    yield ']}'
+
+
+def _csv_parts(pattern: BeadPattern, palette: PaletteSnapshot, code_table: tuple) -> Iterator[str]:
+    """
+    CSV export: one line per run of beads (empty cells are left out), with 1-based row and column numbers as on the
+    PDF template
+    """
+    table, order, _ = code_table
+    names = bead_names(pattern, palette)
+    # Code, id and name are the same on every line of a bead, so they are quoted once
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['row', 'column', 'length', 'code', 'bead_id', 'bead_name'])
+    yield buffer.getvalue()
+    suffixes = [None] * len(table)
+    for i in order:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow([table[i], int(pattern.bead_ids[i]), names[i]])
+        suffixes[i] = ',' + buffer.getvalue()
+
+    empty = len(pattern.bead_ids)
+    for y, runs in enumerate(row_runs(pattern)):
+        starts, lengths, beads = _filled(*runs, empty)
+        yield ''.join(map('{},{},{}{}'.format, repeat(y + 1), [start + 1 for start in starts], lengths,
+                          map(suffixes.__getitem__, beads)))
+
+
+def _svg_parts(pattern: BeadPattern, palette: PaletteSnapshot, code_table: tuple) -> Iterator[str]:
+    """
+    SVG export: one rectangle per run of beads, styled by color code, with pegboard outlines for murals. Empty cells
+    are left transparent.
+    """
+    table, order, _ = code_table
+    width, height = pattern.width, pattern.height
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n' \
+          '<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" viewBox="0 0 {} {}" ' \
+          'shape-rendering="crispEdges">\n'.format(width * SVG_CELL_SIZE, height * SVG_CELL_SIZE, width, height)
+    yield '<style>{}</style>\n'.format(''.join(
+        '.c{}{{fill:#{:02x}{:02x}{:02x}}}'.format(table[i], *pattern.colors[i].tolist()) for i in order))
+
+    classes = ['<rect class="c{}" x="'.format(code) for code in table]
+    empty = len(pattern.bead_ids)
+    for y, runs in enumerate(row_runs(pattern)):
+        starts, lengths, beads = _filled(*runs, empty)
+        row_end = '" y="{}" width="'.format(y)
+        yield ''.join(map('{}{}{}{}" height="1"/>\n'.format, map(classes.__getitem__, beads), starts,
+                          repeat(row_end), lengths))
+
+    boards = pattern.boards()
+    if len(boards) > 0:
+        yield '<path fill="none" stroke="#000" stroke-width="0.1" d="{}"/>\n'.format(' '.join(
+            'M{} {}h{}v{}h-{}z'.format(board.left, board.top, board.width, board.height, board.width)
+            for board in boards))
+    yield '</svg>\n'
+
+
+def _buffered(parts: Iterable[str], size: int = EXPORT_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Join small text parts into chunks of about the given size
+    :param parts: text parts
+    :param size: minimum number of characters per chunk (except the last)
+    :return: iterator of UTF-8 encoded chunks
+    """
+    buffer = []
+    buffered = 0
+    for part in parts:
+        buffer.append(part)
+        buffered += len(part)
+        if buffered >= size:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            buffered = 0
+    if len(buffer) > 0:
+        yield ''.join(buffer).encode('utf-8')
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import uuid
 
@@ -5,16 +6,45 @@ from django.core.files.uploadedfile import UploadedFile
 
 from pixel.settings import TMP_DIR
 
+_CHUNK_SIZE = 64 * 1024
+
 
 def generate_session_key():
     return str(uuid.uuid4())
 
 
-def create_tmp_file(buffer=None):
+class UploadTooLarge(ValueError):
+    """
+    Raised when an upload exceeds the allowed size
+    """
+    pass
+
+
+def create_tmp_file(buffer=None, return_digest=False, max_bytes=None):
+    """
+    Create a uniquely named file in TMP_DIR
+    :param buffer: optional file-like object (or uploaded file) whose contents are copied to the new file in chunks
+    :param return_digest: True to also return the SHA-256 hex digest of the contents
+    :param max_bytes: maximum number of bytes to accept from the buffer
+    :return: path of the new file, or (path, digest) if return_digest is True
+    :raises UploadTooLarge: if the buffer holds more than max_bytes (the partial file is removed)
+    """
     file_name = os.path.join(TMP_DIR, str(uuid.uuid4()))
+    digest = hashlib.sha256()
     if buffer is not None:
         if isinstance(buffer, UploadedFile):
             buffer = buffer.file
+        size = 0
         with open(file_name, 'wb') as fout:
-            fout.write(buffer.read())
+            for chunk in iter(lambda: buffer.read(_CHUNK_SIZE), b''):
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    break
+                digest.update(chunk)
+                fout.write(chunk)
+        if max_bytes is not None and size > max_bytes:
+            os.remove(file_name)
+            raise UploadTooLarge('File is larger than the {} byte limit'.format(max_bytes))
+    if return_digest:
+        return file_name, digest.hexdigest()
     return file_name
@@ -1,4 +1,6 @@
-from django.http import HttpResponse
+from typing import BinaryIO
+
+from django.http import HttpResponse, FileResponse
 
 
 def create_file_response(data: bytes, filename: str, content_type: str) -> HttpResponse:
@@ -15,3 +17,16 @@ def create_file_response(data: bytes, filename: str, content_type: str) -> HttpR
     response['Content-Length'] = len(data)
     response.write(data)
     return response
+
+
+def create_stream_response(file: BinaryIO, filename: str, content_type: str) -> FileResponse:
+    """
+    Returns a downloadable http response that streams the provided file
+    :param file: binary file object positioned at the start of the data; closed when the response is closed
+    :param filename: download filename
+    :param content_type: download content type
+    :return: Http response streaming the file for download
+    """
+    response = FileResponse(file, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename={}'.format(filename)
+    return response
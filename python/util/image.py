@@ -1,9 +1,32 @@
-from typing import Iterable
+from types import SimpleNamespace
+from typing import Iterable, Optional
 
+import numpy as np
 from PIL import Image
+from django.conf import settings
 
-from core.models import BeadColor, Color
-from util.color import color_distance
+from core.models import BeadColor
+from util.color import WEIGHTED_EUCLIDIAN, color_distance, match_pixels
+from util.color_index import palette_index_cache
+from util.dither import NONE, dither as dither_indices
+from util.lookup import DEFAULT_BITS as LOOKUP_BITS, find_table, tables_version
+from util.pattern import BeadPattern
+
+REMAP_METHODS = ('lookup', 'vectorized', 'per_pixel')
+# Remap method of the pipeline. 'vectorized' is exact; 'lookup' is faster once tables have been built with the
+# build_color_lookup command, but only exact with 8-bit tables (COLOR_LOOKUP_BITS).
+REMAP_METHOD = getattr(settings, 'REMAP_METHOD', 'vectorized')
+
+# Longest side of the normalized working copy made from each upload
+WORKING_SIZE = 512
+MAX_IMAGE_PIXELS = getattr(settings, 'MAX_IMAGE_PIXELS', 40 * 1000 * 1000)
+
+
+class ImageTooLarge(ValueError):
+    """
+    Raised when an image's decoded size exceeds MAX_IMAGE_PIXELS
+    """
+    pass
 
 
 def downsample(image: Image.Image, width: int, height: int, keep_aspect: bool=True,
@@ -38,32 +61,160 @@ def upsample(image: Image.Image, width: int, height: int, keep_aspect: bool=True
     return image.resize((width, height), sample_filter)
 
 
-def remap(image: Image.Image, allowable_colors: Iterable[BeadColor]) -> Image.Image:
+def create_working_copy(src_file: str, size: int=WORKING_SIZE, max_pixels: int=MAX_IMAGE_PIXELS) -> Image.Image:
+    """
+    Decode an uploaded image into a normalized working copy, checking its size before decoding any pixel data
+    :param src_file: path to the source image
+    :param size: longest side of the working copy
+    :param max_pixels: maximum number of pixels the source image may have
+    :return: RGB (or RGBA, if the source has transparency) image downsampled to fit within size x size
+    :raises ImageTooLarge: if the source image has more than max_pixels pixels
+    """
+    # Opening only reads the header
+    image = Image.open(src_file)
+    if image.width * image.height > max_pixels:
+        raise ImageTooLarge('Image is larger than the {} megapixel limit'.format(max_pixels // (1000 * 1000)))
+
+    # JPEG can decode directly at a reduced scale that is still at least the requested size
+    if image.format == 'JPEG':
+        image.draft('RGB', (size, size))
+
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    return downsample(image, size, size)
+
+
+def remap(image: Image.Image, allowable_colors: Iterable[BeadColor], method: str='vectorized',
+          metric: str=WEIGHTED_EUCLIDIAN, dither: str=NONE, alpha_threshold: int=0) -> Image.Image:
     """
     Remap the colors of the source image to the nearest allowable color
     :param image: Source image
     :param allowable_colors: Iterable of BeadColor objects indicating which colors are allowable
+    :param method: 'lookup' to use a prebuilt lookup table for the palette (falling back to 'vectorized' if none
+                   exists), 'vectorized' to match all pixels in batched array form, 'per_pixel' for the reference loop
+    :param metric: color distance metric, one of util.color.METRICS
+    :param dither: dithering mode, one of util.dither.DITHER_MODES. Dithering always uses the palette index.
+    :param alpha_threshold: see remap_pattern
     :return: New image with remapped colors
     """
-    new_image = image.copy()
+    return pattern_to_image(remap_pattern(image, allowable_colors, method, metric, dither, alpha_threshold), image)
+
+
+def remap_version(method: str = REMAP_METHOD) -> str:
+    """
+    Identify the matching a remap method performs, for cache keys: lookup results depend on the tables built
+    :param method: one of REMAP_METHODS
+    :return: the method, plus the bit depth and version of the saved tables for 'lookup'
+    """
+    if method != 'lookup':
+        return method
+    return 'lookup-{}bit-{}'.format(LOOKUP_BITS, tables_version(LOOKUP_BITS))
+
+
+def alpha_mask(image: Image.Image, alpha_threshold: int) -> Optional[np.ndarray]:
+    """
+    Find the pixels of an image that are opaque enough to be beaded
+    :param image: Source image
+    :param alpha_threshold: minimum alpha (0-255) of a kept pixel; 0 keeps every pixel
+    :return: (H, W) boolean array, True for kept pixels; None if every pixel is kept
+    """
+    if alpha_threshold <= 0 or 'A' not in image.getbands():
+        return None
+    mask = np.asarray(image.getchannel('A')) >= alpha_threshold
+    return None if mask.all() else mask
+
 
-    tmp_color = Color()
-    for y in range(image.height):
-        for x in range(image.width):
-            px = image.getpixel((x, y))
-            tmp_color.red = px[0]
-            tmp_color.green = px[1]
-            tmp_color.blue = px[2]
+def remap_pattern(image: Image.Image, allowable_colors: Iterable[BeadColor], method: str='vectorized',
+                  metric: str=WEIGHTED_EUCLIDIAN, dither: str=NONE, alpha_threshold: int=0) -> BeadPattern:
+    """
+    Match every pixel of the source image to the nearest allowable bead
+    :param image: Source image
+    :param allowable_colors: Iterable of BeadColor objects indicating which colors are allowable
+    :param method: one of REMAP_METHODS, see remap
+    :param metric: color distance metric, one of util.color.METRICS
+    :param dither: dithering mode, one of util.dither.DITHER_MODES
+    :param alpha_threshold: pixels less opaque than this (0-255) are left empty and are not matched; 0 keeps every
+                            pixel
+    :return: Bead pattern with one cell per pixel
+    """
+    data = np.asarray(image.convert('RGB'))
+    mask = alpha_mask(image, alpha_threshold)
+
+    if dither != NONE:
+        bead_ids, index = palette_index_cache.get(allowable_colors, metric)
+        return BeadPattern.from_indices(dither_indices(data, index, dither, mask), bead_ids, index.palette,
+                                        mask=mask)
+    elif method == 'lookup':
+        allowable_colors = list(allowable_colors)
+        # Lookup tables are built with the weighted Euclidian metric
+        table = find_table(allowable_colors) if metric == WEIGHTED_EUCLIDIAN else None
+        if table is not None:
+            return BeadPattern.from_indices(match_pixels(table.lookup, data, mask), table.bead_ids, table.palette,
+                                            mask=mask)
+        return _remap_vectorized(data, allowable_colors, metric, mask)
+    elif method == 'vectorized':
+        return _remap_vectorized(data, allowable_colors, metric, mask)
+    elif method == 'per_pixel':
+        return _remap_per_pixel(data, allowable_colors, metric, mask)
+    raise ValueError('Unknown remap method: {}'.format(method))
+
+
+def _remap_vectorized(data: np.ndarray, allowable_colors: Iterable[BeadColor], metric: str,
+                      mask: Optional[np.ndarray] = None) -> BeadPattern:
+    """
+    Match every pixel against the palette in batched array form, using a cached index for the selected palette
+    :param data: (H, W, 3) array of 8-bit RGB values
+    :param allowable_colors: Iterable of BeadColor objects indicating which colors are allowable
+    :param metric: color distance metric
+    :param mask: (H, W) boolean array of the pixels to match, None to match every pixel
+    :return: Bead pattern
+    """
+    bead_ids, index = palette_index_cache.get(allowable_colors, metric)
+    return BeadPattern.from_indices(match_pixels(index.nearest, data, mask), bead_ids, index.palette, mask=mask)
+
+
+def _remap_per_pixel(data: np.ndarray, allowable_colors: Iterable[BeadColor], metric: str,
+                     mask: Optional[np.ndarray] = None) -> BeadPattern:
+    """
+    Match the pixels one at a time
+    :param data: (H, W, 3) array of 8-bit RGB values
+    :param allowable_colors: Iterable of BeadColor objects indicating which colors are allowable
+    :param metric: color distance metric
+    :param mask: (H, W) boolean array of the pixels to match, None to match every pixel
+    :return: Bead pattern
+    """
+    allowable_colors = list(allowable_colors)
+    indices = np.zeros(data.shape[:2], dtype=np.intp)
+
+    # Color is an abstract model, so pixels are passed to color_distance as plain objects with the same fields
+    tmp_color = SimpleNamespace(red=0, green=0, blue=0)
+    for y in range(data.shape[0]):
+        for x in range(data.shape[1]):
+            if mask is not None and not mask[y, x]:
+                continue
+            tmp_color.red, tmp_color.green, tmp_color.blue = (int(value) for value in data[y, x])
 
             distances = sorted([
-                (color_distance(tmp_color, bead_color), bead_color) for bead_color in allowable_colors],
+                (color_distance(tmp_color, bead_color, metric), i) for (i, bead_color) in enumerate(allowable_colors)],
                 key=lambda tup: tup[0])
-            closest_bead = distances[0][1]
-            closest_color = (closest_bead.red, closest_bead.green, closest_bead.blue)
+            indices[y, x] = distances[0][1]
+
+    return BeadPattern.from_indices(indices, [bead.id for bead in allowable_colors],
+                                    [(bead.red, bead.green, bead.blue) for bead in allowable_colors], mask=mask)
 
-            new_image.putpixel((x, y), closest_color)
 
-    return new_image
+def pattern_to_image(pattern: BeadPattern, source: Image.Image=None) -> Image.Image:
+    """
+    Render a bead pattern at one pixel per bead
+    :param pattern: Bead pattern
+    :param source: Image the pattern was made from; its alpha channel, if any, is kept unless the pattern has empty
+                   cells (which are transparent)
+    :return: RGB (or RGBA) image
+    """
+    image = pattern.to_image()
+    if pattern.mask is None and source is not None and source.mode == 'RGBA':
+        image.putalpha(source.getchannel('A'))
+    return image
 
 
 def preserve_aspect_ratio(old_width: int, old_height: int, new_width: int, new_height: int) -> (int, int):
@@ -0,0 +1,205 @@
+import cProfile
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import wraps
+
+from django.conf import settings
+
+# Master switch; when off, stages and counters cost a single attribute check
+INSTRUMENTATION = getattr(settings, 'INSTRUMENTATION', False)
+# Requests slower than this many seconds have their profile dumped (None disables profiling)
+PROFILE_SLOW_SECONDS = getattr(settings, 'PROFILE_SLOW_SECONDS', None)
+# Fraction of requests run under cProfile when profiling is enabled
+PROFILE_SAMPLE_RATE = getattr(settings, 'PROFILE_SAMPLE_RATE', 0.01)
+PROFILE_DIR = getattr(settings, 'PROFILE_DIR', None)
+
+_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_NULL_STAGE = nullcontext()
+_local = threading.local()
+
+
+class _Histogram:
+    """
+    Cumulative latency histogram in the Prometheus layout
+    """
+
+    def __init__(self):
+        self.buckets = [0] * len(_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.sum += seconds
+        for i, bound in enumerate(_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+
+class MetricsRegistry:
+    """
+    Process-wide timers and counters. Each web worker process keeps its own registry, so the metrics endpoint
+    reports the worker that served the scrape.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timers = OrderedDict()
+        self._counters = OrderedDict()
+
+    def observe(self, family: str, label: str, seconds: float) -> None:
+        """
+        Record a duration
+        :param family: metric family, 'request' or 'stage'
+        :param label: view or stage name
+        :param seconds: duration
+        """
+        with self._lock:
+            histogram = self._timers.get((family, label))
+            if histogram is None:
+                histogram = self._timers[(family, label)] = _Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name: str, value: float = 1) -> None:
+        """
+        Add to a counter
+        :param name: counter name
+        :param value: amount to add
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format
+        :return: metrics text
+        """
+        label_names = {'request': 'view', 'stage': 'stage'}
+        lines = []
+        with self._lock:
+            for family in ('request', 'stage'):
+                name = 'pixel_{}_seconds'.format(family)
+                lines.append('# HELP {} Time spent per {}.'.format(name, label_names[family]))
+                lines.append('# TYPE {} histogram'.format(name))
+                for (timer_family, label), histogram in self._timers.items():
+                    if timer_family != family:
+                        continue
+                    tag = '{}="{}"'.format(label_names[family], label)
+                    for bound, count in zip(_BUCKETS, histogram.buckets):
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, tag, bound, count))
+                    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, tag, histogram.count))
+                    lines.append('{}_sum{{{}}} {}'.format(name, tag, histogram.sum))
+                    lines.append('{}_count{{{}}} {}'.format(name, tag, histogram.count))
+            for counter, value in self._counters.items():
+                name = 'pixel_{}_total'.format(counter)
+                lines.append('# TYPE {} counter'.format(name))
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self) -> None:
+        """
+        Reset every metric
+        """
+        with self._lock:
+            self._timers.clear()
+            self._counters.clear()
+
+
+registry = MetricsRegistry()
+
+
+class _Stage:
+    """
+    Times a block of code, recording it in the registry and in the timings of the current request
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        registry.observe('stage', self.name, elapsed)
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            timings[self.name] = timings.get(self.name, 0.0) + elapsed
+        return False
+
+
+def stage(name: str):
+    """
+    Context manager timing a stage of the pipeline, e.g. `with stage('remap'): ...`
+    :param name: stage name
+    """
+    if not INSTRUMENTATION:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def count(name: str, value: float = 1) -> None:
+    """
+    Add to a counter, e.g. the number of pixels remapped
+    :param name: counter name
+    :param value: amount to add
+    """
+    if INSTRUMENTATION:
+        registry.increment(name, value)
+
+
+def instrumented(view_name: str):
+    """
+    View decorator recording the request time, adding a Server-Timing header with the time of each stage and, for a
+    sample of requests, dumping a cProfile of those slower than PROFILE_SLOW_SECONDS
+    :param view_name: name the view is reported under
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not INSTRUMENTATION:
+                return view(request, *args, **kwargs)
+
+            _local.timings = timings = OrderedDict()
+            profiler = None
+            if PROFILE_SLOW_SECONDS is not None and random.random() < PROFILE_SAMPLE_RATE:
+                profiler = cProfile.Profile()
+                profiler.enable()
+            start = time.perf_counter()
+            try:
+                response = view(request, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                if profiler is not None:
+                    profiler.disable()
+                _local.timings = None
+                registry.observe('request', view_name, elapsed)
+
+            if profiler is not None and elapsed >= PROFILE_SLOW_SECONDS:
+                _dump_profile(profiler, view_name)
+
+            metrics = ['{};dur={:.2f}'.format(name, seconds * 1000) for (name, seconds) in timings.items()]
+            metrics.append('total;dur={:.2f}'.format(elapsed * 1000))
+            response['Server-Timing'] = ', '.join(metrics)
+            return response
+        return wrapper
+    return decorator
+
+
+def _dump_profile(profiler: cProfile.Profile, view_name: str) -> None:
+    """
+    Save a request profile, readable with pstats or snakeviz
+    :param profiler: finished profiler
+    :param view_name: name of the profiled view
+    """
+    directory = PROFILE_DIR or os.path.join(settings.TMP_DIR, 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    profiler.dump_stats(os.path.join(directory, '{}-{}-{}.prof'.format(
+        view_name, time.strftime('%Y%m%d-%H%M%S'), os.getpid())))
@@ -0,0 +1,230 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from core.models import ImageSession, ProcessingJob
+from util.general import create_tmp_file
+from util.pipeline import generate_pattern_pdf, process_image
+from util.worker import init_worker
+
+JOB_WORKERS = getattr(settings, 'JOB_WORKERS', max(1, (os.cpu_count() or 2) - 1))
+# Maximum number of queued or running jobs across all web workers before new submissions are refused
+JOB_QUEUE_DEPTH = getattr(settings, 'JOB_QUEUE_DEPTH', 4 * JOB_WORKERS)
+# Jobs that have not been updated for this long are assumed lost (e.g. the web worker was restarted)
+JOB_TIMEOUT = getattr(settings, 'JOB_TIMEOUT', 300)
+# Suggested delay, in seconds, before clients retry after a backpressure response
+JOB_RETRY_AFTER = getattr(settings, 'JOB_RETRY_AFTER', 2)
+
+_executor = None
+_executor_lock = threading.Lock()
+# Futures of the jobs submitted by this web worker; the done callbacks run on the executor's management thread
+_futures = {}
+_futures_lock = threading.Lock()
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when the job queue is saturated and the client should retry later
+    """
+    pass
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """
+    Lazily create the process pool. Workers are spawned rather than forked so they never share database
+    connections with the web worker.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=init_worker)
+        return _executor
+
+
+def _run_job(job_id: str, kind: str, args: tuple):
+    """
+    Entry point executed in a worker process
+    :param job_id: job id
+    :param kind: ProcessingJob.PROCESS or ProcessingJob.DOWNLOAD
+    :param args: arguments for the job function
+    :return: the job result, or None if the job was cancelled before it started
+    """
+    # Claim the job; a superseded job is skipped without doing any work
+    if ProcessingJob.objects.filter(pk=job_id, status=ProcessingJob.QUEUED).update(
+            status=ProcessingJob.RUNNING, updated=timezone.now()) == 0:
+        return None
+
+    if kind == ProcessingJob.PROCESS:
+        return process_image(*args)
+    elif kind == ProcessingJob.DOWNLOAD:
+        pdf_file = create_tmp_file()
+        pattern_file, counts = args
+        with open(pdf_file, 'wb') as fout:
+            generate_pattern_pdf(pattern_file, fout, counts)
+        return pdf_file
+    raise ValueError('Unknown job kind: {}'.format(kind))
+
+
+def _active_jobs():
+    """
+    Jobs that are queued or running and have not timed out
+    """
+    cutoff = timezone.now() - timedelta(seconds=JOB_TIMEOUT)
+    return ProcessingJob.objects.filter(status__in=ProcessingJob.ACTIVE_STATUSES, updated__gte=cutoff)
+
+
+def submit_job(image_session: ImageSession, kind: str, params: dict, args: tuple) -> ProcessingJob:
+    """
+    Queue a job for an image session, cancelling any earlier job of the same kind for that session
+    :param image_session: session the job belongs to
+    :param kind: ProcessingJob.PROCESS or ProcessingJob.DOWNLOAD
+    :param params: parameters to store with the job
+    :param args: arguments for the job function
+    :return: the new job
+    :raises JobQueueFull: if too many jobs are already queued or running
+    """
+    # Supersede earlier jobs first so that they do not count against the queue depth
+    superseded = list(ProcessingJob.objects.filter(session=image_session, kind=kind,
+                                                   status__in=ProcessingJob.ACTIVE_STATUSES)
+                      .values_list('job_id', flat=True))
+    cancel_jobs(superseded)
+
+    if _active_jobs().count() >= JOB_QUEUE_DEPTH:
+        raise JobQueueFull()
+
+    job = ProcessingJob.objects.create(job_id=str(uuid.uuid4()), session=image_session, kind=kind,
+                                       params=json.dumps(params))
+    future = _get_executor().submit(_run_job, job.job_id, kind, args)
+    with _futures_lock:
+        _futures[job.job_id] = future
+    future.add_done_callback(lambda f: _finish_job(job.job_id, f))
+    return job
+
+
+def cancel_jobs(job_ids) -> None:
+    """
+    Cancel jobs. Jobs that have not started are dropped from the pool; the results of running jobs are discarded.
+    :param job_ids: ids of the jobs to cancel
+    """
+    ProcessingJob.objects.filter(job_id__in=job_ids, status__in=ProcessingJob.ACTIVE_STATUSES) \
+        .update(status=ProcessingJob.CANCELLED, updated=timezone.now())
+    for job_id in job_ids:
+        with _futures_lock:
+            future = _futures.get(job_id)
+        if future is not None:
+            future.cancel()
+
+
+def _finish_job(job_id: str, future: Future) -> None:
+    """
+    Record the outcome of a job (runs in the web worker when the future completes)
+    :param job_id: job id
+    :param future: completed future
+    """
+    with _futures_lock:
+        _futures.pop(job_id, None)
+    # This runs outside the request cycle, so stale connections are not cleaned up by Django
+    close_old_connections()
+    try:
+        _record_result(job_id, future)
+    finally:
+        close_old_connections()
+
+
+def _record_result(job_id: str, future: Future) -> None:
+    """
+    Store the result or error of a completed job
+    :param job_id: job id
+    :param future: completed future
+    """
+    try:
+        result = future.result()
+    except CancelledError:
+        return
+    except Exception as e:
+        ProcessingJob.objects.filter(pk=job_id, status__in=ProcessingJob.ACTIVE_STATUSES) \
+            .update(status=ProcessingJob.FAILED, error=str(e), updated=timezone.now())
+        return
+    if result is None:
+        return
+
+    job = ProcessingJob.objects.select_related('session').get(pk=job_id)
+    if job.kind == ProcessingJob.PROCESS:
+        result_file = _write_result(result)
+        files = [result['pattern_file'], result_file]
+    else:
+        result_file = result
+        files = [result_file]
+
+    # The job may have been cancelled since it was loaded; only a job that is still active takes the result
+    updated = ProcessingJob.objects.filter(pk=job_id, status__in=ProcessingJob.ACTIVE_STATUSES) \
+        .update(status=ProcessingJob.DONE, result_file=result_file, updated=timezone.now())
+    if not updated:
+        for fp in files:
+            os.remove(fp)
+        return
+    if job.kind == ProcessingJob.PROCESS:
+        job.session.set_pattern_file(result['pattern_file'], result.get('counts'))
+
+
+def _write_result(result: dict) -> str:
+    """
+    Persist a processing result so that any web worker can serve it
+    :param result: result of util.pipeline.process_image
+    :return: path of the result file
+    """
+    result_file = create_tmp_file()
+    with open(result_file, 'w') as fout:
+        json.dump(result, fout)
+    return result_file
+
+
+def wait_for_job(job_id: str, timeout: float, interval: float = 0.25) -> ProcessingJob:
+    """
+    Long-poll a job until it leaves the active states or the timeout expires
+    :param job_id: job id
+    :param timeout: maximum number of seconds to wait
+    :param interval: polling interval in seconds
+    :return: the job
+    :raises ProcessingJob.DoesNotExist: if the job does not exist
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        job = ProcessingJob.objects.get(pk=job_id)
+        if job.status not in ProcessingJob.ACTIVE_STATUSES or time.monotonic() >= deadline:
+            return job
+        time.sleep(interval)
+
+
+def open_result(job: ProcessingJob, mode: str = 'rb'):
+    """
+    Open the result file of a finished job
+    :param job: finished job
+    :param mode: file mode
+    :return: open file
+    :raises FileNotFoundError: if the result file has been removed, e.g. by the reaper
+    """
+    if job.result_file is None:
+        raise FileNotFoundError('Job {} has no result file'.format(job.job_id))
+    return open(job.result_file, mode)
+
+
+def load_result(job: ProcessingJob) -> dict:
+    """
+    Load the result of a finished processing job
+    :param job: finished job
+    :return: result of util.pipeline.process_image
+    :raises FileNotFoundError: if the result file has been removed, e.g. by the reaper
+    """
+    with open_result(job, 'r') as fin:
+        return json.load(fin)
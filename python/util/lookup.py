@@ -0,0 +1,426 @@
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections
+
+from core.models import BeadColor
+from util.color import colors_to_array, nearest_color_indices, _weighted_euclidian_array
+
+logger = logging.getLogger(__name__)
+
+LOOKUP_DIR = getattr(settings, 'COLOR_LOOKUP_DIR', os.path.join(settings.TMP_DIR, 'lookup'))
+# Bits per channel of the tables that are built and used; 8-bit tables are exact, smaller ones approximate
+DEFAULT_BITS = getattr(settings, 'COLOR_LOOKUP_BITS', 6)
+ALL_BRANDS = 'all'
+
+# Number of cube cells matched per batch when (re)building a table
+_CELLS_PER_BATCH = 1 << 18
+
+_HEADER_PATTERN = re.compile(r'^palette-(\w+)-(\d)bit\.json$')
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+_refresh_thread = None
+_refresh_pending = False
+_refresh_lock = threading.Lock()
+
+
+class ColorLookupTable:
+    """
+    Precomputed mapping from every (optionally quantized) RGB value to the index of the nearest bead in a palette.
+    The table is stored as a .npy file so it can be memory-mapped, with a small JSON header describing the palette.
+    """
+
+    def __init__(self, name: str, bits: int, bead_ids: List[int], palette: np.ndarray, table: np.ndarray):
+        """
+        Constructor
+        :param name: palette name (brand id or ALL_BRANDS)
+        :param bits: bits per channel used to quantize the RGB cube (1-8)
+        :param bead_ids: BeadColor ids, in palette order
+        :param palette: (M, 3) array of bead RGB values, in palette order
+        :param table: flat array of palette indices, one per cube cell
+        """
+        self.name = name
+        self.bits = bits
+        self.bead_ids = bead_ids
+        self.palette = palette
+        self.table = table
+
+    @classmethod
+    def build(cls, name: str, beads: Iterable[BeadColor], bits: int = DEFAULT_BITS) -> 'ColorLookupTable':
+        """
+        Build a table by matching the center of every cube cell against the palette
+        :param name: palette name (brand id or ALL_BRANDS)
+        :param beads: bead colors making up the palette
+        :param bits: bits per channel used to quantize the RGB cube (1-8)
+        :return: The new table
+        """
+        if not 1 <= bits <= 8:
+            raise ValueError('bits must be between 1 and 8')
+        beads = list(beads)
+        palette = colors_to_array(beads)
+        table = np.empty(1 << (3 * bits), dtype=np.uint16)
+        for start in range(0, len(table), _CELLS_PER_BATCH):
+            cells = np.arange(start, min(start + _CELLS_PER_BATCH, len(table)))
+            table[cells] = nearest_color_indices(_cell_centers(cells, bits), palette)
+        return cls(name, bits, [bead.id for bead in beads], palette, table)
+
+    @classmethod
+    def load(cls, name: str, bits: int = DEFAULT_BITS, mmap: bool = True) -> Optional['ColorLookupTable']:
+        """
+        Load a previously saved table
+        :param name: palette name (brand id or ALL_BRANDS)
+        :param bits: bits per channel of the table
+        :param mmap: True to memory-map the table read-only, False to read a private copy that can be modified
+        :return: The table, or None if it has not been built
+        """
+        table_path, header_path = _paths(name, bits)
+        try:
+            with open(header_path) as fin:
+                header = json.load(fin)
+            # The header names the table file it was written with
+            if 'table' in header:
+                table_path = os.path.join(LOOKUP_DIR, header['table'])
+            table = np.load(table_path, mmap_mode='r' if mmap else None)
+        except (OSError, ValueError):
+            # Not built, or replaced between reading the header and opening the table
+            return None
+        palette = np.array(header['palette'], dtype=np.float64).reshape(-1, 3)
+        return cls(name, header['bits'], header['bead_ids'], palette, table)
+
+    def save(self) -> None:
+        """
+        Write the table and header to LOOKUP_DIR, replacing any previous version atomically: the table is written
+        under a new name, and the header naming it replaces the previous header in a single rename. Processes that
+        already mapped the previous version keep reading it until they reload.
+        """
+        os.makedirs(LOOKUP_DIR, exist_ok=True)
+        table_path, header_path = _paths(self.name, self.bits)
+        previous = _table_file(header_path)
+        base = os.path.basename(table_path)[:-len('.npy')]
+        table_file = '{}.{}.npy'.format(base, uuid.uuid4().hex)
+        np.save(os.path.join(LOOKUP_DIR, table_file), self.table)
+        tmp_path = '{}.{}.tmp'.format(header_path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as fout:
+            json.dump({'bits': self.bits, 'bead_ids': self.bead_ids, 'palette': self.palette.tolist(),
+                       'table': table_file}, fout)
+        os.replace(tmp_path, header_path)
+        if previous is not None and previous != table_file:
+            _remove(os.path.join(LOOKUP_DIR, previous))
+
+    def same_palette(self, beads: Iterable[BeadColor]) -> bool:
+        """
+        Check whether the table was built for exactly these beads, with their current colors
+        :param beads: bead colors
+        :return: True if the table's palette holds the same beads with the same colors
+        """
+        expected = {bead.id: (bead.red, bead.green, bead.blue) for bead in beads}
+        return len(expected) == len(self.bead_ids) and \
+            all(expected.get(bead_id) == tuple(color) for (bead_id, color) in zip(self.bead_ids,
+                                                                                    self.palette.astype(int).tolist()))
+
+    def lookup(self, pixels: np.ndarray) -> np.ndarray:
+        """
+        Find the nearest palette color for each pixel
+        :param pixels: (N, 3) array of 8-bit RGB values
+        :return: (N,) array of indices into the palette
+        """
+        pixels = np.asarray(pixels).reshape(-1, 3).astype(np.intp)
+        shift = 8 - self.bits
+        cells = ((pixels[:, 0] >> shift) << (2 * self.bits)) | ((pixels[:, 1] >> shift) << self.bits) | \
+                (pixels[:, 2] >> shift)
+        return self.table[cells]
+
+    def set_bead(self, bead: BeadColor) -> None:
+        """
+        Incrementally add or update a bead in the palette. Only cells that could have changed are rematched.
+        :param bead: The added or edited bead
+        """
+        color = colors_to_array([bead])
+        if bead.id in self.bead_ids:
+            index = self.bead_ids.index(bead.id)
+            # Cells that used to map to this bead may now belong elsewhere
+            stale = np.flatnonzero(self.table == index)
+            self.palette[index] = color[0]
+            self._rematch(stale)
+        else:
+            index = len(self.bead_ids)
+            self.bead_ids.append(bead.id)
+            self.palette = np.vstack([self.palette, color])
+
+        # Any cell may now be closer to the new color than to its current bead
+        for start in range(0, len(self.table), _CELLS_PER_BATCH):
+            cells = np.arange(start, min(start + _CELLS_PER_BATCH, len(self.table)))
+            centers = _cell_centers(cells, self.bits)
+            current = self.palette[self.table[cells]]
+            current_dist = _paired_distance(centers, current)
+            new_dist = _weighted_euclidian_array(centers, color)[:, 0]
+            closer = new_dist < current_dist
+            # Ties keep the earlier bead, matching nearest_color_indices; only an existing bead can tie earlier
+            ties = (new_dist == current_dist) & (self.table[cells] > index)
+            self.table[cells[closer | ties]] = index
+
+    def remove_bead(self, bead_id: int) -> None:
+        """
+        Incrementally remove a bead from the palette
+        :param bead_id: id of the deleted bead
+        """
+        if bead_id not in self.bead_ids:
+            return
+        index = self.bead_ids.index(bead_id)
+        stale = np.flatnonzero(self.table == index)
+        del self.bead_ids[index]
+        self.palette = np.delete(self.palette, index, axis=0)
+        if len(self.bead_ids) == 0:
+            return
+        # Shift indices above the removed bead down by one, then rematch the orphaned cells
+        above = np.flatnonzero(self.table > index)
+        self.table[above] -= 1
+        self._rematch(stale)
+
+    def _rematch(self, cells: np.ndarray) -> None:
+        """
+        Match the given cells against the full palette
+        :param cells: flat cell indices
+        """
+        for start in range(0, len(cells), _CELLS_PER_BATCH):
+            batch = cells[start:start + _CELLS_PER_BATCH]
+            self.table[batch] = nearest_color_indices(_cell_centers(batch, self.bits), self.palette)
+
+
+def _paired_distance(pixels: np.ndarray, colors: np.ndarray) -> np.ndarray:
+    """
+    Weighted Euclidian distance between each pixel and its own paired color
+    :param pixels: (N, 3) array of RGB values
+    :param colors: (N, 3) array of RGB values
+    :return: (N,) array of distances
+    """
+    r_bar = (pixels[:, 0] + colors[:, 0]) / 2
+    dr = pixels[:, 0] - colors[:, 0]
+    dg = pixels[:, 1] - colors[:, 1]
+    db = pixels[:, 2] - colors[:, 2]
+    return (2 + r_bar / 256) * dr * dr + 4 * dg * dg + (2 + (255 - r_bar) / 256) * db * db
+
+
+def _cell_centers(cells: np.ndarray, bits: int) -> np.ndarray:
+    """
+    Representative RGB value for each cube cell
+    :param cells: flat cell indices
+    :param bits: bits per channel
+    :return: (N, 3) float array of RGB values
+    """
+    mask = (1 << bits) - 1
+    shift = 8 - bits
+    offset = (1 << shift) >> 1
+    channels = [(cells >> (2 * bits)) & mask, (cells >> bits) & mask, cells & mask]
+    return np.stack([(channel << shift) + offset for channel in channels], axis=1).astype(np.float64)
+
+
+def _paths(name: str, bits: int) -> (str, str):
+    """
+    File paths for a table
+    :param name: palette name (brand id or ALL_BRANDS)
+    :param bits: bits per channel
+    :return: (table path, header path)
+    """
+    base = os.path.join(LOOKUP_DIR, 'palette-{}-{}bit'.format(name, bits))
+    return base + '.npy', base + '.json'
+
+
+def _table_file(header_path: str) -> Optional[str]:
+    """
+    Name of the table file a header refers to
+    :param header_path: path of the header
+    :return: file name in LOOKUP_DIR, None if there is no header
+    """
+    try:
+        with open(header_path) as fin:
+            header = json.load(fin)
+    except (OSError, ValueError):
+        return None
+    # Tables saved before headers named their file use the fixed name
+    return header.get('table', os.path.basename(header_path)[:-len('.json')] + '.npy')
+
+
+def _remove(path: str) -> None:
+    """
+    Remove a file if it exists
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@contextmanager
+def table_lock():
+    """
+    Hold the lock that serializes updates of the saved tables across processes
+    """
+    os.makedirs(LOOKUP_DIR, exist_ok=True)
+    with open(os.path.join(LOOKUP_DIR, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def palette_beads(name: str) -> Sequence[BeadColor]:
+    """
+    Beads that make up a named palette
+    :param name: brand id or ALL_BRANDS
+    :return: Beads ordered by id
+    """
+    beads = BeadColor.objects.order_by('id')
+    if name != ALL_BRANDS:
+        beads = beads.filter(brand_id=int(name))
+    return beads
+
+
+def saved_tables() -> List[Tuple[str, int]]:
+    """
+    List the tables that have been built
+    :return: list of (palette name, bits per channel)
+    """
+    if not os.path.isdir(LOOKUP_DIR):
+        return []
+    tables = []
+    for file_name in sorted(os.listdir(LOOKUP_DIR)):
+        match = _HEADER_PATTERN.match(file_name)
+        if match is not None:
+            tables.append((match.group(1), int(match.group(2))))
+    return tables
+
+
+def find_table(beads: Iterable[BeadColor], bits: int = DEFAULT_BITS) -> Optional[ColorLookupTable]:
+    """
+    Find a built table whose palette is exactly the given beads. Edited beads keep their ids, so colors are
+    compared as well, and a table that has not caught up with a change is never used.
+    :param beads: selected bead colors
+    :param bits: bits per channel
+    :return: The table, or None if no matching table has been built
+    """
+    beads = list(beads)
+    for name, table_bits in saved_tables():
+        if table_bits != bits:
+            continue
+        table = _load_cached(name, bits)
+        if table is not None and table.same_palette(beads):
+            return table
+    return None
+
+
+def tables_version(bits: int = DEFAULT_BITS) -> str:
+    """
+    Identify the saved tables, so that results computed with them can be told apart from results computed before
+    they were built or updated
+    :param bits: bits per channel
+    :return: string that changes whenever a table is built, updated or removed
+    """
+    stamps = []
+    for name, table_bits in saved_tables():
+        if table_bits == bits:
+            try:
+                stat = os.stat(_paths(name, bits)[1])
+            except OSError:
+                continue
+            stamps.append('{}:{}.{}'.format(name, stat.st_ino, stat.st_mtime_ns))
+    return ','.join(stamps)
+
+
+def _load_cached(name: str, bits: int) -> Optional[ColorLookupTable]:
+    """
+    Load a table, reusing an existing memory map unless the header changed on disk
+    :param name: palette name
+    :param bits: bits per channel
+    :return: The table, or None if it has not been built
+    """
+    try:
+        # Headers are replaced by rename, so a new version always has a new inode
+        stat = os.stat(_paths(name, bits)[1])
+    except OSError:
+        return None
+    stamp = (stat.st_ino, stat.st_mtime_ns)
+    with _loaded_lock:
+        cached = _loaded.get((name, bits))
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        table = ColorLookupTable.load(name, bits)
+        _loaded[(name, bits)] = (stamp, table)
+        return table
+
+
+def refresh_tables() -> None:
+    """
+    Bring every saved table up to date with the beads in the database. Changed beads are applied incrementally,
+    rematching only the cells that can change; tables whose palette became empty are removed.
+    """
+    with table_lock():
+        for name, bits in saved_tables():
+            beads = list(palette_beads(name))
+            table = ColorLookupTable.load(name, bits, mmap=False)
+            if table is None or table.same_palette(beads):
+                continue
+            if len(beads) == 0:
+                _, header_path = _paths(name, bits)
+                previous = _table_file(header_path)
+                _remove(header_path)
+                if previous is not None:
+                    _remove(os.path.join(LOOKUP_DIR, previous))
+                continue
+
+            current = {bead.id for bead in beads}
+            for bead_id in [bead_id for bead_id in table.bead_ids if bead_id not in current]:
+                table.remove_bead(bead_id)
+            if len(table.bead_ids) == 0:
+                # Nothing left to update incrementally
+                table = ColorLookupTable.build(name, beads, bits)
+            else:
+                colors = dict(zip(table.bead_ids, table.palette.astype(int).tolist()))
+                for bead in beads:
+                    if colors.get(bead.id) != [bead.red, bead.green, bead.blue]:
+                        table.set_bead(bead)
+            table.save()
+
+
+def schedule_refresh() -> None:
+    """
+    Refresh the saved tables in a background thread, so that requests changing beads never wait for it. A change
+    made while a refresh is running triggers one more pass.
+    """
+    global _refresh_thread, _refresh_pending
+    with _refresh_lock:
+        _refresh_pending = True
+        if _refresh_thread is None:
+            _refresh_thread = threading.Thread(target=_refresh_forever, name='lookup-refresh', daemon=True)
+            _refresh_thread.start()
+
+
+def _refresh_forever() -> None:
+    """
+    Body of the refresh thread: refresh until no change is pending
+    """
+    global _refresh_thread, _refresh_pending
+    while True:
+        with _refresh_lock:
+            if not _refresh_pending:
+                _refresh_thread = None
+                return
+            _refresh_pending = False
+        try:
+            refresh_tables()
+        except Exception:
+            logger.exception('Lookup table refresh failed')
+        finally:
+            close_old_connections()
@@ -0,0 +1,145 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+
+from core.models import BeadColor
+from util.color import WEIGHTED_EUCLIDIAN, colors_to_array
+from util.color_index import palette_index_cache
+from util.dither import NONE, dither_bands
+from util.image import REMAP_METHOD, alpha_mask, remap_pattern
+from util.instrument import count
+from util.pattern import BeadPattern, Board, board_layout
+
+# Side, in beads, of the pegboards murals are built on
+MURAL_BOARD_SIZE = getattr(settings, 'MURAL_BOARD_SIZE', 29)
+# Longest side, in beads, of a mural
+MAX_MURAL_SIZE = getattr(settings, 'MAX_MURAL_SIZE', 2048)
+# Threads remapping the boards of a mural
+MURAL_WORKERS = getattr(settings, 'MURAL_WORKERS', os.cpu_count() or 1)
+
+
+def remap_mural(image: Image.Image, allowable_colors: Iterable[BeadColor], board_size: int = MURAL_BOARD_SIZE,
+                metric: str = WEIGHTED_EUCLIDIAN, dither: str = NONE, workers: int = MURAL_WORKERS,
+                alpha_threshold: int = 0) -> BeadPattern:
+    """
+    Match every pixel of a mural to the nearest allowable bead, one pegboard at a time. Boards are cropped from the
+    source image and remapped concurrently, with at most two boards per worker in flight, so the pixel data and
+    matching temporaries stay proportional to a board rather than to the mural; the only full-size arrays are the
+    narrow index array and mask of the pattern itself. Dithered murals are matched one row of boards at a time
+    instead, top to bottom, since error diffusion across board edges is inherently sequential.
+    :param image: Source image at one pixel per bead
+    :param allowable_colors: Iterable of BeadColor objects indicating which colors are allowable
+    :param board_size: side of a pegboard in beads
+    :param metric: color distance metric, one of util.color.METRICS
+    :param dither: dithering mode, one of util.dither.DITHER_MODES
+    :param workers: number of threads
+    :param alpha_threshold: pixels less opaque than this (0-255) are left empty, see remap_pattern
+    :return: Bead pattern recording the board size
+    """
+    allowable_colors = list(allowable_colors)
+    if dither != NONE:
+        return _dither_mural(image, allowable_colors, board_size, metric, dither, alpha_threshold)
+
+    bead_ids = np.array([bead.id for bead in allowable_colors], dtype=np.int64)
+    colors = colors_to_array(allowable_colors)
+    positions = {int(bead_id): i for (i, bead_id) in enumerate(bead_ids)}
+
+    # Cells index the full allowable palette until the pattern is compacted; empty cells are left at 0
+    indices = np.zeros((image.height, image.width), dtype=np.uint8 if len(bead_ids) <= 256 else np.uint16)
+    used = np.zeros(len(bead_ids), dtype=bool)
+    mask = None
+    boards = board_layout(image.width, image.height, board_size)
+    for board, tile in _remap_boards(image, boards, allowable_colors, metric, workers, alpha_threshold):
+        cells = (slice(board.top, board.top + board.height), slice(board.left, board.left + board.width))
+        if tile.mask is not None:
+            if mask is None:
+                mask = np.ones(indices.shape, dtype=bool)
+            mask[cells] = tile.mask
+        if len(tile.bead_ids) == 0:
+            # Every cell of the board is empty
+            continue
+        to_palette = np.array([positions[int(bead_id)] for bead_id in tile.bead_ids], dtype=indices.dtype)
+        used[to_palette] = True
+        indices[cells] = to_palette[tile.indices]
+    count('mural_boards', len(boards))
+
+    # Keep only the beads that are used, renumbering in place one row of boards at a time (see
+    # BeadPattern.from_indices)
+    used = np.flatnonzero(used)
+    compact = np.zeros(len(bead_ids), dtype=indices.dtype)
+    compact[used] = np.arange(len(used), dtype=indices.dtype)
+    for top in range(0, image.height, board_size):
+        indices[top:top + board_size] = compact[indices[top:top + board_size]]
+    if len(used) <= 256 and indices.dtype != np.uint8:
+        indices = indices.astype(np.uint8)
+    return BeadPattern(indices, bead_ids[used], colors[used], board_size, mask)
+
+
+def _dither_mural(image: Image.Image, allowable_colors: List[BeadColor], board_size: int, metric: str, dither: str,
+                  alpha_threshold: int = 0) -> BeadPattern:
+    """
+    Dither a mural one row of boards at a time. Error carries across the rows of boards (see dither_bands), so the
+    pattern is the same as a single pass over the mural, but only one row of boards is converted to pixel data.
+    :param image: Source image at one pixel per bead
+    :param allowable_colors: beads the pattern may use
+    :param board_size: side of a pegboard in beads
+    :param metric: color distance metric
+    :param dither: dithering mode, one of util.dither.DITHER_MODES
+    :param alpha_threshold: pixels less opaque than this (0-255) are left empty, see remap_pattern
+    :return: Bead pattern recording the board size
+    """
+    bead_ids, index = palette_index_cache.get(allowable_colors, metric)
+    indices = np.zeros((image.height, image.width), dtype=np.uint8 if len(bead_ids) <= 256 else np.uint16)
+    mask = None
+    tops = range(0, image.height, board_size)
+
+    def bands() -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        nonlocal mask
+        for top in tops:
+            band = image.crop((0, top, image.width, min(top + board_size, image.height)))
+            band_mask = alpha_mask(band, alpha_threshold)
+            if band_mask is not None:
+                if mask is None:
+                    mask = np.ones(indices.shape, dtype=bool)
+                mask[top:top + board_size] = band_mask
+            yield np.asarray(band.convert('RGB')), band_mask
+
+    for top, band_indices in zip(tops, dither_bands(bands(), index, dither)):
+        indices[top:top + board_size] = band_indices
+    count('mural_boards', len(board_layout(image.width, image.height, board_size)))
+    return BeadPattern.from_indices(indices, bead_ids, index.palette, board_size, mask)
+
+
+def _remap_boards(image: Image.Image, boards: List[Board], allowable_colors: List[BeadColor], metric: str,
+                  workers: int, alpha_threshold: int = 0) -> Iterator[Tuple[Board, BeadPattern]]:
+    """
+    Remap boards in a thread pool, yielding them in order
+    :param image: Source image at one pixel per bead
+    :param boards: boards to remap
+    :param allowable_colors: beads the pattern may use
+    :param metric: color distance metric
+    :param workers: number of threads
+    :param alpha_threshold: pixels less opaque than this (0-255) are left empty, see remap_pattern
+    :return: iterator of (board, bead pattern of the board)
+    """
+    def remap_board(board: Board, tile: Image.Image) -> Tuple[Board, BeadPattern]:
+        return board, remap_pattern(tile, allowable_colors, method=REMAP_METHOD, metric=metric,
+                                    alpha_threshold=alpha_threshold)
+
+    # Boards are cropped on this thread, as they are submitted, so only the boards in flight hold pixel data
+    image.load()
+    workers = max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for board in boards:
+            tile = image.crop((board.left, board.top, board.left + board.width, board.top + board.height))
+            pending.append(pool.submit(remap_board, board, tile))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
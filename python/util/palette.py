@@ -0,0 +1,130 @@
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from core.models import BeadBrand, BeadColor
+
+# Touched whenever the palette changes, so that every process (web and job workers) reloads its snapshot
+PALETTE_VERSION_FILE = getattr(settings, 'PALETTE_VERSION_FILE', os.path.join(settings.TMP_DIR, 'palette.version'))
+
+
+class PaletteSnapshot:
+    """
+    Immutable snapshot of every bead color together with its brand. Beads are loaded with their brand, so
+    formatting them (e.g. for the PDF color key) does not issue queries.
+    """
+
+    def __init__(self, version: int, stamp: tuple, brands: Iterable[BeadBrand], beads: Iterable[BeadColor]):
+        """
+        Constructor
+        :param version: snapshot number, incremented on every load in this process
+        :param stamp: version file stamp the snapshot was loaded for
+        :param brands: every brand, in display order
+        :param beads: every bead color, ordered by id, with its brand loaded
+        """
+        self.version = version
+        self.stamp = stamp
+        self.brands = tuple(brands)
+        self.beads = tuple(beads)
+        self.ids = tuple(bead.id for bead in self.beads)
+        self._by_id = {bead.id: bead for bead in self.beads}
+
+        groups = OrderedDict((brand.id, []) for brand in self.brands)
+        for bead in self.beads:
+            groups.setdefault(bead.brand_id, []).append(bead)
+        names = {brand.id: brand.name for brand in self.brands}
+        self.color_groups = MappingProxyType(OrderedDict(
+            (names.get(brand_id, ''), tuple(beads)) for (brand_id, beads) in groups.items()))
+
+    def __len__(self) -> int:
+        return len(self.beads)
+
+    def get(self, bead_id: int) -> Optional[BeadColor]:
+        """
+        Look up a bead
+        :param bead_id: bead id
+        :return: the bead, or None if it does not exist
+        """
+        return self._by_id.get(bead_id)
+
+    def select(self, bead_ids: Iterable[int]) -> List[BeadColor]:
+        """
+        Beads for a color selection; unknown ids are ignored and an empty selection means every bead
+        :param bead_ids: selected bead ids
+        :return: beads ordered by id
+        """
+        bead_ids = set(bead_ids)
+        if len(bead_ids) == 0:
+            return list(self.beads)
+        return [bead for bead in self.beads if bead.id in bead_ids]
+
+
+class PaletteRegistry:
+    """
+    In-process registry of the bead palette. The snapshot is loaded once and reused until a bead or brand changes:
+    the change signals bump a version file, and each process reloads when the file's stamp differs from the one its
+    snapshot was loaded for. In steady state, reading the palette costs a stat() call and no queries.
+    """
+
+    def __init__(self, version_file: str = PALETTE_VERSION_FILE):
+        """
+        Constructor
+        :param version_file: file touched whenever the palette changes
+        """
+        self.version_file = version_file
+        self.loads = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def _stamp(self) -> Tuple[int, int]:
+        """
+        Current stamp of the version file
+        :return: (inode, modification time); (0, 0) if the palette has never changed
+        """
+        try:
+            stat = os.stat(self.version_file)
+        except OSError:
+            return 0, 0
+        return stat.st_ino, stat.st_mtime_ns
+
+    def snapshot(self) -> PaletteSnapshot:
+        """
+        Get the current palette, reloading it if it changed
+        :return: palette snapshot
+        """
+        stamp = self._stamp()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.stamp == stamp:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.stamp != stamp:
+                brands = list(BeadBrand.objects.order_by('id'))
+                beads = list(BeadColor.objects.select_related('brand').order_by('id'))
+                self.loads += 1
+                self._snapshot = snapshot = PaletteSnapshot(self.loads, stamp, brands, beads)
+            return snapshot
+
+    def invalidate(self) -> None:
+        """
+        Drop the snapshot in this process and signal the change to the other processes
+        """
+        with self._lock:
+            self._snapshot = None
+            directory = os.path.dirname(self.version_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Replacing the file gives it a new inode, so the stamp changes even within one timestamp tick
+            tmp_file = '{}.{}.tmp'.format(self.version_file, uuid.uuid4())
+            with open(tmp_file, 'w') as fout:
+                fout.write(str(uuid.uuid4()))
+            os.replace(tmp_file, self.version_file)
+
+
+palette_registry = PaletteRegistry()
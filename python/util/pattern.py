@@ -0,0 +1,190 @@
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Hashable, List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+from PIL import Image
+
+# Bumped whenever the saved layout changes
+FORMAT_VERSION = 1
+
+# Characters identifying the beads of a pattern on printed templates, in order of assignment
+VALID_COLOR_CODES = [chr(char_val) for char_val in range(ord('0'), ord('9'))] + \
+                    [chr(char_val) for char_val in range(ord('A'), ord('Z')) if char_val != ord('I')] + \
+                    [chr(char_val) for char_val in range(ord('a'), ord('z')) if char_val != ord('l')]
+# Code of empty cells (transparent pixels), printed as blank cells
+BLANK_CODE = ''
+
+
+def assign_color_codes(counts: Dict[Hashable, int]) -> 'OrderedDict[Hashable, str]':
+    """
+    Assign the color codes printed on templates: the most used bead gets the first code, so codes run 0-9, then A-Z,
+    etc. without skipping. Beads used equally often keep their order in counts.
+    :param counts: bead (any key, e.g. a palette index) -> number of cells
+    :return: bead -> color code for the used beads, most used first
+    :raises ValueError: if more beads are used than there are color codes
+    """
+    used = sorted([(key, num) for (key, num) in counts.items() if num > 0], key=lambda tup: tup[1], reverse=True)
+    if len(used) > len(VALID_COLOR_CODES):
+        raise ValueError('Patterns can use at most {} bead colors, this one uses {}'.format(len(VALID_COLOR_CODES),
+                                                                                          len(used)))
+    return OrderedDict((key, VALID_COLOR_CODES[i]) for (i, (key, _)) in enumerate(used))
+
+
+class Board(NamedTuple):
+    """
+    One pegboard of a mural: its position in the board layout and the cells of the pattern it holds
+    """
+    number: int
+    row: int
+    col: int
+    left: int
+    top: int
+    width: int
+    height: int
+
+
+def board_layout(width: int, height: int, board_size: int) -> List[Board]:
+    """
+    Split a pattern into square pegboards; boards on the right and bottom edges may be partial
+    :param width: pattern width in beads
+    :param height: pattern height in beads
+    :param board_size: side of a pegboard in beads
+    :return: boards in reading order (left to right, then top to bottom), numbered from 1
+    """
+    boards = []
+    for row, top in enumerate(range(0, height, board_size)):
+        for col, left in enumerate(range(0, width, board_size)):
+            boards.append(Board(len(boards) + 1, row, col, left, top, min(board_size, width - left),
+                                min(board_size, height - top)))
+    return boards
+
+
+class BeadPattern:
+    """
+    Bead grid stored as indices into a palette of beads: an (H, W) uint8 array (uint16 for more than 256 beads)
+    plus the id and RGB color of each palette bead. Beads are identified by id rather than by color, so beads that
+    share an RGB value stay distinct. Murals also record the size of the pegboards they are built on, and patterns
+    of images with transparency may leave cells empty.
+    """
+
+    def __init__(self, indices: np.ndarray, bead_ids: Sequence[int], colors: np.ndarray, board_size: int = 0,
+                 mask: Optional[np.ndarray] = None):
+        """
+        Constructor
+        :param indices: (H, W) array of indices into bead_ids (meaningless in empty cells)
+        :param bead_ids: id of each palette bead
+        :param colors: (M, 3) array of the RGB color of each palette bead
+        :param board_size: side of the pegboards a mural is split into, 0 if the pattern is not a mural
+        :param mask: (H, W) boolean array, True for the cells that hold a bead; None if every cell does
+        """
+        self.indices = indices
+        self.bead_ids = np.asarray(bead_ids, dtype=np.int64)
+        self.colors = np.asarray(colors).reshape(-1, 3).astype(np.uint8)
+        self.board_size = board_size
+        self.mask = mask
+
+    @classmethod
+    def from_indices(cls, indices: np.ndarray, bead_ids: Sequence[int], colors: np.ndarray,
+                     board_size: int = 0, mask: Optional[np.ndarray] = None) -> 'BeadPattern':
+        """
+        Build a pattern from remap output, keeping only the beads that are used
+        :param indices: (H, W) array of indices into bead_ids
+        :param bead_ids: id of each bead of the remap palette
+        :param colors: (M, 3) array of the RGB color of each bead of the remap palette
+        :param board_size: side of the pegboards of a mural, 0 otherwise
+        :param mask: (H, W) boolean array of the cells that hold a bead, None if every cell does
+        :return: compact pattern
+        """
+        # Counting rather than sorting keeps the temporaries small for large (mural) grids
+        used = np.flatnonzero(np.bincount((indices if mask is None else indices[mask]).ravel(),
+                                          minlength=len(bead_ids)))
+        dtype = np.uint8 if len(used) <= 256 else np.uint16
+        compact = np.zeros(len(bead_ids), dtype=dtype)
+        compact[used] = np.arange(len(used), dtype=dtype)
+        return cls(compact[indices], np.asarray(bead_ids)[used], np.asarray(colors)[used], board_size, mask)
+
+    @property
+    def width(self) -> int:
+        return self.indices.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.indices.shape[0]
+
+    def boards(self) -> List[Board]:
+        """
+        Pegboards of a mural
+        :return: boards in reading order, empty if the pattern is not a mural
+        """
+        if self.board_size <= 0:
+            return []
+        return board_layout(self.width, self.height, self.board_size)
+
+    def counts(self) -> np.ndarray:
+        """
+        Number of cells using each palette bead
+        :return: (M,) array of counts, in palette order
+        """
+        cells = self.indices if self.mask is None else self.indices[self.mask]
+        return np.bincount(cells.ravel(), minlength=len(self.bead_ids))
+
+    def bead_counts(self) -> Dict[int, int]:
+        """
+        Number of cells using each bead
+        :return: dict of bead id -> count
+        """
+        return {int(bead_id): int(count) for (bead_id, count) in zip(self.bead_ids, self.counts())}
+
+    def to_image(self) -> Image.Image:
+        """
+        Render the pattern at one pixel per bead
+        :return: RGB image, or RGBA with empty cells transparent if the pattern has any
+        """
+        # A pattern whose cells are all empty has no beads to index
+        colors = self.colors if len(self.colors) > 0 else np.zeros((1, 3), dtype=np.uint8)
+        image = Image.fromarray(colors[self.indices], 'RGB')
+        if self.mask is not None:
+            image.putalpha(Image.fromarray(self.mask.astype(np.uint8) * 255, 'L'))
+        return image
+
+    def codes(self, codes: Sequence[str], blank: str = BLANK_CODE) -> np.ndarray:
+        """
+        Color code of every cell
+        :param codes: color code of each palette bead
+        :param blank: code of empty cells
+        :return: (H, W) array of codes
+        """
+        code_array = np.array(list(codes) + [blank])
+        if self.mask is None:
+            return code_array[self.indices]
+        return code_array[np.where(self.mask, self.indices, len(codes))]
+
+    def save(self, output: Union[str, BinaryIO]) -> None:
+        """
+        Save the pattern as a compressed .npz archive
+        :param output: file path or writable binary file object
+        """
+        if isinstance(output, str):
+            # np.savez would append '.npz' to a path without that extension
+            with open(output, 'wb') as fout:
+                self.save(fout)
+            return
+        arrays = {} if self.mask is None else {'mask': self.mask}
+        np.savez_compressed(output, version=np.array(FORMAT_VERSION), indices=self.indices, bead_ids=self.bead_ids,
+                            colors=self.colors, board_size=np.array(self.board_size), **arrays)
+
+    @classmethod
+    def load(cls, source: Union[str, BinaryIO]) -> 'BeadPattern':
+        """
+        Load a saved pattern
+        :param source: file path or readable binary file object
+        :return: the pattern
+        :raises ValueError: if the file is not a pattern of a supported version
+        """
+        with np.load(source) as archive:
+            if 'version' not in archive.files or int(archive['version']) != FORMAT_VERSION:
+                raise ValueError('Unsupported bead pattern format')
+            # Patterns saved before murals existed have no board size
+            board_size = int(archive['board_size']) if 'board_size' in archive.files else 0
+            mask = archive['mask'] if 'mask' in archive.files else None
+            return cls(archive['indices'], archive['bead_ids'], archive['colors'], board_size, mask)
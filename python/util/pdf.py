@@ -1,26 +1,60 @@
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import groupby
 from io import BytesIO
 from math import ceil
-from typing import List, Dict, Iterable
+from typing import List, Dict, Iterable, BinaryIO, Callable
 
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib.units import mm
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, PageBreak, Flowable, Paragraph
+from reportlab.lib.units import mm, inch
+from reportlab.lib.utils import ImageReader, simpleSplit
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, PageBreak, Flowable, Paragraph, Frame
+from reportlab.platypus.doctemplate import LayoutError
+from PIL import Image
 
 from pixel.settings import PDF_TEXT
+from util.instrument import count, stage
+from util.pattern import BLANK_CODE, Board, assign_color_codes
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+logger = logging.getLogger(__name__)
 
-_STYLES = getSampleStyleSheet()
 _CELL_SIZE = [5 * mm]
+_MARGIN = inch
+# Grid pages each worker process must have to pay for starting it (spawning a process imports reportlab afresh)
+PAGES_PER_WORKER = 20
+
+
+@lru_cache(maxsize=None)
+def _warn_serial() -> None:
+    """
+    Log once per process that grid pages are rendered serially because pypdf is missing
+    """
+    logger.warning('pypdf is not installed: PDF grid pages are rendered in a single process (PDF_WORKERS is ignored)')
 
-VALID_COLOR_CODES = [chr(char_val) for char_val in range(ord('0'), ord('9'))] + \
-                    [chr(char_val) for char_val in range(ord('A'), ord('Z')) if char_val != ord('I')] + \
-                    [chr(char_val) for char_val in range(ord('a'), ord('z')) if char_val != ord('l')]
+
+@lru_cache(maxsize=None)
+def _styles():
+    """
+    Paragraph styles, created on first use (building the stylesheet is a noticeable part of importing this module)
+    """
+    return getSampleStyleSheet()
 
 
 class PDFGenerator:
     def __init__(self, color_map: Dict[str, str], data: List[str], total_width: int, num_cols: int = 30,
-                 text: Iterable[str] = None):
+                 text: Iterable[str] = None, num_rows: int = 45, counts: Dict[str, int] = None):
         """
         Constructor
         :param color_map: dict of color_code -> color_name
@@ -28,13 +62,17 @@ class PDFGenerator:
         :param total_width: width of the output image
         :param num_cols: maximum number of columns per page
         :param text: strings to add to the cover page
+        :param num_rows: maximum number of rows per page (only used by write_pdf)
+        :param counts: dict of color_code -> number of cells, if already known (counted from data otherwise)
         :return: bytes of the generated PDF
         """
         self._color_map = color_map
         self._data = data
         self._total_width = total_width
         self._num_cols = num_cols
+        self._num_rows = num_rows
         self._text = text
+        self._counts = counts
         self._code_remap = {}
 
     def generate_pdf(self) -> bytes:
@@ -75,12 +113,68 @@ class PDFGenerator:
                 components.append(PageBreak())
 
         # Build the document
-        with BytesIO() as buffer:
+        with stage('pdf_build'), BytesIO() as buffer:
             doc = SimpleDocTemplate(buffer, pagesize=letter)
             # doc.build(components, onFirstPage=_header, onLaterPages=_header)
             doc.build(components)
+            count('pdf_pages', doc.page)
             return buffer.getvalue()
 
+    def write_pdf(self, output: BinaryIO, workers: int = 1) -> None:
+        """
+        Writes a PDF of the color data provided to a file object. Grid pages are drawn directly on the canvas rather
+        than laid out as tables, and are paginated both horizontally and vertically. With more than one worker
+        (and pypdf installed), page ranges of at least PAGES_PER_WORKER pages are rendered in parallel processes and
+        concatenated.
+        :param output: writable binary file object
+        :param workers: maximum number of processes to render grid pages with
+        """
+        with stage('pdf_cover'):
+            cover = self._generate_cover_page(self._color_map, self._data, paragraphs=self._text)
+            codes = [self._code_remap[code] for code in self._data]
+        total_height = int(ceil(len(codes) / self._total_width))
+
+        # Pages in reading order: left to right, then top to bottom
+        pages = [(start_row, start_col)
+                 for start_row in range(0, total_height, self._num_rows)
+                 for start_col in range(0, self._total_width, self._num_cols)]
+        layout = (self._total_width, total_height, self._num_cols, self._num_rows)
+        count('pdf_grid_pages', len(pages))
+
+        workers = min(workers, len(pages) // PAGES_PER_WORKER)
+        if workers > 1 and PdfWriter is None:
+            _warn_serial()
+        if workers <= 1 or PdfWriter is None:
+            canvas = Canvas(output, pagesize=letter)
+            with stage('pdf_draw_cover'):
+                _draw_flowables(canvas, cover)
+            with stage('pdf_draw_grid'):
+                for start_row, start_col in pages:
+                    _draw_grid_page(canvas, codes, layout, start_row, start_col)
+                    canvas.showPage()
+            with stage('pdf_save'):
+                canvas.save()
+            return
+
+        # Render the cover in this process while the workers render contiguous ranges of grid pages
+        chunk_size = int(ceil(len(pages) / workers))
+        chunks = [pages[i:i + chunk_size] for i in range(0, len(pages), chunk_size)]
+        with stage('pdf_draw_parallel'), tempfile.TemporaryDirectory() as tmp_dir:
+            part_files = [os.path.join(tmp_dir, 'part{}.pdf'.format(i)) for i in range(len(chunks) + 1)]
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = [pool.submit(_render_grid_part, part_file, codes, layout, chunk)
+                           for part_file, chunk in zip(part_files[1:], chunks)]
+                canvas = Canvas(part_files[0], pagesize=letter)
+                _draw_flowables(canvas, cover)
+                canvas.save()
+                for future in futures:
+                    future.result()
+
+            writer = PdfWriter()
+            for part_file in part_files:
+                writer.append(part_file)
+            writer.write(output)
+
     def _generate_cover_page(self, color_map: Dict[str, str], data: List[str], paragraphs: Iterable[str] = None) -> \
             List[Flowable]:
         """
@@ -95,24 +189,23 @@ class PDFGenerator:
         # Include introductory paragraphs
         if paragraphs is not None:
             for paragraph in paragraphs:
-                flowables.append(Paragraph(paragraph, style=_STYLES['Normal']))
-                flowables.append(Paragraph('<br/><br/>', style=_STYLES['Normal']))
+                flowables.append(Paragraph(paragraph, style=_styles()['Normal']))
+                flowables.append(Paragraph('<br/><br/>', style=_styles()['Normal']))
 
         # Count occurrences of each color
-        counts = {}
-        for item in data:
-            counts[item] = counts.get(item, 0) + 1
-        sorted_counts = sorted([(color_code, count) for (color_code, count) in counts.items() if count > 0],
-                               key=lambda tup: tup[1],
-                               reverse=True)
-
+        counts = self._counts
+        if counts is None:
+            counts = {}
+            for item in data:
+                counts[item] = counts.get(item, 0) + 1
         # Remap the color codes so that the PDF is more intuitive
         # This will force the use of 0-9, then A-Z, etc. rather than skipping around
-        self._code_remap = {code: VALID_COLOR_CODES[i] for (i, code) in enumerate(tup[0] for tup in sorted_counts)}
+        self._code_remap = assign_color_codes({code: num for (code, num) in counts.items() if code != BLANK_CODE})
 
-        # Organize color codes into a table
+        # Organize color codes into a table, most used first
         row_data = [['Color Code', 'Color Name', 'Number of Beads']]
-        row_data += [[self._code_remap[tup[0]], color_map[tup[0]], tup[1]] for tup in sorted_counts]
+        row_data += [[new_code, color_map[code], counts[code]] for (code, new_code) in self._code_remap.items()]
+        self._code_remap[BLANK_CODE] = BLANK_CODE
 
         # Create table
         table = Table(row_data)
@@ -126,7 +219,7 @@ class PDFGenerator:
         table.setStyle(table_style)
         table_description = 'The table below contains the color codes that you will find in the grid, along with the ' \
                             'number of each color required.'
-        flowables.append(Paragraph(table_description + '<br/><br/>', style=_STYLES['Normal']))
+        flowables.append(Paragraph(table_description + '<br/><br/>', style=_styles()['Normal']))
         flowables.append(table)
 
         return flowables
@@ -137,3 +230,242 @@ class PDFGenerator:
         Add a header to the page
         """
         canvas.drawCentredString(doc.width / 2, doc.height - doc.topMargin / 2, PDF_TEXT['HEADER'])
+
+
+class MuralPDFGenerator(PDFGenerator):
+    """
+    Bead template for a mural built on pegboards: the cover page, a map of the boards, then one section per board.
+    Boards are drawn one at a time from board_codes, so only one board's codes are held at once.
+    """
+
+    def __init__(self, color_map: Dict[str, str], counts: Dict[str, int], boards: List[Board],
+                 board_codes: Callable[[Board], List[str]], total_width: int, total_height: int,
+                 preview: Image.Image = None, text: Iterable[str] = None, num_cols: int = 30, num_rows: int = 45):
+        """
+        Constructor
+        :param color_map: dict of color_code -> color_name
+        :param counts: dict of color_code -> number of cells in the whole mural
+        :param boards: pegboards in reading order
+        :param board_codes: callable returning the color codes of a board (row-major ordering)
+        :param total_width: width of the mural
+        :param total_height: height of the mural
+        :param preview: mural at one pixel per bead, drawn under the board map
+        :param text: strings to add to the cover page
+        :param num_cols: maximum number of columns per page (boards wider than this span several pages)
+        :param num_rows: maximum number of rows per page
+        """
+        super().__init__(color_map, [], total_width, num_cols=num_cols, text=text, num_rows=num_rows, counts=counts)
+        self._boards = boards
+        self._board_codes = board_codes
+        self._total_height = total_height
+        self._preview = preview
+
+    def generate_pdf(self) -> bytes:
+        with BytesIO() as buffer:
+            self.write_pdf(buffer)
+            return buffer.getvalue()
+
+    def write_pdf(self, output: BinaryIO, workers: int = 1) -> None:
+        """
+        Writes the mural template to a file object. Boards are always drawn in this process, in order.
+        :param output: writable binary file object
+        :param workers: ignored
+        """
+        canvas = Canvas(output, pagesize=letter)
+        with stage('pdf_draw_cover'):
+            _draw_flowables(canvas, self._generate_cover_page(self._color_map, self._data, paragraphs=self._text))
+        with stage('pdf_draw_map'):
+            self._draw_board_map(canvas, canvas.getPageNumber() + 1)
+            canvas.showPage()
+
+        num_pages = 0
+        with stage('pdf_draw_boards'):
+            for board in self._boards:
+                codes = [self._code_remap[code] for code in self._board_codes(board)]
+                layout = (board.width, board.height, self._num_cols, self._num_rows)
+                for start_row in range(0, board.height, self._num_rows):
+                    for start_col in range(0, board.width, self._num_cols):
+                        _draw_grid_page(canvas, codes, layout, start_row, start_col,
+                                        title=self._board_title(board, start_row, start_col))
+                        self._draw_board_counts(canvas, codes, min(self._num_rows, board.height - start_row))
+                        canvas.showPage()
+                        num_pages += 1
+        count('pdf_grid_pages', num_pages)
+        count('pdf_boards', len(self._boards))
+        with stage('pdf_save'):
+            canvas.save()
+
+    def _board_title(self, board: Board, start_row: int, start_col: int) -> str:
+        """
+        Heading of a board page, locating the board in the layout and its cells in the mural
+        """
+        cols = min(self._num_cols, board.width - start_col)
+        rows = min(self._num_rows, board.height - start_row)
+        return 'Board {} of {} (row {}, column {}): mural columns {}-{}, rows {}-{}'.format(
+            board.number, len(self._boards), board.row + 1, board.col + 1,
+            board.left + start_col + 1, board.left + start_col + cols, board.top + start_row + 1,
+            board.top + start_row + rows)
+
+    def _draw_board_map(self, canvas: Canvas, first_board_page: int) -> None:
+        """
+        Draw the index map of the boards, over the mural preview if there is one
+        :param canvas: canvas to draw on
+        :param first_board_page: page number of the first board section
+        """
+        width, height = letter
+        board_rows = max(board.row for board in self._boards) + 1
+        board_cols = max(board.col for board in self._boards) + 1
+
+        canvas.setFillColor(colors.black)
+        canvas.setFont('Helvetica-Bold', 14)
+        canvas.drawString(_MARGIN, height - _MARGIN, 'Board Map')
+        canvas.setFont('Helvetica', 10)
+        summary = 'The mural is {} x {} beads, built on {} boards ({} across, {} down). Each board has its own ' \
+                  'section, in the numbered order, starting on page {}.'.format(
+                      self._total_width, self._total_height, len(self._boards), board_cols, board_rows,
+                      first_board_page)
+        y = height - _MARGIN - 18
+        for line in simpleSplit(summary, 'Helvetica', 10, width - 2 * _MARGIN):
+            canvas.drawString(_MARGIN, y, line)
+            y -= 12
+
+        # Scale the mural to fit the rest of the page
+        scale = min((width - 2 * _MARGIN) / self._total_width, (y - 12 - _MARGIN) / self._total_height)
+        left = _MARGIN
+        top = y - 12
+        if self._preview is not None:
+            canvas.drawImage(ImageReader(self._preview), left, top - self._total_height * scale,
+                             self._total_width * scale, self._total_height * scale)
+
+        canvas.setLineWidth(0.75)
+        canvas.setStrokeColor(colors.black)
+        font_size = max(4, min(12, int(scale * min(self._boards[0].width, self._boards[0].height) / 3)))
+        for board in self._boards:
+            x = left + board.left * scale
+            y = top - (board.top + board.height) * scale
+            canvas.setFillColor(colors.white)
+            canvas.rect(x, y, board.width * scale, board.height * scale, stroke=1, fill=0)
+            # Numbers on a white label so that they are readable over the preview
+            label = str(board.number)
+            label_width = canvas.stringWidth(label, 'Helvetica-Bold', font_size)
+            cx = x + board.width * scale / 2
+            cy = y + board.height * scale / 2
+            canvas.rect(cx - label_width / 2 - 1, cy - font_size / 2, label_width + 2, font_size, stroke=0, fill=1)
+            canvas.setFillColor(colors.black)
+            canvas.setFont('Helvetica-Bold', font_size)
+            canvas.drawCentredString(cx, cy - font_size * 0.35, label)
+
+    def _draw_board_counts(self, canvas: Canvas, codes: List[str], rows: int) -> None:
+        """
+        List the beads a board needs under its grid
+        :param canvas: canvas to draw on
+        :param codes: color codes of the board
+        :param rows: number of grid rows drawn on the page
+        """
+        counts = {}
+        for code in codes:
+            counts[code] = counts.get(code, 0) + 1
+        counts.pop(BLANK_CODE, None)
+        text = 'Beads on this board: ' + ',  '.join(
+            '{} x {}'.format(code, num) for (code, num) in sorted(counts.items(), key=lambda tup: tup[1], reverse=True))
+
+        width, height = letter
+        canvas.setFillColor(colors.black)
+        canvas.setFont('Helvetica', 8)
+        y = height - _MARGIN - rows * _CELL_SIZE[0] - 14
+        for line in simpleSplit(text, 'Helvetica', 8, width - 2 * _MARGIN):
+            if y < _MARGIN / 2:
+                break
+            canvas.drawString(_MARGIN, y, line)
+            y -= 10
+
+
+def _draw_flowables(canvas: Canvas, flowables: List[Flowable]) -> None:
+    """
+    Draw flowables onto as many pages as they need, ending each page
+    :param canvas: canvas to draw on
+    :param flowables: flowables to draw (consumed)
+    """
+    width, height = letter
+    while len(flowables) > 0:
+        frame = Frame(_MARGIN, _MARGIN, width - 2 * _MARGIN, height - 2 * _MARGIN)
+        placed = False
+        while len(flowables) > 0:
+            if frame.add(flowables[0], canvas):
+                del flowables[0]
+                placed = True
+                continue
+            # Split flowables (e.g. long tables) across pages
+            parts = frame.split(flowables[0], canvas)
+            if len(parts) < 2 or not frame.add(parts[0], canvas):
+                break
+            flowables[0:1] = parts[1:]
+            placed = True
+        if not placed:
+            raise LayoutError('Flowable too large to fit on an empty page')
+        canvas.showPage()
+
+
+def _draw_grid_page(canvas: Canvas, codes: List[str], layout: tuple, start_row: int, start_col: int,
+                    title: str = None) -> None:
+    """
+    Draw one page of the bead grid directly on the canvas
+    :param canvas: canvas to draw on
+    :param codes: color codes (row-major ordering)
+    :param layout: (total width, total height, columns per page, rows per page)
+    :param start_row: first row of the page
+    :param start_col: first column of the page
+    :param title: heading of the page (defaults to the position of the page within the pattern)
+    """
+    total_width, total_height, num_cols, num_rows = layout
+    cols = min(num_cols, total_width - start_col)
+    rows = min(num_rows, total_height - start_row)
+    cell = _CELL_SIZE[0]
+    left = _MARGIN
+    top = letter[1] - _MARGIN
+
+    # Alternating row backgrounds; empty cells stay white
+    canvas.setFillColor(colors.lightgrey)
+    for row in range(1, rows, 2):
+        offset = (start_row + row) * total_width + start_col
+        col = 0
+        for blank, run in groupby(codes[offset:offset + cols], key=lambda code: code == BLANK_CODE):
+            run_length = sum(1 for _ in run)
+            if not blank:
+                canvas.rect(left + col * cell, top - (row + 1) * cell, run_length * cell, cell, stroke=0, fill=1)
+            col += run_length
+
+    # Grid lines
+    canvas.setLineWidth(0.25)
+    canvas.setStrokeColor(colors.black)
+    canvas.grid([left + col * cell for col in range(cols + 1)], [top - row * cell for row in range(rows + 1)])
+
+    # Color codes, centered in each cell
+    canvas.setFillColor(colors.black)
+    canvas.setFont('Helvetica', 9)
+    baseline = cell / 2 - 9 * 0.35
+    for row in range(rows):
+        offset = (start_row + row) * total_width + start_col
+        y = top - (row + 1) * cell + baseline
+        for col, code in enumerate(codes[offset:offset + cols]):
+            canvas.drawCentredString(left + (col + 0.5) * cell, y, code)
+
+    # Position of this page within the pattern
+    canvas.setFont('Helvetica', 8)
+    canvas.drawString(left, top + 6, title or 'Columns {}-{}, rows {}-{}'.format(
+        start_col + 1, start_col + cols, start_row + 1, start_row + rows))
+
+
+def _render_grid_part(file_name: str, codes: List[str], layout: tuple, pages: List[tuple]) -> None:
+    """
+    Render a range of grid pages to a standalone PDF (runs in a worker process)
+    :param file_name: output PDF path
+    :param codes: color codes (row-major ordering)
+    :param layout: (total width, total height, columns per page, rows per page)
+    :param pages: (start row, start column) of each page to render
+    """
+    canvas = Canvas(file_name, pagesize=letter)
+    for start_row, start_col in pages:
+        _draw_grid_page(canvas, codes, layout, start_row, start_col)
+        canvas.showPage()
+    canvas.save()
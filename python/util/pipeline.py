@@ -0,0 +1,349 @@
+import os
+from collections import OrderedDict
+from typing import BinaryIO, Callable, List, Optional, Sequence, Union
+
+import numpy as np
+from PIL import Image, ImageFilter
+from django.conf import settings
+from django.http import QueryDict
+
+from core.models import BeadColor
+from pixel.settings import PDF_TEXT
+from util.cache import result_cache
+from util.color import METRICS, WEIGHTED_EUCLIDIAN
+from util.dither import DITHER_MODES, NONE as NO_DITHER
+from util.general import create_tmp_file
+from util.image import REMAP_METHOD, WORKING_SIZE, create_working_copy, downsample, preserve_aspect_ratio, \
+    remap_pattern, remap_version
+from util.instrument import count, stage
+from util.mural import MAX_MURAL_SIZE, MURAL_BOARD_SIZE, remap_mural
+from util.palette import PaletteSnapshot, palette_registry
+from util.pattern import BLANK_CODE, BeadPattern, assign_color_codes
+from util.reduction import reduce_palette
+from util.stage_cache import stage_cache
+
+# Processes used to render the grid pages of large patterns (settings.PDF_WORKERS). Only patterns with at least
+# util.pdf.PAGES_PER_WORKER grid pages per process are split, and only when the optional pypdf package is installed to
+# concatenate the parts; without it PDFs are rendered in a single process and a warning is logged.
+PDF_WORKERS = getattr(settings, 'PDF_WORKERS', min(4, os.cpu_count() or 1))
+# Longest side of the mural preview drawn under the board map of the PDF
+MURAL_MAP_SIZE = 512
+# Price of a single bead by brand name, for cost estimates
+BEAD_PRICES = getattr(settings, 'BEAD_PRICES', {})
+
+
+def parse_process_params(data: QueryDict) -> dict:
+    """
+    Extract and normalize processing parameters from POST data
+    :param data: POST data
+    :return: dict of parameters; an empty color list means every bead color is allowed, a num_colors of 0
+             means every allowed color may be used, and an alpha_threshold of 0 beads transparent pixels too
+    """
+    metric = data.get('metric', WEIGHTED_EUCLIDIAN)
+    dither = data.get('dither', NO_DITHER)
+    mural = data.get('mural', '0') == '1'
+    width = int(data.get('width', 64))
+    height = int(data.get('height', 64))
+    if mural:
+        width = min(width, MAX_MURAL_SIZE)
+        height = min(height, MAX_MURAL_SIZE)
+    return {
+        'width': width,
+        'height': height,
+        'blur': data.get('blur', '0') == '1',
+        'sharpen': data.get('sharpen', '0') == '1',
+        'metric': metric if metric in METRICS else WEIGHTED_EUCLIDIAN,
+        'dither': dither if dither in DITHER_MODES else NO_DITHER,
+        'colors': sorted(map(int, data.getlist('colors', []))),
+        'num_colors': max(0, int(data.get('num_colors', 0) or 0)),
+        'alpha_threshold': min(max(int(data.get('alpha_threshold', 0) or 0), 0), 255),
+        'mural': mural,
+    }
+
+
+def prepare_source(src_file: Union[str, Image.Image], blur: bool, sharpen: bool,
+                   size: int = WORKING_SIZE) -> (Image.Image, Image.Image):
+    """
+    Load a source image and prepare it for processing
+    :param src_file: path to the source image (normally the session's working copy), or the decoded image
+    :param blur: True to soften the image
+    :param sharpen: True to sharpen the image (ignored if blur is set)
+    :param size: longest side of the filtered image
+    :return: (source image, filtered image at preview size)
+    """
+    _, image, src_image = _source_stages(src_file, blur, sharpen, size)
+    return image, src_image
+
+
+def _memoized(parent_key: Optional[tuple], name: str, compute: Callable, *params) -> (Optional[tuple], object):
+    """
+    Run a pipeline stage through the stage cache
+    :param parent_key: key of the stage whose output this stage consumes, None to run without caching
+    :param name: stage name
+    :param compute: callable producing the stage output
+    :param params: parameters the stage depends on
+    :return: (key of this stage, stage output)
+    """
+    key = None if parent_key is None else (parent_key, name, params)
+    return key, stage_cache.get_or_compute(key, name, compute)
+
+
+def _source_stages(src_file: Union[str, Image.Image], blur: bool, sharpen: bool, size: int = WORKING_SIZE,
+                   source_file: str = None) -> (Optional[tuple], Image.Image, Image.Image):
+    """
+    Decode, preview and filter stages: load a source image, downsample it to the preview size and apply filters.
+    Outputs are cached per source file; decoded images passed in and mural-sized decodes of the original upload are
+    not cached, nor are the stages that follow them.
+    :param src_file: path to the source image (normally the session's working copy), or the decoded image
+    :param blur: True to soften the image
+    :param sharpen: True to sharpen the image (ignored if blur is set)
+    :param size: longest side of the filtered image
+    :param source_file: path to the original upload, decoded instead of src_file when size is larger than the
+                        working copy
+    :return: (key of the last stage, source image, filtered image at preview size)
+    """
+    if source_file is not None and size > WORKING_SIZE:
+        # A mural-sized image and its intermediates would take most of the stage cache's budget for one request
+        key, image = _memoized(None, 'decode', lambda: create_working_copy(source_file, size=size), size)
+    elif isinstance(src_file, Image.Image):
+        key, image = None, src_file
+    else:
+        key, image = _memoized((src_file,), 'decode', lambda: _open_image(src_file))
+
+    # Downsample the image to a reasonable size for previews (not needed for working copies)
+    src_image = image
+    if max(image.size) != size:
+        key, src_image = _memoized(key, 'preview', lambda: downsample(image, size, size), size)
+
+    # Apply filters if applicable
+    if blur:
+        key, src_image = _memoized(key, 'filter', lambda: src_image.filter(ImageFilter.BLUR), 'blur')
+    elif sharpen:
+        key, src_image = _memoized(key, 'filter', lambda: src_image.filter(ImageFilter.SHARPEN), 'sharpen')
+    return key, image, src_image
+
+
+def _open_image(src_file: str) -> Image.Image:
+    """
+    Decode an image file
+    """
+    image = Image.open(src_file)
+    image.load()
+    return image
+
+
+def create_pattern(src_file: Union[str, Image.Image], params: dict, available_colors: Sequence[BeadColor],
+                   source_file: str = None) -> (BeadPattern, tuple):
+    """
+    Run the image -> bead pattern process on a source image. The process is a chain of stages (decode -> preview
+    -> filter -> grid resample -> remap) whose outputs are cached per source file, so changing one parameter only
+    reruns the stages from the first that depends on it. Rendering happens when the pattern preview is requested.
+    :param src_file: path to the source image, or the decoded image
+    :param params: parameters from parse_process_params
+    :param available_colors: beads the pattern may use
+    :param source_file: path to the original upload, decoded instead of src_file for murals larger than the
+                        working copy
+    :return: (bead pattern, (width, height) of the source image)
+    """
+    size = WORKING_SIZE
+    if params['mural'] and source_file is not None:
+        size = max(size, params['width'], params['height'])
+    key, image, src_image = _source_stages(src_file, params['blur'], params['sharpen'], size, source_file)
+
+    # Downsample to the desired size (1 px per bead)
+    dest_width, dest_height = preserve_aspect_ratio(image.width, image.height, params['width'], params['height'])
+    key, px_image = _memoized(key, 'resize', lambda: downsample(src_image, dest_width, dest_height),
+                              dest_width, dest_height)
+
+    # Remap the colors to the available bead colors, optionally reduced to the beads that best reproduce the grid.
+    # Beads are keyed by color as well, since edited beads keep their ids.
+    def remap() -> BeadPattern:
+        beads = available_colors
+        if params['num_colors'] > 0:
+            with stage('reduce'):
+                beads = reduce_palette(px_image, available_colors, params['num_colors'], params['metric'],
+                                       params['alpha_threshold'])
+        count('pixels_remapped', dest_width * dest_height)
+        if params['mural']:
+            return remap_mural(px_image, beads, MURAL_BOARD_SIZE, metric=params['metric'], dither=params['dither'],
+                               alpha_threshold=params['alpha_threshold'])
+        return remap_pattern(px_image, beads, method=REMAP_METHOD, metric=params['metric'], dither=params['dither'],
+                             alpha_threshold=params['alpha_threshold'])
+
+    palette = tuple(sorted((bead.id, bead.red, bead.green, bead.blue) for bead in available_colors))
+    _, pattern = _memoized(key, 'remap', remap, palette, params['num_colors'], params['metric'], params['dither'],
+                           params['mural'], params['alpha_threshold'], remap_version())
+    return pattern, image.size
+
+
+def process_image(src_file: str, params: dict, src_hash: str = None, source_file: str = None) -> dict:
+    """
+    Run the image -> sprite process on a source image
+    :param src_file: path to the source image (normally the session's working copy)
+    :param params: parameters from parse_process_params
+    :param src_hash: digest of the source image; if given, results are served from and stored in the result cache
+    :param source_file: path to the original upload, for murals larger than the working copy
+    :return: dict containing the output size, the source aspect ratio, the bead counts (see pattern_counts) and
+             the path of the saved bead pattern
+    """
+    with stage('palette'):
+        available_colors = palette_registry.snapshot().select(params['colors'])
+    count('palette_colors', len(available_colors))
+
+    # Identical requests (from any session) are a cache read
+    pattern_file = create_tmp_file()
+    cache_key = None
+    if src_hash is not None:
+        with stage('cache_lookup'):
+            cache_key = result_cache.make_key(src_hash, params, available_colors, remap_version())
+            result = result_cache.get(cache_key, pattern_file)
+        if result is not None:
+            count('cache_hits')
+            result['pattern_file'] = pattern_file
+            return result
+
+    pattern, (src_width, src_height) = create_pattern(src_file, params, available_colors, source_file)
+
+    # Save the pattern for possible download
+    with stage('save'):
+        pattern.save(pattern_file)
+
+    result = {
+        'width': pattern.width,
+        'height': pattern.height,
+        'aspect_ratio': src_width / src_height,
+        'counts': pattern_counts(pattern),
+    }
+    if cache_key is not None:
+        result_cache.put(cache_key, pattern_file, result)
+
+    result['pattern_file'] = pattern_file
+    return result
+
+
+def bead_names(pattern: BeadPattern, palette: PaletteSnapshot = None) -> List[str]:
+    """
+    Display name of each bead of a pattern; beads deleted since the pattern was made are named by their color
+    :param pattern: bead pattern
+    :param palette: palette to name the beads from (defaults to the current palette)
+    :return: names in pattern palette order
+    """
+    palette = palette or palette_registry.snapshot()
+    return [str(palette.get(int(bead_id)) or '({}, {}, {})'.format(*color))
+            for (bead_id, color) in zip(pattern.bead_ids, pattern.colors.tolist())]
+
+
+def pattern_counts(pattern: BeadPattern) -> List[List[int]]:
+    """
+    Number of cells using each bead of a pattern, counted in one vectorized pass
+    :param pattern: bead pattern
+    :return: list of [bead id, count] pairs, most used first (JSON-serializable)
+    """
+    counts = pattern.counts()
+    order = np.argsort(-counts, kind='stable')
+    return [[int(pattern.bead_ids[i]), int(counts[i])] for i in order if counts[i] > 0]
+
+
+def count_summary(counts: List[List[int]], palette: PaletteSnapshot = None) -> dict:
+    """
+    Describe bead counts for display and pricing
+    :param counts: [bead id, count] pairs from pattern_counts
+    :param palette: palette to name the beads from (defaults to the current palette)
+    :return: dict of the total number of beads, the count of each bead (with its name and brand) and the totals of
+             each brand. Costs are included for brands with a price in BEAD_PRICES.
+    """
+    palette = palette or palette_registry.snapshot()
+    beads = []
+    brands = OrderedDict()
+    for bead_id, num in counts:
+        bead = palette.get(bead_id)
+        brand = bead.brand.name if bead is not None else None
+        beads.append({'id': bead_id, 'name': bead.name if bead is not None else None, 'brand': brand, 'count': num})
+        totals = brands.setdefault(brand, {'brand': brand, 'colors': 0, 'count': 0})
+        totals['colors'] += 1
+        totals['count'] += num
+
+    cost = None
+    for totals in brands.values():
+        if totals['brand'] in BEAD_PRICES:
+            totals['cost'] = round(totals['count'] * BEAD_PRICES[totals['brand']], 2)
+            cost = (cost or 0) + totals['cost']
+    return {'total': sum(num for (_, num) in counts), 'beads': beads, 'brands': list(brands.values()),
+            'cost': cost}
+
+
+def generate_pattern_pdf(pattern_file: str, output: BinaryIO, counts: List[List[int]] = None) -> None:
+    """
+    Generate the bead template PDF for a saved bead pattern
+    :param pattern_file: path to the saved bead pattern
+    :param output: writable binary file object to write the PDF to
+    :param counts: bead counts of the pattern from pattern_counts, if already known
+    """
+    write_pattern_pdf(BeadPattern.load(pattern_file), output, counts=counts)
+
+
+def write_pattern_pdf(pattern: BeadPattern, output: BinaryIO, palette: PaletteSnapshot = None,
+                      workers: int = PDF_WORKERS, counts: List[List[int]] = None) -> None:
+    """
+    Generate the bead template PDF for a bead pattern; murals get a board map and a section per pegboard
+    :param pattern: bead pattern
+    :param output: writable binary file object to write the PDF to
+    :param palette: palette to name the beads from (defaults to the current palette)
+    :param workers: number of processes to render grid pages with
+    :param counts: bead counts of the pattern from pattern_counts (counted from the pattern otherwise)
+    :raises ValueError: if the pattern uses more beads than there are color codes (before anything is written)
+    """
+    with stage('pdf_prepare'):
+        # One color code per used pattern bead; unused beads are never drawn
+        by_id = dict(counts if counts is not None else pattern_counts(pattern))
+        used = [by_id.get(int(bead_id), 0) for bead_id in pattern.bead_ids]
+        assigned = assign_color_codes(dict(enumerate(used)))
+        codes = [assigned.get(i, BLANK_CODE) for i in range(len(pattern.bead_ids))]
+        color_map = {code: name for (code, name) in zip(codes, bead_names(pattern, palette)) if code != BLANK_CODE}
+        counts = {code: num for (code, num) in zip(codes, used) if code != BLANK_CODE}
+
+    if pattern.board_size > 0:
+        _write_mural_pdf(pattern, output, codes, color_map, counts)
+        return
+
+    with stage('pdf_prepare'):
+        # Color codes in row-major order, blank for empty cells
+        px_data = pattern.codes(codes).ravel().tolist()
+
+    # Generate the PDF; reportlab is only imported by the processes that actually write PDFs
+    from util.pdf import PDFGenerator
+    pdf_gen = PDFGenerator(color_map, px_data, pattern.width, text=[PDF_TEXT['THANK_YOU'], PDF_TEXT['INSTRUCTIONS']],
+                           counts=counts)
+    pdf_gen.write_pdf(output, workers=workers)
+
+
+def _write_mural_pdf(pattern: BeadPattern, output: BinaryIO, codes: List[str], color_map: dict, counts: dict) -> None:
+    """
+    Generate the bead template PDF of a mural, expanding the color codes of one board at a time
+    :param pattern: bead pattern of the mural
+    :param output: writable binary file object to write the PDF to
+    :param codes: color code of each pattern bead
+    :param color_map: dict of color code -> bead name
+    :param counts: dict of color code -> number of cells
+    """
+    code_array = np.array(codes + [BLANK_CODE])
+
+    def board_codes(board) -> List[str]:
+        rows, cols = slice(board.top, board.top + board.height), slice(board.left, board.left + board.width)
+        cells = pattern.indices[rows, cols]
+        if pattern.mask is not None:
+            cells = np.where(pattern.mask[rows, cols], cells, len(codes))
+        return code_array[cells].ravel().tolist()
+
+    with stage('pdf_prepare'):
+        preview = pattern.to_image()
+        if max(preview.size) > MURAL_MAP_SIZE:
+            preview = downsample(preview, MURAL_MAP_SIZE, MURAL_MAP_SIZE, sample_filter=Image.NEAREST)
+        if preview.mode == 'RGBA':
+            # Empty cells show the page
+            preview = Image.alpha_composite(Image.new('RGBA', preview.size, 'white'), preview).convert('RGB')
+
+    from util.pdf import MuralPDFGenerator
+    pdf_gen = MuralPDFGenerator(color_map, counts, pattern.boards(), board_codes, pattern.width, pattern.height,
+                                preview=preview, text=[PDF_TEXT['THANK_YOU'], PDF_TEXT['INSTRUCTIONS']])
+    pdf_gen.write_pdf(output)
@@ -0,0 +1,87 @@
+import hashlib
+from io import BytesIO
+from typing import Callable
+
+from PIL import Image
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse, QueryDict
+from django.utils.cache import get_conditional_response, quote_etag
+
+PNG = 'png'
+WEBP = 'webp'
+PREVIEW_FORMATS = (PNG, WEBP)
+_CONTENT_TYPES = {PNG: 'image/png', WEBP: 'image/webp'}
+
+# zlib level used for PNG previews (0-9; higher is smaller and slower)
+PREVIEW_PNG_COMPRESS_LEVEL = getattr(settings, 'PREVIEW_PNG_COMPRESS_LEVEL', 6)
+# Quality of lossy WebP previews (sprites are always encoded losslessly)
+PREVIEW_WEBP_QUALITY = getattr(settings, 'PREVIEW_WEBP_QUALITY', 85)
+# Lifetime, in seconds, of previews whose URL identifies their content
+PREVIEW_MAX_AGE = getattr(settings, 'PREVIEW_MAX_AGE', 7 * 24 * 60 * 60)
+
+
+def parse_preview_params(data: QueryDict) -> (str, int):
+    """
+    Extract the output format and PNG compression level of a preview request
+    :param data: GET data
+    :return: (format, compress level)
+    """
+    fmt = data.get('format', PNG)
+    if fmt not in PREVIEW_FORMATS:
+        fmt = PNG
+    try:
+        level = min(max(int(data.get('level', PREVIEW_PNG_COMPRESS_LEVEL)), 0), 9)
+    except ValueError:
+        level = PREVIEW_PNG_COMPRESS_LEVEL
+    return fmt, level
+
+
+def preview_etag(*parts) -> str:
+    """
+    Strong ETag for a preview
+    :param parts: everything the preview's bytes depend on
+    :return: unquoted ETag
+    """
+    return hashlib.sha256(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+
+def encode_image(image: Image.Image, fmt: str, compress_level: int = PREVIEW_PNG_COMPRESS_LEVEL,
+                 lossless: bool = False) -> bytes:
+    """
+    Encode an image for display
+    :param image: image to encode
+    :param fmt: one of PREVIEW_FORMATS
+    :param compress_level: PNG compression level
+    :param lossless: True to encode WebP losslessly (for flat-colored sprites)
+    :return: encoded bytes
+    """
+    with BytesIO() as buffer:
+        if fmt == WEBP:
+            image.save(buffer, 'webp', lossless=lossless, quality=100 if lossless else PREVIEW_WEBP_QUALITY)
+        else:
+            image.save(buffer, 'png', compress_level=compress_level)
+        return buffer.getvalue()
+
+
+def create_preview_response(request: HttpRequest, etag: str, render: Callable[[], Image.Image], fmt: str,
+                            compress_level: int, immutable: bool, lossless: bool = False) -> HttpResponse:
+    """
+    Returns a cacheable image response, or 304 Not Modified if the client already has it. The image is only
+    rendered when it has to be sent.
+    :param request: current request
+    :param etag: unquoted ETag of the preview
+    :param render: callable producing the image
+    :param fmt: one of PREVIEW_FORMATS
+    :param compress_level: PNG compression level
+    :param immutable: True if the URL identifies the content, so that it can be cached without revalidation
+    :param lossless: True to encode WebP losslessly
+    :return: Http response
+    """
+    etag = quote_etag(etag)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(encode_image(render(), fmt, compress_level, lossless),
+                                content_type=_CONTENT_TYPES[fmt])
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age={}, immutable'.format(PREVIEW_MAX_AGE) if immutable else 'no-cache'
+    return response
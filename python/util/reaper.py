@@ -0,0 +1,237 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+from typing import Dict, Iterable, Set
+
+from django.conf import settings
+from django.utils import timezone
+
+from core.models import ImageSession, ProcessingJob
+from util.instrument import count
+
+logger = logging.getLogger(__name__)
+
+# Sessions unused for this many seconds are deleted
+SESSION_TTL = getattr(settings, 'SESSION_TTL', 24 * 60 * 60)
+# Maximum bytes of files per session; older job results go first, then the whole session
+SESSION_MAX_BYTES = getattr(settings, 'SESSION_MAX_BYTES', 100 * 1024 * 1024)
+# Maximum bytes of session files in TMP_DIR; least recently used sessions are deleted beyond it
+TMP_MAX_BYTES = getattr(settings, 'TMP_MAX_BYTES', 2 * 1024 * 1024 * 1024)
+# Unreferenced files younger than this many seconds may still be claimed by an in-flight request
+ORPHAN_GRACE = getattr(settings, 'ORPHAN_GRACE', 60 * 60)
+# Seconds between runs of the in-process reaper thread (None disables it)
+REAPER_INTERVAL = getattr(settings, 'REAPER_INTERVAL', None)
+
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def _is_tmp_file(file_name: str) -> bool:
+    """
+    Whether a file name in TMP_DIR was generated by create_tmp_file
+    """
+    try:
+        uuid.UUID(file_name)
+    except ValueError:
+        return False
+    return True
+
+
+def _file_size(path: str) -> int:
+    """
+    Size of a file, 0 if it does not exist
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class Reaper:
+    """
+    Deletes expired sessions, enforces the per-session and global storage quotas and removes orphaned files from
+    TMP_DIR. Safe to run concurrently from several processes: files that are already gone are skipped.
+    """
+
+    def __init__(self, tmp_dir: str = settings.TMP_DIR, ttl: float = SESSION_TTL,
+                 session_max_bytes: int = SESSION_MAX_BYTES, max_bytes: int = TMP_MAX_BYTES,
+                 orphan_grace: float = ORPHAN_GRACE):
+        """
+        Constructor
+        :param tmp_dir: directory holding the session files
+        :param ttl: seconds after which an unused session expires
+        :param session_max_bytes: maximum bytes per session
+        :param max_bytes: maximum bytes of all session files
+        :param orphan_grace: minimum age, in seconds, of an unreferenced file before it is removed
+        """
+        self.tmp_dir = tmp_dir
+        self.ttl = ttl
+        self.session_max_bytes = session_max_bytes
+        self.max_bytes = max_bytes
+        self.orphan_grace = orphan_grace
+        self.stats = None
+
+    def run(self) -> Dict[str, int]:
+        """
+        Run one reaping pass
+        :return: dict of sessions_expired, sessions_evicted, job_results_removed, orphans_removed, files_removed
+                 and bytes_reclaimed
+        """
+        self.stats = {'sessions_expired': 0, 'sessions_evicted': 0, 'job_results_removed': 0,
+                      'orphans_removed': 0, 'files_removed': 0, 'bytes_reclaimed': 0}
+
+        cutoff = timezone.now() - timedelta(seconds=self.ttl)
+        expired = list(ImageSession.objects.filter(accessed__lt=cutoff).values_list('session_key', flat=True))
+        self._delete_sessions(expired)
+        self.stats['sessions_expired'] = len(expired)
+
+        self._enforce_quotas()
+        self._remove_orphans()
+
+        for name, value in self.stats.items():
+            count('reaper_{}'.format(name), value)
+        return self.stats
+
+    def _remove(self, paths: Iterable[str]) -> None:
+        """
+        Remove files, recording the reclaimed space
+        :param paths: file paths
+        """
+        for path in paths:
+            size = _file_size(path)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.stats['files_removed'] += 1
+            self.stats['bytes_reclaimed'] += size
+
+    def _delete_sessions(self, keys: Iterable[str]) -> None:
+        """
+        Delete sessions, their jobs and all their files in bulk
+        :param keys: session keys
+        """
+        keys = list(keys)
+        if len(keys) == 0:
+            return
+        sessions = ImageSession.objects.filter(session_key__in=keys)
+        files = [fp for session in sessions.only('src_file', 'working_file', 'pattern_file') for fp in session.files]
+        files += ProcessingJob.objects.filter(session__in=keys).exclude(result_file=None) \
+            .values_list('result_file', flat=True)
+        # Rows first, so that no request finds a session whose files are gone
+        sessions.delete()
+        self._remove(files)
+
+    def _enforce_quotas(self) -> None:
+        """
+        Trim sessions over the per-session quota, then evict least recently used sessions until the total fits
+        """
+        jobs = {}
+        for job in ProcessingJob.objects.exclude(result_file=None).exclude(status__in=ProcessingJob.ACTIVE_STATUSES) \
+                .order_by('updated').only('job_id', 'session_id', 'result_file'):
+            jobs.setdefault(job.session_id, []).append(job)
+
+        usage = []
+        total = 0
+        for session in ImageSession.objects.order_by('accessed').only('session_key', 'src_file', 'working_file',
+                                                                       'pattern_file', 'accessed'):
+            size = sum(_file_size(fp) for fp in session.files)
+            job_sizes = [(job, _file_size(job.result_file)) for job in jobs.get(session.session_key, [])]
+            size += sum(job_size for (_, job_size) in job_sizes)
+
+            # Oldest job results can be regenerated, so they go first
+            for job, job_size in job_sizes:
+                if size <= self.session_max_bytes:
+                    break
+                ProcessingJob.objects.filter(pk=job.pk).update(result_file=None)
+                self._remove([job.result_file])
+                self.stats['job_results_removed'] += 1
+                size -= job_size
+
+            usage.append((session.session_key, size))
+            total += size
+
+        evict = [key for (key, size) in usage if size > self.session_max_bytes]
+        total -= sum(size for (key, size) in usage if size > self.session_max_bytes)
+        for key, size in usage:
+            if total <= self.max_bytes:
+                break
+            if size <= self.session_max_bytes:
+                evict.append(key)
+                total -= size
+        self._delete_sessions(evict)
+        self.stats['sessions_evicted'] = len(evict)
+
+    def _referenced_files(self) -> Set[str]:
+        """
+        Every file referenced by a session or job
+        """
+        referenced = set()
+        for row in ImageSession.objects.values_list('src_file', 'working_file', 'pattern_file'):
+            referenced.update(fp for fp in row if fp)
+        referenced.update(ProcessingJob.objects.exclude(result_file=None).values_list('result_file', flat=True))
+        return {os.path.abspath(fp) for fp in referenced}
+
+    def _remove_orphans(self) -> None:
+        """
+        Remove files created by create_tmp_file that no session or job references
+        """
+        if not os.path.isdir(self.tmp_dir):
+            return
+        referenced = self._referenced_files()
+        cutoff = timezone.now().timestamp() - self.orphan_grace
+        orphans = []
+        for entry in os.scandir(self.tmp_dir):
+            if not entry.is_file() or not _is_tmp_file(entry.name) or os.path.abspath(entry.path) in referenced:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    orphans.append(entry.path)
+            except OSError:
+                continue
+        before = self.stats['files_removed']
+        self._remove(orphans)
+        self.stats['orphans_removed'] = self.stats['files_removed'] - before
+
+
+def reap() -> Dict[str, int]:
+    """
+    Run one reaping pass with the configured limits
+    :return: reaping statistics, see Reaper.run
+    """
+    return Reaper().run()
+
+
+def _reap_forever(interval: float) -> None:
+    """
+    Body of the reaper thread
+    :param interval: seconds between passes
+    """
+    from django.db import close_old_connections
+    while True:
+        time.sleep(interval)
+        try:
+            stats = reap()
+            if stats['bytes_reclaimed'] > 0:
+                logger.info('Reaped %(files_removed)d files (%(bytes_reclaimed)d bytes)', stats)
+        except Exception:
+            logger.exception('Reaper pass failed')
+        finally:
+            close_old_connections()
+
+
+def start_reaper(interval: float = REAPER_INTERVAL) -> None:
+    """
+    Start the in-process reaper thread, once per process. Does nothing if interval is None.
+    :param interval: seconds between passes
+    """
+    global _thread
+    if interval is None:
+        return
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_reap_forever, args=(interval,), name='reaper', daemon=True)
+            _thread.start()
@@ -0,0 +1,136 @@
+from typing import Iterable, List
+
+import numpy as np
+from PIL import Image
+
+from core.models import BeadColor
+from util.color import WEIGHTED_EUCLIDIAN, array_distance_functions, colors_to_array, to_metric_space
+from util.image import alpha_mask
+
+# Bits per channel of the color histogram the beads are chosen from
+HISTOGRAM_BITS = 5
+# Most histogram colors the beads are chosen from; noisier images are binned more coarsely
+MAX_HISTOGRAM_COLORS = 4096
+# Most refinement passes after the initial selection
+MAX_ITERATIONS = 20
+
+
+def color_histogram(image: Image.Image, bits: int = HISTOGRAM_BITS, alpha_threshold: int = 0) -> \
+        (np.ndarray, np.ndarray):
+    """
+    Weighted color histogram of an image: pixels are binned on a quantized RGB cube, and each occupied bin is
+    represented by the mean color of its pixels
+    :param image: source image
+    :param bits: bits per channel of the bins
+    :param alpha_threshold: pixels less opaque than this (0-255) are left out, see util.image.remap_pattern
+    :return: ((K, 3) float array of bin colors, (K,) array of pixel counts)
+    """
+    data = np.asarray(image.convert('RGB'))
+    mask = alpha_mask(image, alpha_threshold)
+    data = data.reshape(-1, 3) if mask is None else data[mask]
+    shift = 8 - bits
+    bins = ((data[:, 0] >> shift).astype(np.intp) << 2 * bits) | ((data[:, 1] >> shift).astype(np.intp) << bits) | \
+        (data[:, 2] >> shift).astype(np.intp)
+    counts = np.bincount(bins, minlength=1 << 3 * bits)
+    occupied = np.flatnonzero(counts)
+    sums = np.stack([np.bincount(bins, weights=data[:, channel], minlength=len(counts))[occupied]
+                     for channel in range(3)], axis=1)
+    weights = counts[occupied].astype(np.float64)
+    return sums / weights[:, np.newaxis], weights
+
+
+def reduce_palette(image: Image.Image, beads: Iterable[BeadColor], num_colors: int,
+                   metric: str = WEIGHTED_EUCLIDIAN, alpha_threshold: int = 0) -> List[BeadColor]:
+    """
+    Choose the num_colors beads that best reproduce an image. This is k-means restricted to real beads (k-medoids):
+    every center is a bead, so no snapping step can merge or drift centers. It works on the color histogram of the
+    image rather than on its pixels, so the cost depends on the number of histogram colors (at most
+    MAX_HISTOGRAM_COLORS) and beads only.
+    :param image: image to be remapped (normally the resampled bead grid)
+    :param beads: beads to choose from
+    :param num_colors: number of beads to keep
+    :param metric: color distance metric, one of util.color.METRICS
+    :param alpha_threshold: pixels less opaque than this (0-255) are left out, since they get no bead
+    :return: chosen beads, in their original order; every bead if num_colors is 0 or not less than their number
+    """
+    beads = list(beads)
+    if num_colors <= 0 or num_colors >= len(beads):
+        return beads
+
+    bits = HISTOGRAM_BITS
+    colors, weights = color_histogram(image, bits, alpha_threshold)
+    while len(weights) > MAX_HISTOGRAM_COLORS and bits > 1:
+        # The cost of the search grows with the number of histogram colors times the number of beads
+        bits -= 1
+        colors, weights = color_histogram(image, bits, alpha_threshold)
+    if len(weights) == 0:
+        # Nothing to reproduce
+        return beads[:num_colors]
+    distances = array_distance_functions(metric)(to_metric_space(colors, metric),
+                                                 to_metric_space(colors_to_array(beads), metric))
+
+    selected = _greedy_selection(distances, weights, num_colors)
+    cost = _cost(distances, weights, selected)
+    for _ in range(MAX_ITERATIONS):
+        candidate = _refine(distances, weights, selected)
+        candidate_cost = _cost(distances, weights, candidate)
+        if candidate_cost >= cost:
+            break
+        selected, cost = candidate, candidate_cost
+    return [beads[i] for i in sorted(selected)]
+
+
+def _cost(distances: np.ndarray, weights: np.ndarray, selected: List[int]) -> float:
+    """
+    Total weighted distance from each histogram color to its nearest selected bead
+    """
+    return float(weights @ distances[:, selected].min(axis=1))
+
+
+def _greedy_selection(distances: np.ndarray, weights: np.ndarray, num_colors: int) -> List[int]:
+    """
+    Initial selection: repeatedly add the bead that lowers the total weighted distance the most
+    :param distances: (K, M) distances between histogram colors and beads
+    :param weights: (K,) pixel count of each histogram color
+    :param num_colors: number of beads to select
+    :return: indices of the selected beads
+    """
+    selected = [int(np.argmin(weights @ distances))]
+    nearest = distances[:, selected[0]].copy()
+    for _ in range(num_colors - 1):
+        gains = weights @ np.maximum(nearest[:, np.newaxis] - distances, 0)
+        gains[selected] = -1
+        best = int(np.argmax(gains))
+        selected.append(best)
+        np.minimum(nearest, distances[:, best], out=nearest)
+    return selected
+
+
+def _refine(distances: np.ndarray, weights: np.ndarray, selected: List[int]) -> List[int]:
+    """
+    One Lloyd pass: assign histogram colors to their nearest selected bead, then replace each cluster's bead with
+    the bead that serves the cluster best. Heavier clusters choose first, and no bead is chosen twice.
+    :param distances: (K, M) distances between histogram colors and beads
+    :param weights: (K,) pixel count of each histogram color
+    :param selected: indices of the selected beads
+    :return: indices of the new selection
+    """
+    assignment = np.argmin(distances[:, selected], axis=1)
+    membership = np.zeros((len(selected), len(weights)))
+    membership[assignment, np.arange(len(weights))] = weights
+    cluster_costs = membership @ distances
+
+    refined = list(selected)
+    taken = set()
+    cluster_weights = membership.sum(axis=1)
+    for cluster in np.argsort(-cluster_weights, kind='stable'):
+        # Clusters that attracted no colors keep their bead unless another cluster took it
+        order = np.argsort(cluster_costs[cluster], kind='stable')
+        if cluster_weights[cluster] == 0:
+            order = [selected[cluster]] + list(order)
+        for bead in order:
+            if int(bead) not in taken:
+                refined[cluster] = int(bead)
+                taken.add(int(bead))
+                break
+    return refined
@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+from PIL import Image
+from django.conf import settings
+
+from util.instrument import count, stage
+from util.pattern import BeadPattern
+
+# Memory budget, per worker process, of the intermediate results of the image -> bead pattern process
+STAGE_CACHE_MAX_BYTES = getattr(settings, 'STAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+
+
+def _nbytes(value) -> int:
+    """
+    Approximate memory held by a stage output
+    :param value: image or bead pattern
+    :return: size in bytes
+    """
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, BeadPattern):
+        return value.indices.nbytes + value.bead_ids.nbytes + value.colors.nbytes + \
+            (0 if value.mask is None else value.mask.nbytes)
+    raise TypeError('Cannot size stage output of type {}'.format(type(value).__name__))
+
+
+class StageCache:
+    """
+    Thread-safe LRU cache of the outputs of pipeline stages (decoded and filtered images, bead grids and patterns),
+    bounded by memory. The key of each stage extends the key of the stage it consumes with the parameters it
+    depends on, so a parameter change misses from the first stage that uses it onwards while the stages before it
+    are served from the cache. Cached outputs are shared and must not be modified.
+    """
+
+    def __init__(self, max_bytes: int = STAGE_CACHE_MAX_BYTES):
+        """
+        Constructor
+        :param max_bytes: maximum total size of the cached outputs
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: Optional[Hashable], name: str, compute: Callable):
+        """
+        Get the output of a stage, computing (and timing) it if it is not cached
+        :param key: stage key, None to compute without caching
+        :param name: stage name, for instrumentation
+        :param compute: callable producing the stage output
+        :return: the stage output
+        """
+        if key is not None:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+            if entry is not None:
+                count('stage_cache_hits')
+                return entry[0]
+            with self._lock:
+                self.misses += 1
+            count('stage_cache_misses')
+
+        with stage(name):
+            value = compute()
+        if key is None:
+            return value
+
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        """
+        Remove every cached output
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """
+        Cache counters
+        :return: dict of hits, misses, evictions, entries and bytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self._bytes}
+
+    def _discard(self, key: Hashable) -> None:
+        """
+        Remove an entry (caller must hold the lock)
+        :param key: entry key
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+
+stage_cache = StageCache()
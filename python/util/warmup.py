@@ -0,0 +1,98 @@
+import gc
+import importlib
+import logging
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.urls import get_resolver
+
+from util.color import WEIGHTED_EUCLIDIAN
+from util.color_index import palette_index_cache
+from util.dither import DIFFUSION_TABLE_BITS
+from util.image import REMAP_METHOD
+from util.instrument import INSTRUMENTATION, registry
+from util.lookup import find_table
+from util.palette import palette_registry
+
+logger = logging.getLogger(__name__)
+
+# Warm up when the WSGI application is loaded
+WARMUP = getattr(settings, 'WARMUP', True)
+# Modules imported (and timed) before the URLconf; the PDF code is left out on purpose, it is imported on first use
+WARMUP_MODULES = getattr(settings, 'WARMUP_MODULES', ('numpy', 'PIL.Image', 'util.pipeline', 'core.views'))
+# Metrics whose palette index over the full palette is built ahead of the first request
+WARMUP_METRICS = getattr(settings, 'WARMUP_METRICS', (WEIGHTED_EUCLIDIAN,))
+# Also build the color tables used by error diffusion dithering for those indices
+WARMUP_DITHER = getattr(settings, 'WARMUP_DITHER', True)
+
+
+@contextmanager
+def _timed(report: OrderedDict, name: str):
+    """
+    Record the duration of a warm-up step in the report
+    :param report: step name -> seconds
+    :param name: step name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report[name] = time.perf_counter() - start
+
+
+def warm_up(freeze: bool = True) -> OrderedDict:
+    """
+    Do the work every web worker would otherwise do on its first requests: import the views and the pipeline, load
+    the palette snapshot, build the palette indices and dither tables of the full palette and map the prebuilt
+    lookup tables if the pipeline uses them. Run before the server forks its workers (e.g. gunicorn --preload), they
+    all share this state copy-on-write; the lookup tables are memory-mapped, so they are shared through the page
+    cache either way.
+    :param freeze: move everything allocated so far to the permanent generation of the garbage collector, so that
+                   collections in the workers do not write to (and so copy) the shared pages
+    :return: seconds per warm-up step, in order
+    """
+    report = OrderedDict()
+    start = time.perf_counter()
+    for module_name in WARMUP_MODULES:
+        with _timed(report, 'import {}'.format(module_name)):
+            importlib.import_module(module_name)
+    with _timed(report, 'urls'):
+        get_resolver().url_patterns
+
+    with _timed(report, 'palette'):
+        palette = palette_registry.snapshot()
+    if len(palette) > 0:
+        for metric in WARMUP_METRICS:
+            with _timed(report, 'palette_index {}'.format(metric)):
+                _, index = palette_index_cache.get(palette.beads, metric)
+            if WARMUP_DITHER:
+                with _timed(report, 'dither_table {}'.format(metric)):
+                    palette_index_cache.quantized_table(index, DIFFUSION_TABLE_BITS)
+    if len(palette) > 0 and REMAP_METHOD == 'lookup':
+        with _timed(report, 'lookup_tables'):
+            # The tables are normally built for the full palette and for each brand
+            for beads in [palette.beads] + list(palette.color_groups.values()):
+                table = find_table(beads)
+                if table is not None:
+                    # Fault the pages in now rather than during a request
+                    table.table.max()
+
+    # Workers must not inherit open database connections
+    connections.close_all()
+    if freeze and hasattr(gc, 'freeze'):
+        with _timed(report, 'gc_freeze'):
+            gc.collect()
+            gc.freeze()
+    report['total'] = time.perf_counter() - start
+
+    if INSTRUMENTATION:
+        for name, seconds in report.items():
+            registry.observe('stage', 'warmup {}'.format(name), seconds)
+    logger.info('Warm-up finished in %.3fs (%s); PDF code %s', report['total'],
+                ', '.join('{} {:.3f}s'.format(name, seconds) for (name, seconds) in report.items() if name != 'total'),
+                'loaded' if 'util.pdf' in sys.modules else 'not loaded')
+    return report
@@ -0,0 +1,18 @@
+import importlib
+import os
+
+
+def init_worker(initializer: str = None, *args) -> None:
+    """
+    Initialize Django in a freshly spawned worker process. This module imports nothing from Django at load time,
+    so that it can be unpickled before the app registry is ready.
+    :param initializer: optional dotted path of a function to call once Django is set up
+    :param args: arguments for the initializer
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pixel.settings')
+    import django
+    django.setup()
+
+    if initializer is not None:
+        module_name, function_name = initializer.rsplit('.', 1)
+        getattr(importlib.import_module(module_name), function_name)(*args)